@@ -4,8 +4,10 @@ from flowy.swf.config import SWFWorkflowConfig
 from flowy.swf.starter import SWFWorkflowStarter
 from flowy.swf.worker import SWFActivityWorker
 from flowy.swf.worker import SWFWorkflowWorker
+from flowy.operations import batch
 from flowy.operations import finish_order
 from flowy.operations import first
+from flowy.operations import parallel_map
 from flowy.operations import parallel_reduce
 from flowy.result import restart
 from flowy.result import TaskError
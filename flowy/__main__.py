@@ -1,7 +1,9 @@
 import argparse
+import json
 import sys
 
 from flowy import SWFWorkflowStarter
+from flowy.utils import setup_default_logger
 
 
 def main():
@@ -13,16 +15,48 @@ def main():
     parser.add_argument("--decision-duration", type=int, default=None)
     parser.add_argument("--workflow-duration", type=int, default=None)
     parser.add_argument("--child-policy", type=str, default=None)
+    parser.add_argument("--inputs", type=argparse.FileType('r'), default=None,
+                        help="start a workflow for each line of this JSON "
+                             "lines file, instead of using args")
+    parser.add_argument("--concurrency", type=int, default=8)
     parser.add_argument('args', nargs=argparse.REMAINDER)
 
     args = parser.parse_args()
 
     starter = SWFWorkflowStarter(args.domain, args.name, args.version,
-                                 args.task_list, args.decision_duration,
-                                 args.workflow_duration,
+                                 task_list=args.task_list,
+                                 decision_duration=args.decision_duration,
+                                 workflow_duration=args.workflow_duration,
                                  child_policy=args.child_policy)
+    if args.inputs is not None:
+        setup_default_logger()  # the throughput is logged
+        results = starter.start_many(read_inputs(args.inputs),
+                                     concurrency=args.concurrency)
+        failed = 0
+        for number, result in enumerate(results, 1):
+            if result.status == 'failed':
+                failed += 1
+                sys.stderr.write('Input %s (%s) failed: %s\n'
+                                 % (number, result.wid, result.error))
+        sys.stderr.write('%s inputs, %s failed\n' % (len(results), failed))
+        return int(failed > 0)
     return not starter(*args.args)  # 0 is success
 
 
+def read_inputs(lines):
+    """Parse the inputs for start_many, one JSON value per line.
+
+    A line is either a list of args or an object with args, kwargs and wid
+    (the workflow id) keys, all optional.
+    """
+    for line in lines:
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        if isinstance(item, list):
+            item = {'args': item}
+        yield item
+
+
 if __name__ == '__main__':
     sys.exit(main())
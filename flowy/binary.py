@@ -0,0 +1,330 @@
+"""A binary encoding, an alternative to the tagged JSON encoding.
+
+Unlike JSON, it keeps tuples apart from lists, stores bytes, UUIDs and
+floats without any textual conversion and allows any hashable as a dict key.
+The encoded data is wrapped in base64 so that it's safe to store as text in
+the SWF history, and prefixed with a version header so that loads can tell it
+apart from JSON payloads.
+
+It's meant for the values JSON can't represent exactly, not for speed: the
+decoder is pure Python, several times slower than the JSON one, and the
+base64 wrapping makes text heavy payloads about a third larger than JSON.
+Only payloads of bytes, or of numbers and short strings, come out smaller.
+"""
+
+import binascii
+import struct
+import sys
+import uuid
+from base64 import b64decode
+from base64 import b64encode
+
+if sys.version_info < (3,):
+    uni = unicode
+    ints = (int, long)
+    to_byte = chr
+    as_octets = bytearray  # indexing str returns characters
+else:
+    uni = str
+    ints = int
+    to_byte = lambda i: bytes((i,))
+    as_octets = lambda data: data
+
+
+__all__ = ['HEADER', 'encode', 'decode', 'RawPayload']
+
+
+HEADER = '~1'  # JSON payloads can't start with ~
+
+
+class RawPayload(object):
+    """A payload of any format, embedded as is in the encoded data."""
+
+    __slots__ = ['data']
+
+    def __init__(self, data):
+        self.data = data
+
+
+def encode(value, extension=None):
+    """Encode a value and return the text to be stored.
+
+    The values of other types are passed to the extension callable, if set,
+    which returns a (tag, data) pair to encode in their place, or None.
+    """
+    out = bytearray()
+    _encode(value, out, extension)
+    return HEADER + b64encode(bytes(out)).decode('ascii')
+
+
+def decode(text, load_payload, load_extension=None):
+    """Decode the text produced by encode.
+
+    The embedded raw payloads are decoded with the load_payload callable and
+    the values encoded by an extension with load_extension(tag, data).
+    """
+    if not text.startswith(HEADER):
+        raise ValueError('Unknown binary payload version: %r' % text[:2])
+    try:
+        data = as_octets(b64decode(text[len(HEADER):].encode('ascii')))
+    except (binascii.Error, TypeError, UnicodeEncodeError):
+        raise ValueError('Invalid binary payload.')
+    try:
+        value, pos = _decode(data, 0, (load_payload, load_extension))
+    except (IndexError, struct.error):
+        raise ValueError('Truncated binary payload.')
+    if pos != len(data):
+        raise ValueError('Trailing data in binary payload.')
+    return value
+
+
+def _write_varint(out, n):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _write_sized(out, tag, data):
+    out.append(tag)
+    _write_varint(out, len(data))
+    out.extend(data)
+
+
+def _encode_none(value, out, ext):
+    out.append(_N)
+
+
+def _encode_bool(value, out, ext):
+    out.append(_T if value else _F)
+
+
+def _encode_int(value, out, ext):
+    out.append(_I)
+    _write_varint(out, value << 1 if value >= 0 else (-value << 1) - 1)
+
+
+def _encode_float(value, out, ext):
+    out.append(_FLOAT)
+    out.extend(_pack_double(value))
+
+
+def _encode_unicode(value, out, ext):
+    _write_sized(out, _S, value.encode('utf-8'))
+
+
+def _encode_bytes(value, out, ext):
+    _write_sized(out, _B, value)
+
+
+def _encode_uuid(value, out, ext):
+    out.append(_U)
+    out.extend(value.bytes)
+
+
+def _encode_raw(value, out, ext):
+    _write_sized(out, _R, value.data.encode('utf-8'))
+
+
+def _encode_list(value, out, ext):
+    out.append(_L)
+    _write_varint(out, len(value))
+    for item in value:
+        _encode(item, out, ext)
+
+
+def _encode_tuple(value, out, ext):
+    out.append(_TUPLE)
+    _write_varint(out, len(value))
+    for item in value:
+        _encode(item, out, ext)
+
+
+def _encode_dict(value, out, ext):
+    out.append(_D)
+    _write_varint(out, len(value))
+    for k, v in value.items():
+        _encode(k, out, ext)
+        _encode(v, out, ext)
+
+
+def _encode_extension(tag, data, out, ext):
+    _write_sized(out, _X, tag.encode('utf-8'))
+    _encode(data, out, ext)
+
+
+def _encode(value, out, ext):
+    # The exact types are dispatched with a lookup, subclasses and objects
+    # with a __json__ method go through the slower checks below.
+    encoder = _ENCODERS.get(type(value))
+    if encoder is not None:
+        return encoder(value, out, ext)
+    if ext is not None:
+        tagged = ext(value)
+        if tagged is not None:
+            return _encode_extension(tagged[0], tagged[1], out, ext)
+    if callable(getattr(value, '__json__', None)):
+        return _encode(value.__json__(), out, ext)
+    for base, encoder in _SUBCLASS_ENCODERS:
+        if isinstance(value, base):
+            return encoder(value, out, ext)
+    raise TypeError('Cannot encode %r' % (value,))
+
+
+def _read_varint(data, pos):
+    byte = data[pos]
+    if byte < 0x80:
+        return byte, pos + 1  # most sizes and small ints fit in a byte
+    n = shift = 0
+    while 1:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return n, pos
+        shift += 7
+
+
+def _read_sized(data, pos):
+    size, pos = _read_varint(data, pos)
+    end = pos + size
+    if end > len(data):
+        raise ValueError('Truncated binary payload.')
+    return bytes(data[pos:end]), end
+
+
+def _decode_none(data, pos, loaders):
+    return None, pos
+
+
+def _decode_true(data, pos, loaders):
+    return True, pos
+
+
+def _decode_false(data, pos, loaders):
+    return False, pos
+
+
+def _decode_int(data, pos, loaders):
+    n, pos = _read_varint(data, pos)
+    return (n >> 1 if not n & 1 else -((n + 1) >> 1)), pos
+
+
+def _decode_float(data, pos, loaders):
+    return _unpack_double(data, pos)[0], pos + 8
+
+
+def _decode_unicode(data, pos, loaders):
+    # The most common value, decoded from the slice without a bytes copy
+    size, pos = _read_varint(data, pos)
+    end = pos + size
+    if end > len(data):
+        raise ValueError('Truncated binary payload.')
+    return data[pos:end].decode('utf-8'), end
+
+
+def _decode_bytes(data, pos, loaders):
+    return _read_sized(data, pos)
+
+
+def _decode_raw(data, pos, loaders):
+    chunk, pos = _read_sized(data, pos)
+    return loaders[0](chunk.decode('utf-8')), pos
+
+
+def _decode_uuid(data, pos, loaders):
+    end = pos + 16
+    if end > len(data):
+        raise ValueError('Truncated binary payload.')
+    return uuid.UUID(bytes=bytes(data[pos:end])), end
+
+
+def _decode_list(data, pos, loaders):
+    size, pos = _read_varint(data, pos)
+    items = []
+    append = items.append
+    decoders = _DECODERS
+    for _ in range(size):
+        item, pos = decoders[data[pos]](data, pos + 1, loaders)
+        append(item)
+    return items, pos
+
+
+def _decode_tuple(data, pos, loaders):
+    items, pos = _decode_list(data, pos, loaders)
+    return tuple(items), pos
+
+
+def _decode_dict(data, pos, loaders):
+    size, pos = _read_varint(data, pos)
+    d = {}
+    decoders = _DECODERS
+    for _ in range(size):
+        k, pos = decoders[data[pos]](data, pos + 1, loaders)
+        d[k], pos = decoders[data[pos]](data, pos + 1, loaders)
+    return d, pos
+
+
+def _decode_extension(data, pos, loaders):
+    tag, pos = _read_sized(data, pos)
+    value, pos = _decode(data, pos, loaders)
+    if loaders[1] is None:
+        raise ValueError('No decoder for the binary extension %r.' % tag)
+    return loaders[1](tag.decode('utf-8'), value), pos
+
+
+def _decode_unknown(data, pos, loaders):
+    tag = to_byte(data[pos - 1])
+    raise ValueError('Unknown tag in binary payload: %r' % tag)
+
+
+def _decode(data, pos, loaders):
+    return _DECODERS[data[pos]](data, pos + 1, loaders)
+
+
+(_N, _T, _F, _I, _FLOAT, _S, _B, _R, _U, _L, _TUPLE, _D, _X) = bytearray(
+    b'NTFifsbrultdx')
+
+_double = struct.Struct('>d')
+_pack_double = _double.pack
+_unpack_double = _double.unpack_from
+
+_ENCODERS = {
+    type(None): _encode_none,
+    bool: _encode_bool,
+    int: _encode_int,
+    float: _encode_float,
+    uni: _encode_unicode,
+    bytes: _encode_bytes,
+    uuid.UUID: _encode_uuid,
+    RawPayload: _encode_raw,
+    list: _encode_list,
+    tuple: _encode_tuple,
+    dict: _encode_dict,
+}
+if sys.version_info < (3,):
+    _ENCODERS[long] = _encode_int
+
+# Checked in order, bool before int as it's a subclass
+_SUBCLASS_ENCODERS = [
+    (bool, _encode_bool),
+    (ints, _encode_int),
+    (float, _encode_float),
+    (uni, _encode_unicode),
+    (bytes, _encode_bytes),
+    (uuid.UUID, _encode_uuid),
+    (list, _encode_list),
+    (tuple, _encode_tuple),
+    (dict, _encode_dict),
+]
+
+_DECODERS = [_decode_unknown] * 256
+for _tag, _decoder in [
+    (_N, _decode_none), (_T, _decode_true), (_F, _decode_false),
+    (_I, _decode_int), (_FLOAT, _decode_float), (_S, _decode_unicode),
+    (_B, _decode_bytes), (_R, _decode_raw), (_U, _decode_uuid),
+    (_L, _decode_list), (_TUPLE, _decode_tuple), (_D, _decode_dict),
+    (_X, _decode_extension),
+]:
+    _DECODERS[_tag] = _decoder
+del _tag, _decoder
@@ -0,0 +1,78 @@
+"""Content addressed stores for payloads too large to keep in the history.
+
+See flowy.serialization.Serializer for how payloads are offloaded.
+"""
+
+import errno
+import hashlib
+import os
+import tempfile
+
+
+__all__ = ['BlobStore', 'FileBlobStore', 'blob_key']
+
+
+def blob_key(data):
+    """The content address of some serialized data."""
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class BlobStore(object):
+    """The interface of a blob store.
+
+    The blobs are serialized payloads (text) stored under their blob_key. As
+    the keys depend only on the content, the blobs are never overwritten and
+    can be cached forever.
+    """
+
+    def put(self, key, data):
+        """Store the data under key."""
+        raise NotImplementedError
+
+    def get(self, key):
+        """Return the data stored under key or raise KeyError."""
+        raise NotImplementedError
+
+
+class FileBlobStore(BlobStore):
+    """A blob store in a local (or shared) directory."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _path(self, key):
+        if not key.isalnum():
+            raise ValueError('Invalid blob key: %r' % (key,))
+        return os.path.join(self.path, key[:2], key)
+
+    def put(self, key, data):
+        path = self._path(key)
+        if os.path.exists(path):
+            return
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # Write and rename so that readers never see partial blobs
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data.encode('utf-8'))
+            os.rename(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read().decode('utf-8')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                raise KeyError(key)
+            raise
+
+    def __repr__(self):
+        return '<FileBlobStore %r>' % self.path
@@ -5,12 +5,17 @@ import keyword
 import venusian
 
 from flowy.result import is_result_proxy
+from flowy.result import log_ignored_errors
 from flowy.result import restart_type
 from flowy.result import SuspendTask
 from flowy.result import TaskError
 from flowy.result import wait
+from flowy.proxy import serialize_input_binary
 from flowy.serialization import dumps
+from flowy.serialization import dumps_binary
+from flowy.serialization import is_raw_aware
 from flowy.serialization import loads
+from flowy.serialization import raw_aware
 from flowy.serialization import traverse_data
 from flowy.utils import logger
 
@@ -30,7 +35,8 @@ class ActivityConfig(object):
 
     category = None  # The category used with venusian
 
-    def __init__(self, deserialize_input=None, serialize_result=None):
+    def __init__(self, deserialize_input=None, serialize_result=None,
+                 raw=False, binary=False, serializer=None):
         """Initialize the activity config object.
 
         The deserialize_input/serialize_result callables are used to
@@ -41,7 +47,38 @@ class ActivityConfig(object):
         Custom serializers must walk the entire data structure. This ensures
         that any placeholder or error objects in the data structure will have a
         chance to raise.
+
+        If raw is set, the activity is called with the undecoded input data
+        instead of the decoded args and kwargs and must return an already
+        serialized result, as text or UTF-8 encoded bytes. This is useful for
+        activities that only route or store data.
+
+        If binary is set, the result is serialized with the binary encoding
+        instead of JSON, see flowy.binary for when it's worth it. The input is
+        decoded from either format.
+
+        The serializer, if set, is a flowy.serialization.Serializer used for
+        both the input and the result, with its own format, blob store,
+        compression and types. The settings travel with the config, so they
+        also apply in the worker processes.
         """
+        if serializer is not None:
+            if (raw or binary or deserialize_input is not None
+                    or serialize_result is not None):
+                raise ValueError('A serializer cannot be used with custom '
+                                 'serializers, raw or binary.')
+            deserialize_input = serializer.deserialize_input
+            serialize_result = serializer.serialize_result
+        if (raw or binary) and (deserialize_input is not None
+                                or serialize_result is not None):
+            raise ValueError(
+                'Custom serializers cannot be used with raw or binary.')
+        if raw and binary:
+            raise ValueError('Raw activities cannot use the binary encoding.')
+        if raw:
+            deserialize_input, serialize_result = _raw_input, _raw_result
+        if binary:
+            serialize_result = dumps_binary
         # Use default methods for the serialization/deserialization instead of
         # default argument values. This is convenient for the local backend
         # that uses pickle.
@@ -113,6 +150,19 @@ class ActivityConfig(object):
         return functools.partial(_activity_wrapper, self, func)
 
 
+def _raw_input(input_data):
+    return [input_data], {}
+
+
+def _raw_result(result):
+    # The results are sent as text, str() would turn bytes into "b'...'"
+    if isinstance(result, bytes):
+        return result.decode('utf-8')
+    if not isinstance(result, type(u'')):
+        raise ValueError('Raw activities must return serialized results.')
+    return result
+
+
 def _activity_wrapper(self, func, input_data, *extra_args):
     try:
         args, kwargs = self.deserialize_input(input_data)
@@ -131,17 +181,29 @@ class WorkflowConfig(ActivityConfig):
     """A simple/generic workflow configuration object with dependencies."""
 
     def __init__(self, deserialize_input=None, serialize_result=None,
-                 serialize_restart_input=None):
+                 serialize_restart_input=None, binary=False, serializer=None):
         """Initialize the workflow config object.
 
         The deserialize_input, serialize_result and serialize_restart_input
         callables are used to deserialize the initial input data, serialize the
         final result and serialize the restart arguments. It uses JSON by
-        default.
+        default, or the binary encoding if binary is set.
 
-        See ActivityConfig for a note on serialization.
+        See ActivityConfig for a note on serialization and the serializer.
         """
-        super(WorkflowConfig, self).__init__(deserialize_input, serialize_result)
+        super(WorkflowConfig, self).__init__(deserialize_input, serialize_result,
+                                             binary=binary,
+                                             serializer=serializer)
+        if serializer is not None:
+            if serialize_restart_input is not None:
+                raise ValueError('A serializer cannot be used with custom '
+                                 'serializers, raw or binary.')
+            serialize_restart_input = serializer.serialize_input
+        if binary:
+            if serialize_restart_input is not None:
+                raise ValueError(
+                    'Custom serializers cannot be used with binary.')
+            serialize_restart_input = serialize_input_binary
         if serialize_restart_input is not None:
             self.serialize_restart_input = serialize_restart_input
         self.proxy_factory_registry = {}
@@ -151,10 +213,19 @@ class WorkflowConfig(ActivityConfig):
         return dumps([args, kwargs])
 
     @staticmethod
+    @raw_aware
     def serialize_result(result):
         """Try to serialize the result, returns any errors or placeholders."""
         return dumps(result)
 
+    def input_deserializer(self, *extra_args):
+        """Return the callable used to deserialize the workflow input.
+
+        Backends can override this to make use of the extra_args the workflow
+        is called with.
+        """
+        return self.deserialize_input
+
     def _check_dep(self, dep_name):
         """Check if dep_name is a unique valid identifier name."""
         # stolen from namedtuple
@@ -203,12 +274,17 @@ class WorkflowConfig(ActivityConfig):
 
 
 def _workflow_wrapper(self, factory, input_data, *extra_args):
+    with log_ignored_errors():
+        return _run_workflow(self, factory, input_data, *extra_args)
+
+
+def _run_workflow(self, factory, input_data, *extra_args):
     wf_kwargs = {}
     for dep_name, proxy in self.proxy_factory_registry.items():
         wf_kwargs[dep_name] = proxy(*extra_args)
     func = factory(**wf_kwargs)
     try:
-        args, kwargs = self.deserialize_input(input_data)
+        args, kwargs = self.input_deserializer(*extra_args)(input_data)
     except Exception:
         logger.exception('Cannot deserialize the input:')
         raise ValueError('Cannot deserialize the input: %r' % (input_data,))
@@ -238,8 +314,11 @@ def _workflow_wrapper(self, factory, input_data, *extra_args):
                 'Cannot serialize the restart arguments: %r, %r' %
                 result.args, result.kwargs)
         raise Restart(serialized_input)
+    # Results forwarded unchanged are spliced as is by the default serializers
+    forward_raw = is_raw_aware(self.serialize_result)
     try:
-        traversed_result, (error, placeholders) = traverse_data(result)
+        traversed_result, (error, placeholders) = traverse_data(
+            result, forward_raw=forward_raw)
     except Exception:
         logger.exception('Cannot traverse the result:')
         raise ValueError('Cannot traverse the result: %r' % result)
@@ -0,0 +1,94 @@
+__all__ = ['RUNNING', 'RESULT', 'ERROR', 'TIMEDOUT', 'HistoryIndex',
+           'parse_task_key']
+
+
+# The states a task can be in; a task missing from the index is not scheduled
+RUNNING = 1
+RESULT = 2
+ERROR = 3
+TIMEDOUT = 4
+
+_NOT_FOUND = {}
+
+
+class HistoryIndex(object):
+    """An index of the task states in an execution history.
+
+    The index maps identity -> call_number -> retry_number to an entry with
+    the (state, order, payload) of each task. The order is the finish position
+    of the task, or None if the task isn't finished, and the payload is either
+    the result or the error reason. A single lookup per call answers every
+    question a proxy has about its retries.
+    """
+
+    def __init__(self):
+        self.tasks = {}
+
+    def set(self, call_key, state, order=None, payload=None):
+        """Set the state of a task. Keys that aren't task keys are ignored."""
+        parsed = parse_task_key(call_key)
+        if parsed is None:
+            return
+        identity, call_number, retry_number = parsed
+        calls = self.tasks.get(identity)
+        if calls is None:
+            calls = self.tasks[identity] = {}
+        retries = calls.get(call_number)
+        if retries is None:
+            retries = calls[call_number] = {}
+        retries[retry_number] = (state, order, payload)
+
+    def copy(self):
+        """Return an independent copy; the entries are immutable tuples."""
+        index = self.__class__()
+        index.tasks = dict(
+            (identity, dict((call_number, dict(retries))
+                            for call_number, retries in calls.items()))
+            for identity, calls in self.tasks.items())
+        return index
+
+    def get(self, call_key):
+        """Return the entry for a task key or None if it's not scheduled."""
+        parsed = parse_task_key(call_key)
+        if parsed is None:
+            return None
+        identity, call_number, retry_number = parsed
+        return self.retries(identity, call_number).get(retry_number)
+
+    def retries(self, identity, call_number):
+        """Return a mapping of retry_number -> entry for a proxy call."""
+        return self.tasks.get(identity, _NOT_FOUND).get(call_number, _NOT_FOUND)
+
+    def results(self, identity):
+        """Iterate over the result payloads of all the tasks of a proxy."""
+        for retries in self.tasks.get(identity, _NOT_FOUND).values():
+            for state, _, payload in retries.values():
+                if state == RESULT:
+                    yield payload
+
+    @classmethod
+    def from_sets(cls, running, timedout, results, errors, order):
+        """Build the index from the running/timedout/results/errors/order."""
+        index = cls()
+        positions = {}
+        for position, call_key in enumerate(order):
+            positions.setdefault(call_key, position)
+        # On conflicts the later states win, in the order the proxies check
+        for call_key, reason in errors.items():
+            index.set(call_key, ERROR, positions.get(call_key), reason)
+        for call_key, result in results.items():
+            index.set(call_key, RESULT, positions.get(call_key), result)
+        for call_key in running:
+            index.set(call_key, RUNNING)
+        for call_key in timedout:
+            index.set(call_key, TIMEDOUT, positions.get(call_key))
+        return index
+
+
+def parse_task_key(call_key):
+    """Split a identity-call_number-retry_number key or return None."""
+    try:
+        identity, call_number, retry_number = str(call_key).rsplit('-', 2)
+        return identity, int(call_number), int(retry_number)
+    except ValueError:
+        return None
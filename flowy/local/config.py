@@ -3,9 +3,13 @@ from concurrent.futures import ProcessPoolExecutor
 from flowy.config import WorkflowConfig
 from flowy.local.decision import Decision
 from flowy.local.proxy import ActivityProxy
+from flowy.local.proxy import TimerProxy
 from flowy.local.proxy import WorkflowProxy
+from flowy.local.runner import RecyclingExecutor
 from flowy.local.runner import RootWorkflowRunner
 from flowy.proxy import Proxy
+from flowy.swf.config import max_rate_encode
+from flowy.swf.config import rate_encode
 from flowy.tracer import ExecutionTracer
 from flowy.worker import Worker
 
@@ -22,11 +26,40 @@ class LocalWorkflow(WorkflowConfig):
         self.worker = Worker()
         self.worker.register_task('local', self.wrap(w))
 
-    def conf_activity(self, dep_name, f):
-        self.conf_proxy_factory(dep_name, ActivityProxy(dep_name, f))
+    def conf_activity(self, dep_name, f, max_rate=None, start_to_close=None,
+                      retry=(0, 0, 0)):
+        """Configure an activity dependency.
 
-    def conf_workflow(self, dep_name, f):
-        self.conf_proxy_factory(dep_name, WorkflowProxy(dep_name, f))
+        The max_rate, if set, is the maximum number of tasks of this
+        dependency started per second, like for SWF workflows. The tasks over
+        the rate wait in the timer queue until they can start.
+
+        The start_to_close, if set, is the number of seconds a task can run,
+        counted from when it gets a worker, before it times out. A timed out
+        task is retried, after the delays in retry, like on SWF. Its worker is
+        abandoned: with processes the pool is replaced and its worker
+        processes terminated, the other tasks running in it time out too and
+        are retried the same way.
+        """
+        proxy = ActivityProxy(dep_name, f,
+                              max_rate=max_rate_encode(max_rate, 'max_rate'),
+                              start_to_close=rate_encode(start_to_close,
+                                                         'start_to_close'),
+                              retry=retry)
+        self.conf_proxy_factory(dep_name, proxy)
+
+    def conf_workflow(self, dep_name, f, max_rate=None):
+        """Same as conf_activity but for sub-workflows."""
+        max_rate = max_rate_encode(max_rate, 'max_rate')
+        self.conf_proxy_factory(dep_name, WorkflowProxy(dep_name, f, max_rate))
+
+    def conf_timer(self, dep_name):
+        """Configure a dependency the workflow can sleep with.
+
+        Calling it with a number of seconds returns a result that finishes,
+        with None, after that many seconds.
+        """
+        self.conf_proxy_factory(dep_name, TimerProxy(dep_name))
 
     def __call__(self, state, input_data, tracer):
         # NB: The final trace can be computed only on the last decision
@@ -43,7 +76,7 @@ class LocalWorkflow(WorkflowConfig):
         tracer = None
         if kwargs.pop('_trace', False):
             tracer = ExecutionTracer()
-        a_executor = self.executor(max_workers=self.activity_workers)
+        a_executor = RecyclingExecutor(self.executor, self.activity_workers)
         w_executor = self.executor(max_workers=self.workflow_workers)
         input_data = Proxy.serialize_input(*args, **kwargs)
         wr = RootWorkflowRunner(self, w_executor, a_executor, input_data,
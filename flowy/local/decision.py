@@ -3,6 +3,7 @@ class Decision(dict):
         self['type'] = 'schedule'
         self['activities'] = []
         self['workflows'] = []
+        self['timers'] = []
         self.closed = False
 
     def fail(self, reason):
@@ -32,28 +33,45 @@ class Decision(dict):
         self['result'] = result
         self.closed = True
 
-    def schedule_activity(self, call_key, input_data, f):
+    def schedule_activity(self, call_key, input_data, f, delay=0,
+                          max_rate=None, start_to_close=None):
         if self.closed or 'activities' not in self:
             return
         self['activities'].append(
             {'id': call_key,
              'input_data': input_data,
-             'f': f})
+             'f': f,
+             'delay': delay,
+             'max_rate': max_rate,
+             'start_to_close': start_to_close})
 
-    def schedule_workflow(self, call_key, input_data, f):
+    def schedule_workflow(self, call_key, input_data, f, delay=0,
+                          max_rate=None):
         if self.closed or 'workflows' not in self:
             return
         self['workflows'].append(
             {'id': call_key,
              'input_data': input_data,
-             'f': f})
+             'f': f,
+             'delay': delay,
+             'max_rate': max_rate})
+
+    def schedule_timer(self, call_key, delay):
+        if self.closed or 'timers' not in self:
+            return
+        self['timers'].append(
+            {'id': call_key,
+             'delay': delay})
 
 
 class ActivityDecision(object):
-    def __init__(self, decision, identity, f):
+    def __init__(self, decision, identity, f, max_rate=None,
+                 start_to_close=None):
         self.decision = decision
         self.identity = identity
         self.f = f
+        self.max_rate = max_rate
+        self.start_to_close = start_to_close
 
     def fail(self, reason):
         self.decision.fail(reason)
@@ -61,14 +79,15 @@ class ActivityDecision(object):
     def schedule(self, call_number, retry_number, delay, input_data):
         self.decision.schedule_activity(
             '%s-%s-%s' % (self.identity, call_number, retry_number),
-            input_data, self.f)
+            input_data, self.f, delay, self.max_rate, self.start_to_close)
 
 
 class WorkflowDecision(object):
-    def __init__(self, decision, identity, f):
+    def __init__(self, decision, identity, f, max_rate=None):
         self.decision = decision
         self.identity = identity
         self.f = f
+        self.max_rate = max_rate
 
     def fail(self, reason):
         self.decision.fail(reason)
@@ -76,4 +95,4 @@ class WorkflowDecision(object):
     def schedule(self, call_number, retry_number, delay, input_data):
         self.decision.schedule_workflow(
             '%s-%s-%s' % (self.identity, call_number, retry_number),
-            input_data, self.f)
+            input_data, self.f, delay, self.max_rate)
@@ -1,31 +1,46 @@
 from flowy.local.decision import ActivityDecision
 from flowy.local.decision import WorkflowDecision
 from flowy.proxy import Proxy
+from flowy.proxy import SleepProxy
 from flowy.swf.history import SWFTaskExecutionHistory as TaskHistory
 from flowy.tracer import TracingProxy
 
 
 class ActivityProxy(object):
-    def __init__(self, identity, f):
+    def __init__(self, identity, f, max_rate=None, start_to_close=None,
+                 retry=(0, )):
         self.identity = identity
         self.f = f
+        self.max_rate = max_rate
+        self.start_to_close = start_to_close
+        self.retry = retry
 
     def __call__(self, decision, history, tracer):
         th = TaskHistory(history, self.identity)
-        ad = ActivityDecision(decision, self.identity, self.f)
+        ad = ActivityDecision(decision, self.identity, self.f, self.max_rate,
+                              self.start_to_close)
         if tracer is None:
-            return Proxy(th, ad)
-        return TracingProxy(tracer, self.identity, th, ad)
+            return Proxy(th, ad, self.retry)
+        return TracingProxy(tracer, self.identity, th, ad, self.retry)
 
 
 class WorkflowProxy(object):
-    def __init__(self, identity, f):
+    def __init__(self, identity, f, max_rate=None):
         self.identity = identity
         self.f = f
+        self.max_rate = max_rate
 
     def __call__(self, decision, history, tracer):
         th = TaskHistory(history, self.identity)
-        wd = WorkflowDecision(decision, self.identity, self.f)
+        wd = WorkflowDecision(decision, self.identity, self.f, self.max_rate)
         if tracer is None:
             return Proxy(th, wd)
         return TracingProxy(tracer, self.identity, th, wd)
+
+
+class TimerProxy(object):
+    def __init__(self, identity):
+        self.identity = identity
+
+    def __call__(self, decision, history, tracer):
+        return SleepProxy(self.identity, history, decision)
@@ -1,23 +1,227 @@
 import copy
+import heapq
+import itertools
+import time
+from collections import deque
 from functools import partial
+from threading import Condition
 from threading import Event
 from threading import RLock
+from threading import Thread
+
+try:
+    from concurrent.futures import Future
+except ImportError:
+    from futures import Future
 
 from flowy import serialization
+from flowy.history import ERROR
+from flowy.history import HistoryIndex
+from flowy.history import parse_task_key
+from flowy.history import RESULT
+from flowy.history import RUNNING
+from flowy.history import TIMEDOUT
 from flowy.result import TaskError
+from flowy.utils import logger
+
+
+class WorkerLost(Exception):
+    """The task was lost with the pool of a hung task that was replaced."""
+
+
+class TimerQueue(object):
+    """Call functions after a delay, all of them from a single thread.
+
+    The calls are kept in a heap ordered by their due time; the thread sleeps
+    until the earliest one is due or an earlier one is added. Calls due at the
+    same time are made in the order they were added.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+        self.cond = Condition()
+        self.closed = False
+        self.thread = None
+
+    def call_later(self, delay, f, *args):
+        with self.cond:
+            if self.closed:
+                return
+            heapq.heappush(self.heap,
+                           (time.time() + delay, next(self.counter), f, args))
+            if self.thread is None:
+                self.thread = Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify()
+
+    def close(self):
+        """Drop the pending calls and stop the thread."""
+        with self.cond:
+            self.closed = True
+            self.heap = []
+            self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.closed:
+                    if not self.heap:
+                        self.cond.wait()
+                        continue
+                    wait = self.heap[0][0] - time.time()
+                    if wait <= 0:
+                        break
+                    self.cond.wait(wait)
+                if self.closed:
+                    return
+                _, _, f, args = heapq.heappop(self.heap)
+            try:
+                f(*args)
+            except Exception:
+                logger.exception('Error in a delayed call:')
+
+
+class RecyclingExecutor(object):
+    """An executor that can replace its pool to get rid of hung tasks.
+
+    The tasks run in a pool made with executor_factory(max_workers). At most
+    max_workers tasks are given to the pool at a time, the others wait in a
+    queue, so every task in the pool has a worker and its start time is
+    known. When a running task is abandoned, the pool is replaced with a new
+    one. The worker processes of a process pool are terminated and its other
+    running tasks are lost with them; they are not submitted again, their
+    side effects could happen twice, it's up to the caller to fail or retry
+    them. Threads can't be stopped, so the hung one is left behind in the old
+    pool and the others finish there.
+    """
+
+    def __init__(self, executor_factory, max_workers):
+        self.executor_factory = executor_factory
+        self.max_workers = max_workers
+        self.executor = executor_factory(max_workers=max_workers)
+        self.tasks = {}  # future -> (pool future, fn, args, kwargs, start)
+        self.queue = deque()  # the (future, fn, args, kwargs) waiting
+        self.lock = RLock()
+        self.drained = Condition(self.lock)
+        self.closed = False
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('cannot schedule new futures after shutdown')
+            self.queue.append((future, fn, args, kwargs))
+            self._fill()
+        return future
+
+    def _fill(self):
+        while self.queue and len(self.tasks) < self.max_workers:
+            future, fn, args, kwargs = self.queue.popleft()
+            self._submit(future, fn, args, kwargs)
+        if not self.queue:
+            self.drained.notify_all()
+
+    def _submit(self, future, fn, args, kwargs):
+        pool_future = self.executor.submit(fn, *args, **kwargs)
+        self.tasks[future] = (pool_future, fn, args, kwargs, time.time())
+        pool_future.add_done_callback(partial(self._done, future))
+
+    def _done(self, future, pool_future):
+        with self.lock:
+            entry = self.tasks.get(future)
+            if entry is None or entry[0] is not pool_future:
+                return  # abandoned or submitted again
+            del self.tasks[future]
+            try:
+                self._fill()
+            except RuntimeError:
+                pass  # the pool was shut down without waiting
+        if pool_future.cancelled():
+            future.cancel()
+        elif pool_future.exception() is not None:
+            future.set_exception(pool_future.exception())
+        else:
+            future.set_result(pool_future.result())
+
+    def start_time(self, future):
+        """Return the time the task of the future got a worker, or None."""
+        with self.lock:
+            entry = self.tasks.get(future)
+            return entry[4] if entry is not None else None
+
+    def abandon(self, future):
+        """Forget a task, replacing the pool if the task is running.
+
+        Return the futures of the other tasks lost with the worker processes,
+        they are never resolved by the executor.
+        """
+        lost = []
+        with self.lock:
+            for waiting in self.queue:
+                if waiting[0] is future:
+                    self.queue.remove(waiting)
+                    return lost
+            entry = self.tasks.pop(future, None)
+            if entry is None or entry[0].cancel() or entry[0].done():
+                self._fill()
+                return lost
+            old = self.executor
+            # The pool forgets its processes on shutdown, get them first
+            processes = getattr(old, '_processes', None)
+            if isinstance(processes, dict):
+                processes = list(processes.values())
+            elif processes is not None:
+                processes = list(processes)
+            self.executor = self.executor_factory(max_workers=self.max_workers)
+            old.shutdown(wait=False)
+            if processes is not None:
+                for p in processes:
+                    p.terminate()
+                lost = list(self.tasks)
+                self.tasks.clear()
+            self._fill()
+        return lost
+
+    def shutdown(self, wait=True):
+        """Shut the pool down, waiting for the queued tasks if wait is set.
+
+        Otherwise the queued tasks are canceled.
+        """
+        with self.lock:
+            self.closed = True
+            if wait:
+                while self.queue:
+                    self.drained.wait()
+            else:
+                for future, _, _, _ in self.queue:
+                    future.cancel()
+                self.queue.clear()
+            executor = self.executor
+        executor.shutdown(wait=wait)
 
 
 class WorkflowRunner(object):
     def __init__(self, workflow, workflow_executor, activity_executor,
                  input_data,
                  state=None,
-                 tracer=None):
+                 tracer=None,
+                 timers=None):
+        """Initialize the runner.
+
+        The timers is a TimerQueue shared by all the runners of a workflow,
+        it starts the delayed and the rate limited tasks and fires the timers
+        of the sleep dependencies.
+        """
         self.workflow = workflow
         self.workflow_executor = workflow_executor
         self.activity_executor = activity_executor
         self.input_data = input_data
         self.state = state if state is not None else State()
         self.tracer = tracer
+        self.timers = timers if timers is not None else TimerQueue()
+        self.starts = {}  # identity -> the recent start times, for max_rate
         self.lock = RLock()
         self.will_restart = True
         self.history_updated = False
@@ -27,8 +231,9 @@ class WorkflowRunner(object):
         if self.tracer is None:
             return
         name, call_n, retry_n = a['id'].split('-')
+        if int(retry_n) > 0:
+            return  # A retry of an already traced activity
         node_id = '%s-%s' % (name, call_n)
-        assert int(retry_n) == 0
         self.tracer.schedule_activity(node_id, name)
 
     def trace_workflow(self, w):
@@ -51,6 +256,13 @@ class WorkflowRunner(object):
         node_id = '%s-%s' % (name, call_n)
         self.tracer.result(node_id, result)
 
+    def trace_timeout(self, task_id):
+        if self.tracer is None:
+            return
+        name, call_n, _ = task_id.split('-')
+        node_id = '%s-%s' % (name, call_n)
+        self.tracer.timeout(node_id)
+
     def trace_error(self, task_id, reason):
         if self.tracer is None:
             return
@@ -98,21 +310,102 @@ class WorkflowRunner(object):
             self.trace_workflow(w)
         self.trace_flush()
         for a in result.get('activities', []):
-            try:
-                args, kwargs = serialization.loads(a['input_data'])
-                f = self.activity_executor.submit(a['f'], *args, **kwargs)
-                f.add_done_callback(partial(
-                    self.complete_activity_and_reschedule_decision, a['id']))
-            except RuntimeError:
-                pass  # The executor must be closed
+            self.start_task(a, self.start_activity)
         for w in result.get('workflows', []):
-            r = ChildWorkflowRunner(w['f'], self.workflow_executor,
-                                    self.activity_executor, w['input_data'],
-                                    parent=self,
-                                    wid=w['id'])
-            r.reschedule_decision()
+            self.start_task(w, self.start_workflow)
+        for t in result.get('timers', []):
+            self.state.set_timer_running(t['id'])
+            self.timers.call_later(t['delay'],
+                                   self.fire_timer_and_reschedule_decision,
+                                   t['id'])
         self.reschedule_if_history_updated()
 
+    def start_task(self, task, start):
+        """Start a task, after its delay and when its max_rate allows it.
+
+        The task is already running for the workflow, the ones that must wait
+        are started later from the timer queue.
+        """
+        with self.lock:
+            if self.restarted:
+                return
+            delay = task.get('delay', 0)
+            if delay > 0:
+                task = dict(task, delay=0)
+            else:
+                delay = self.rate_wait(task)
+            if delay > 0:
+                self.timers.call_later(delay, self.start_task, task, start)
+            else:
+                start(task)
+
+    def rate_wait(self, task):
+        """Return the seconds until the task can start or 0 to start it now.
+
+        At most max_rate tasks of a dependency can start in any window of one
+        second or, for rates below one task per second, one task in any window
+        of 1 / max_rate seconds.
+        """
+        max_rate = task.get('max_rate')
+        if max_rate is None:
+            return 0
+        window = max(1.0, 1.0 / max_rate)
+        allowed = max(int(max_rate * window), 1)
+        identity = parse_task_key(task['id'])[0]
+        starts = self.starts.setdefault(identity, deque())
+        now = time.time()
+        while starts and starts[0] <= now - window:
+            starts.popleft()
+        if len(starts) < allowed:
+            starts.append(now)
+            return 0
+        return starts[0] + window - now
+
+    def start_activity(self, a):
+        try:
+            args, kwargs = serialization.loads(a['input_data'])
+            f = self.activity_executor.submit(a['f'], *args, **kwargs)
+            f.add_done_callback(partial(
+                self.complete_activity_and_reschedule_decision, a['id']))
+        except RuntimeError:
+            return  # The executor must be closed
+        if a.get('start_to_close') is not None:
+            self.timers.call_later(a['start_to_close'],
+                                   self.timeout_and_reschedule_decision,
+                                   a['id'], f, a['start_to_close'])
+
+    def timeout_and_reschedule_decision(self, task_id, future,
+                                        start_to_close):
+        with self.lock:
+            if future.done() or not self.state.is_running(task_id):
+                return
+            start = self.activity_executor.start_time(future)
+            if start is None:
+                left = start_to_close  # the time starts when it gets a worker
+            else:
+                left = start + start_to_close - time.time()
+            if left > 0:
+                self.timers.call_later(left,
+                                       self.timeout_and_reschedule_decision,
+                                       task_id, future, start_to_close)
+                return
+            for other in self.activity_executor.abandon(future):
+                # Their callbacks can take the locks of other runners, fail
+                # them from the timers thread, without holding this one
+                self.timers.call_later(0, other.set_exception, WorkerLost(
+                    'The worker was terminated with a timed out task.'))
+            self.state.set_timeout(task_id)
+            self.trace_timeout(task_id)
+            self.update_history_or_reschedule()
+
+    def start_workflow(self, w):
+        r = ChildWorkflowRunner(w['f'], self.workflow_executor,
+                                self.activity_executor, w['input_data'],
+                                parent=self,
+                                wid=w['id'],
+                                timers=self.timers)
+        r.reschedule_decision()
+
     def handle_restart(self, _):
         self.restarted = True
         if self.tracer is not None:
@@ -120,8 +413,15 @@ class WorkflowRunner(object):
 
     def complete_activity_and_reschedule_decision(self, task_id, result):
         with self.lock:
+            if not self.state.is_running(task_id):
+                return  # It timed out
             try:
                 r = result.result()
+            except WorkerLost:
+                # Like a worker dying on SWF, the task times out and the
+                # retry logic of the workflow decides what happens next
+                self.state.set_timeout(task_id)
+                self.trace_timeout(task_id)
             except Exception as e:
                 self.state.set_error(task_id, str(e))
                 self.trace_error(task_id, e)
@@ -130,6 +430,11 @@ class WorkflowRunner(object):
                 self.trace_result(task_id, r)
             self.update_history_or_reschedule()
 
+    def fire_timer_and_reschedule_decision(self, call_key):
+        with self.lock:
+            self.state.set_timer_fired(call_key)
+            self.update_history_or_reschedule()
+
     def fail_subwf_and_reschedule_decision(self, task_id, reason):
         with self.lock:
             self.state.set_error(task_id, str(reason))
@@ -162,16 +467,19 @@ class RootWorkflowRunner(WorkflowRunner):
     def __init__(self, workflow, workflow_executor, activity_executor,
                  input_data,
                  state=None,
-                 tracer=None):
+                 tracer=None,
+                 timers=None):
         super(RootWorkflowRunner, self).__init__(workflow, workflow_executor,
                                                  activity_executor, input_data,
                                                  state=state,
-                                                 tracer=tracer)
+                                                 tracer=tracer,
+                                                 timers=timers)
         self.stop = Event()
 
     def run(self, wait=False):
         self.reschedule_decision()
         self.stop.wait()
+        self.timers.close()
         self.activity_executor.shutdown(wait=wait)
         self.workflow_executor.shutdown(wait=wait)
         if hasattr(self, 'final_value'):
@@ -198,18 +506,21 @@ class RootWorkflowRunner(WorkflowRunner):
         super(RootWorkflowRunner, self).handle_restart(result)
         RestartedRootRunner(self.workflow, self.workflow_executor,
                             self.activity_executor, result['input_data'], self,
-                            tracer=self.tracer).reschedule_decision()
+                            tracer=self.tracer,
+                            timers=self.timers).reschedule_decision()
 
 
 class RestartedRootRunner(WorkflowRunner):
     def __init__(self, workflow, workflow_executor, activity_executor,
                  input_data, root,
                  state=None,
-                 tracer=None):
+                 tracer=None,
+                 timers=None):
         super(RestartedRootRunner, self).__init__(
             workflow, workflow_executor, activity_executor, input_data,
             state=state,
-            tracer=tracer)
+            tracer=tracer,
+            timers=timers)
         self.root = root
 
     def handle_fail(self, result):
@@ -226,7 +537,8 @@ class RestartedRootRunner(WorkflowRunner):
         r = RestartedRootRunner(self.workflow, self.workflow_executor,
                                 self.activity_executor, result['input_data'],
                                 self.root,
-                                tracer=self.tracer)
+                                tracer=self.tracer,
+                                timers=self.timers)
         r.reschedule_decision()
 
 
@@ -234,11 +546,13 @@ class ChildWorkflowRunner(WorkflowRunner):
     def __init__(self, workflow, workflow_executor, activity_executor,
                  input_data, parent, wid,
                  state=None,
-                 tracer=None):
+                 tracer=None,
+                 timers=None):
         super(ChildWorkflowRunner, self).__init__(
             workflow, workflow_executor, activity_executor, input_data,
             state=state,
-            tracer=tracer)
+            tracer=tracer,
+            timers=timers)
         self.parent = parent
         self.wid = wid
 
@@ -258,16 +572,21 @@ class ChildWorkflowRunner(WorkflowRunner):
         r = ChildWorkflowRunner(self.workflow, self.workflow_executor,
                                 self.activity_executor, result['input_data'],
                                 self.parent, self.wid,
-                                tracer=self.tracer)
+                                tracer=self.tracer,
+                                timers=self.timers)
         r.reschedule_decision()
 
 
 class State(object):
     def __init__(self):
         self.running = set()
+        self.timedout = set()
         self.results = {}
         self.errors = {}
         self.finish_order = []
+        self.index = HistoryIndex()
+        self.timers_running = set()
+        self.timers = {}
 
     def copy(self):
         s = State()
@@ -276,22 +595,45 @@ class State(object):
 
     def set_running(self, call_key):
         self.running.add(call_key)
+        self.index.set(call_key, RUNNING)
 
     def set_result(self, call_key, result):
         self.running.remove(call_key)
         self.results[call_key] = result
+        self.index.set(call_key, RESULT, len(self.finish_order), result)
         self.finish_order.append(call_key)
 
     def set_error(self, call_key, reason):
         self.running.remove(call_key)
         self.errors[call_key] = reason
+        self.index.set(call_key, ERROR, len(self.finish_order), reason)
+        self.finish_order.append(call_key)
+
+    def set_timeout(self, call_key):
+        self.running.remove(call_key)
+        self.timedout.add(call_key)
+        self.index.set(call_key, TIMEDOUT, len(self.finish_order))
         self.finish_order.append(call_key)
 
+    def set_timer_running(self, call_key):
+        self.timers_running.add(call_key)
+
+    def set_timer_fired(self, call_key):
+        self.timers_running.remove(call_key)
+        self.timers[call_key] = len(self.finish_order)
+        self.finish_order.append(call_key)
+
+    def retries(self, identity, call_number):
+        return self.index.retries(identity, call_number)
+
     def is_running(self, call_key):
         return call_key in self.running
 
     def order(self, call_key):
-        return self.finish_order.index(call_key)
+        entry = self.index.get(call_key)
+        if entry is None or entry[1] is None:
+            raise ValueError('Task is not finished: %r' % (call_key, ))
+        return entry[1]
 
     def has_result(self, call_key):
         return call_key in self.results
@@ -306,7 +648,16 @@ class State(object):
         return self.errors[call_key]
 
     def is_timeout(self, call_key):
-        return False
+        return call_key in self.timedout
+
+    def is_timer_ready(self, call_key):
+        return call_key in self.timers
+
+    def is_timer_running(self, call_key):
+        return call_key in self.timers_running
+
+    def timer_order(self, call_key):
+        return self.timers[call_key]
 
     def __repr__(self):
         if len(self.finish_order) > 6:
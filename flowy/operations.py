@@ -1,13 +1,20 @@
+import functools
 import heapq
 import itertools
 
+from flowy.result import copy_result_proxy
+from flowy.result import error
 from flowy.result import is_result_proxy
+from flowy.result import placeholder
 from flowy.result import result
+from flowy.result import SuspendTask
+from flowy.result import TaskError
 from flowy.utils import i_or_args
+from flowy.utils import logger
 from flowy.utils import sentinel
 
 
-__all__ = ['first', 'finish_order', 'parallel_reduce']
+__all__ = ['first', 'finish_order', 'parallel_reduce', 'parallel_map', 'batch']
 
 
 def _order_key(i):
@@ -19,6 +26,10 @@ def first(result, *results):
 
     If no one is finished yet - all of the results are placeholders - return
     the first placeholder from the list.
+
+    Once a result is finished, the tasks of the other results that are still
+    running can no longer affect the outcome and, if the workflow is
+    configured to, their cancellation is requested.
     """
     rs = []
     for r in i_or_args(result, results):
@@ -26,7 +37,13 @@ def first(result, *results):
             rs.append(r)
         else:
             return r
-    return min(rs, key=_order_key)
+    winner = min(rs, key=_order_key)
+    if winner.__factory__.order is not None:
+        for r in rs:
+            cancel = r.__factory__.cancel
+            if cancel is not None:
+                cancel()
+    return winner
 
 
 def finish_order(result, *results):
@@ -45,7 +62,7 @@ def finish_order(result, *results):
         yield r
 
 
-def parallel_reduce(f, iterable, initializer=sentinel):
+def parallel_reduce(f, iterable, initializer=sentinel, arity=2):
     """Like reduce() but optimized to maximize parallel execution.
 
     The reduce function must be associative and commutative.
@@ -72,7 +89,14 @@ def parallel_reduce(f, iterable, initializer=sentinel):
     reduction as soon as any two results are available. The number of reduce
     operations is always constant and equal to len(iterable) - 1 regardless of
     how the reduction graph looks like.
+
+    With arity=k, f is called with up to k values at once instead of two,
+    the first k results to finish. This cuts the number of reduce operations
+    to about (len(iterable) - 1) / (k - 1), a good fit for reductions like
+    sums or merges where combining more values in a task costs little.
     """
+    if arity < 2:
+        raise ValueError('The arity must be at least 2.')
     if initializer is not sentinel:
         iterable = itertools.chain([initializer], iterable)
     results, non_results = [], []
@@ -81,40 +105,115 @@ def parallel_reduce(f, iterable, initializer=sentinel):
             results.append(x)
         else:
             non_results.append(x)
-    i = iter(non_results)
-    reminder = sentinel
-    for x in i:
-        try:
-            y = next(i)
-            results.append(f(x, y))
-        except StopIteration:
-            reminder = x
-            if not results:  # len(iterable) == 1
-                # Wrap the value in a result for uniform interface
-                return result(x, -1)
-    if not results:  # len(iterable) == 0
-        raise ValueError(
-            'parallel_reduce() of empty sequence with no initial value')
-    if is_result_proxy(results[0]):
-        results = [(r.__factory__, r) for r in results]
-        heapq.heapify(results)
-        return _parallel_reduce_recurse(f, results, reminder)
-    else:
-        # Looks like we don't use a task for reduction, fallback on reduce
-        return reduce(f, results)
-
-
-def _parallel_reduce_recurse(f, results, reminder=sentinel):
-    if reminder is not sentinel:
-        _, first = heapq.heappop(results)
-        new_result = f(reminder, first)
-        heapq.heappush(results, (new_result.__factory__, new_result))
-        return _parallel_reduce_recurse(f, results)
-    _, x = heapq.heappop(results)
+    # The values that are not results can be reduced right away
+    reminder = len(non_results) % arity
+    for i in range(0, len(non_results) - reminder, arity):
+        results.append(f(*non_results[i:i + arity]))
+    reminder = non_results[len(non_results) - reminder:]
+    if not results:
+        if not reminder:  # len(iterable) == 0
+            raise ValueError(
+                'parallel_reduce() of empty sequence with no initial value')
+        if len(reminder) == 1:  # len(iterable) == 1
+            # Wrap the value in a result for uniform interface
+            return result(reminder[0], -1)
+    # A heap of (finish order, sequence number, value). The sequence number
+    # breaks the ties between unfinished results, the values are never
+    # compared. The values that are not results (if f doesn't return results)
+    # are available right away, like the reminder.
+    counter = itertools.count()
+    heap = [(_finish_key(r), next(counter), r) for r in results]
+    heap.extend((-1, next(counter), x) for x in reminder)
+    heapq.heapify(heap)
+    while len(heap) > 1:
+        values = [heapq.heappop(heap)[2]
+                  for _ in range(min(arity, len(heap)))]
+        new_result = f(*values)
+        heapq.heappush(heap, (_finish_key(new_result), next(counter),
+                              new_result))
+    return heap[0][2]
+
+
+_UNFINISHED = float('inf')
+
+
+def _finish_key(value):
+    if not is_result_proxy(value):
+        return -1
+    order = value.__factory__.order
+    if order is None:
+        return _UNFINISHED
+    return order
+
+
+def parallel_map(proxy, iterable, chunk_size=100):
+    """Map the items over a batch task, chunk_size items per task.
+
+    The proxy is called once per chunk, with the list of items, and must be
+    bound to a batch task, like the ones made with batch(). This returns a
+    result for each item that can be used like any other result, with first,
+    finish_order or parallel_reduce. The items of a chunk finish at the same
+    time.
+
+    The items that failed are errors on their own and a failed or timed out
+    task is an error for all the items in its chunk. Errors and placeholders
+    among the items are propagated to their whole chunk, as for any task.
+    """
+    if chunk_size < 1:
+        raise ValueError('The chunk size must be at least 1.')
+    items = list(iterable)
+    results = []
+    for i in range(0, len(items), chunk_size):
+        chunk = items[i:i + chunk_size]
+        results.extend(_split_batch(proxy(chunk), len(chunk)))
+    return results
+
+
+def _split_batch(batch_result, size):
+    if not is_result_proxy(batch_result):  # not a task, called directly
+        batch_result = result(batch_result, -1)
     try:
-        _, y = heapq.heappop(results)
-    except IndexError:
-        return x
-    new_result = f(x, y)
-    heapq.heappush(results, (new_result.__factory__, new_result))
-    return _parallel_reduce_recurse(f, results)
+        outcomes = batch_result.__wrapped__
+    except SuspendTask:
+        return [placeholder() for _ in range(size)]
+    except TaskError:
+        return [copy_result_proxy(batch_result) for _ in range(size)]
+    order = batch_result.__factory__.order
+    if not isinstance(outcomes, list) or len(outcomes) != size:
+        return [error('Invalid batch result: %r' % (outcomes,), order)
+                for _ in range(size)]
+    results = []
+    for outcome in outcomes:
+        if not isinstance(outcome, list) or len(outcome) != 2:
+            results.append(error('Invalid batch item: %r' % (outcome,), order))
+        elif outcome[0] == _ITEM_ERROR:
+            results.append(error(outcome[1], order))
+        else:
+            results.append(result(outcome[1], order))
+    return results
+
+
+_ITEM_RESULT, _ITEM_ERROR = 0, 1
+
+
+def batch(func):
+    """Make a batch task, for parallel_map, out of a single item function.
+
+    The batch task is called with a list of items and calls func for each one
+    of them. Any extra arguments before the list, like the SWF heartbeat, are
+    passed to func too. The exceptions raised by func fail only its item.
+    """
+    # A partial instead of a closure, so it can be pickled
+    return functools.partial(_run_batch, func)
+
+
+def _run_batch(func, *args):
+    extra_args, items = args[:-1], args[-1]
+    outcomes = []
+    for item in items:
+        try:
+            outcomes.append([_ITEM_RESULT, func(*(extra_args + (item,)))])
+        except Exception as e:
+            logger.exception('Error while processing a batch item:')
+            outcomes.append([_ITEM_ERROR, str(e)])
+    return outcomes
@@ -1,20 +1,33 @@
+import functools
 import json
 
+from flowy.history import ERROR
+from flowy.history import RESULT
+from flowy.history import RUNNING
+from flowy.history import TIMEDOUT
 from flowy.operations import first
 from flowy.result import copy_result_proxy
 from flowy.result import error
 from flowy.result import placeholder
+from flowy.result import raw_result
 from flowy.result import result
 from flowy.result import SuspendTask
 from flowy.result import timeout
 from flowy.result import wait
+from flowy.serialization import check_err_and_placeholders
 from flowy.serialization import dumps
+from flowy.serialization import dumps_binary
+from flowy.serialization import is_raw_aware
 from flowy.serialization import loads
+from flowy.serialization import raw_aware
 from flowy.serialization import traverse_data
 from flowy.utils import logger
 
 
-__all__ = ['Proxy']
+__all__ = ['Proxy', 'SleepProxy', 'serialize_input_binary']
+
+
+_NOT_SCHEDULED = (None, None, None)
 
 
 class Proxy(object):
@@ -26,17 +39,37 @@ class Proxy(object):
     """
 
     def __init__(self, task_exec_history, task_decision, retry=(0, ),
-                 serialize_input=None, deserialize_result=None):
+                 serialize_input=None, deserialize_result=None,
+                 result_cache=None, hedge=None, cancel_abandoned=False):
         """Init the proxy object.
 
         The task execution history contains the execution history and is
         used to decide what new tasks should be scheduled.
         The scheduling of new tasks or execution or the execution failure is
         delegated to the task decision object.
+
+        With the default serializers, or those of a Serializer, results are
+        decoded only when accessed and results that are only passed along to
+        other tasks are forwarded in their serialized form. The result_cache,
+        if set, is a DecodeCache used to decode the results.
+
+        If hedge is set, a task still running after hedge seconds gets a
+        duplicate and the first of the two to finish is used. The task
+        execution history must implement hedges, returning the entries of the
+        duplicates like retries does, and the task decision must accept the
+        hedge flag on schedule and cancel. The other one is canceled if it's
+        still running.
+
+        If cancel_abandoned is set, the placeholders of running tasks can
+        request their cancellation, as first() does for the ones that lose.
+        The task decision must implement cancel.
         """
         self.task_exec_history = task_exec_history
         self.task_decision = task_decision
         self.retry = retry
+        self.result_cache = result_cache
+        self.hedge = hedge
+        self.cancel_abandoned = cancel_abandoned
         self.call_number = 0
         if serialize_input is not None:
             self.serialize_input = serialize_input
@@ -69,32 +102,53 @@ class Proxy(object):
               are unresolved dependencies.
             * Finally, if all the arguments look OK, schedule it for execution.
         """
-        task_exec_history = self.task_exec_history
+        return self._call(args, kwargs)
+
+    def _call(self, args, kwargs, traversed=None):
+        """The implementation of __call__.
+
+        The traversed arguments, with the error and placeholders found in
+        them, can be passed in by subclasses that already walked them.
+        """
         call_number = self.call_number
         self.call_number += 1
-        r = placeholder()
+        # A single lookup for all the retries: retry_number -> entry
+        retries = self.task_exec_history.retries(call_number)
+        hedges = None
+        if self.hedge is not None:
+            hedges = self.task_exec_history.hedges(call_number)
+        r = None  # a placeholder, made only if no other result is found
         for retry_number, delay in enumerate(self.retry):
-            if task_exec_history.is_timeout(call_number, retry_number):
+            state, order, value = retries.get(retry_number, _NOT_SCHEDULED)
+            duplicate = False
+            if hedges is not None:
+                (state, order, value), duplicate = self._hedge_state(
+                    call_number, retry_number, retries, hedges)
+            if state == TIMEDOUT:
                 continue
-            if task_exec_history.is_running(call_number, retry_number):
-                break  # result = Placehloder
-            if task_exec_history.has_result(call_number, retry_number):
-                value = task_exec_history.result(call_number, retry_number)
-                order = task_exec_history.order(call_number, retry_number)
+            if state == RUNNING:
+                if self.cancel_abandoned:
+                    r = placeholder(functools.partial(
+                        self._cancel_running, call_number, retries, hedges))
+                if not duplicate:
+                    break  # result = Placehloder
+                delay = self.hedge  # schedule the duplicate, after a timer
+            elif state == RESULT:
+                if is_raw_aware(self.deserialize_result):
+                    r = raw_result(value, self._decode_result, order)
+                    break
                 try:
-                    value = self.deserialize_result(value)
-                except Exception as e:
-                    logger.exception('Error while deserializing the activity result:')
-                    self.task_decision.fail(e)
+                    value = self._decode_result(value)
+                except SuspendTask:
                     break  # result = Placeholder
                 r = result(value, order)
                 break
-            if task_exec_history.is_error(call_number, retry_number):
-                err = task_exec_history.error(call_number, retry_number)
-                order = task_exec_history.order(call_number, retry_number)
-                r = error(err, order)
+            elif state == ERROR:
+                r = error(value, order)
                 break
-            traversed_args, (err, placeholders) = traverse_data([args, kwargs])
+            if traversed is None:
+                traversed = self._traverse_input(args, kwargs)
+            traversed_args, (err, placeholders) = traversed
             if err:
                 r = copy_result_proxy(err)
                 break
@@ -107,18 +161,113 @@ class Proxy(object):
                 logger.exception('Error while serializing the task input:')
                 self.task_decision.fail(e)
                 break  # result = Placeholder
-            self.task_decision.schedule(call_number, retry_number, delay, input_data)
+            if duplicate:
+                self.task_decision.schedule(call_number, retry_number, delay,
+                                            input_data, hedge=True)
+                break  # result = Placeholder
+            scheduled = self.task_decision.schedule(
+                call_number, retry_number, delay, input_data)
+            if scheduled and hedges is not None:
+                # Start the hedge timer of the duplicate right away
+                self.task_decision.schedule(call_number, retry_number,
+                                            self.hedge, input_data, hedge=True)
             break  # result = Placeholder
         else:
             # No retries left, it must be a timeout
-            order = task_exec_history.order(call_number, retry_number)
             r = timeout(order)
+        if r is None:
+            r = placeholder()
         return r
 
+    def _cancel_running(self, call_number, retries, hedges):
+        for retry_number, (state, _, _) in sorted(retries.items()):
+            if state == RUNNING:
+                self.task_decision.cancel(call_number, retry_number)
+        for retry_number, (state, _, _) in sorted((hedges or {}).items()):
+            if state == RUNNING:
+                self.task_decision.cancel(call_number, retry_number,
+                                          hedge=True)
+
+    def _hedge_state(self, call_number, retry_number, retries, hedges):
+        """Merge the entries of an attempt and of its duplicate.
+
+        Returns the entry standing for both and whether the duplicate must be
+        scheduled. The first of the two to finish is used and the other one,
+        if still running, is canceled. An attempt that timed out while its
+        duplicate is running is replaced by the duplicate.
+        """
+        entry = retries.get(retry_number, _NOT_SCHEDULED)
+        hedge_entry = hedges.get(retry_number, _NOT_SCHEDULED)
+        finished = entry[0] == RESULT or entry[0] == ERROR
+        hedge_finished = hedge_entry[0] == RESULT or hedge_entry[0] == ERROR
+        if hedge_finished and (not finished or hedge_entry[1] < entry[1]):
+            if entry[0] == RUNNING:
+                self.task_decision.cancel(call_number, retry_number)
+            return hedge_entry, False
+        if finished:
+            if hedge_entry[0] == RUNNING:
+                self.task_decision.cancel(call_number, retry_number,
+                                          hedge=True)
+            return entry, False
+        if entry[0] == RUNNING:
+            return entry, hedge_entry[0] is None
+        if entry[0] == TIMEDOUT and hedge_entry[0] == RUNNING:
+            return hedge_entry, False
+        return entry, False
+
+    def _traverse_input(self, args, kwargs, f=check_err_and_placeholders,
+                        initial=(None, False)):
+        forward_raw = is_raw_aware(self.serialize_input)
+        return traverse_data([args, kwargs], f, initial,
+                             forward_raw=forward_raw)
+
+    def _decode_result(self, value):
+        """Deserialize a result or fail the decision and suspend."""
+        try:
+            if self.result_cache is not None:
+                return self.result_cache.decode(self.deserialize_result, value)
+            return self.deserialize_result(value)
+        except Exception as e:
+            logger.exception('Error while deserializing the activity result:')
+            self.task_decision.fail(e)
+            raise SuspendTask
+
     @staticmethod
+    @raw_aware
     def serialize_input(*args, **kwargs):
         return dumps([args, kwargs])
 
     @staticmethod
+    @raw_aware
     def deserialize_result(result):
         return loads(result)
+
+
+class SleepProxy(object):
+    """A dependency the workflows can sleep with, backed by timers.
+
+    Calling it with a number of seconds starts a timer and returns a result
+    that finishes, with None, when the timer fires. Like any other result, it
+    can be waited for or raced with first().
+    """
+
+    def __init__(self, identity, execution_history, decision):
+        self.identity = identity
+        self.execution_history = execution_history
+        self.decision = decision
+        self.call_number = 0
+
+    def __call__(self, seconds):
+        call_key = '%s-%s-0' % (self.identity, self.call_number)
+        self.call_number += 1
+        if self.execution_history.is_timer_ready(call_key):
+            return result(None, self.execution_history.timer_order(call_key))
+        if not self.execution_history.is_timer_running(call_key):
+            self.decision.schedule_timer(call_key, seconds)
+        return placeholder()
+
+
+@raw_aware
+def serialize_input_binary(*args, **kwargs):
+    """Serialize the task input with the binary encoding."""
+    return dumps_binary([list(args), kwargs])
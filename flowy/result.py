@@ -1,14 +1,21 @@
 from lazy_object_proxy.slots import Proxy
 import collections
+import contextlib
+import threading
 
 from flowy.utils import logger
 from flowy.utils import sentinel
 from flowy.utils import i_or_args
 
 
-__all__ = ['result', 'error', 'timeout', 'placeholder', 'copy_result_proxy',
-           'wait', 'is_result_proxy', 'SuspendTask', 'TaskError',
-           'TaskTimedout', 'restart_type', 'restart']
+__all__ = ['result', 'raw_result', 'error', 'timeout', 'placeholder',
+           'copy_result_proxy', 'wait', 'is_result_proxy', 'SuspendTask',
+           'TaskError', 'TaskTimedout', 'restart_type', 'restart',
+           'log_ignored_errors']
+
+
+# The error results made by the decision running on this thread, if any
+_decision_errors = threading.local()
 
 
 def result(value, order):
@@ -16,25 +23,65 @@ def result(value, order):
     return ResultProxy(TaskResult(value, order))
 
 
+def raw_result(raw, decode, order):
+    """A result proxy for a task that has finished successfuly.
+
+    The result is kept in its serialized form and decoded only when it's
+    accessed. Until then, the serializers can forward the raw form as is.
+    """
+    return ResultProxy(TaskResult(order=order, raw=raw, decode=decode))
+
+
 def error(reason, order):
     """A result proxy for a task that failed."""
-    return ResultProxy(TaskResult(TaskError(reason), order))
+    return ResultProxy(_track(TaskResult(TaskError(reason), order)))
 
 
 def timeout(order):
     """A result proxy for a task that timed out."""
-    return ResultProxy(TaskResult(TaskTimedout('A task has timedout'), order))
+    return ResultProxy(_track(
+        TaskResult(TaskTimedout('A task has timedout'), order)))
 
 
-def placeholder():
-    """A result proxy for a task that is either not scheduled or running."""
-    return ResultProxy(TaskResult())
+def placeholder(cancel=None):
+    """A result proxy for a task that is either not scheduled or running.
+
+    The cancel function, if set, requests the cancellation of the task.
+    """
+    return ResultProxy(TaskResult(cancel=cancel))
 
 
 def copy_result_proxy(rp):
     assert is_result_proxy(rp)
     factory = rp.__factory__
-    return ResultProxy(TaskResult(factory.value, factory.order))
+    return ResultProxy(_track(TaskResult(factory.value, factory.order,
+                                         factory.raw, factory.decode)))
+
+
+def _track(task_result):
+    """Remember an error result, to log it if it's never accessed."""
+    errors = getattr(_decision_errors, 'errors', None)
+    if errors is not None and isinstance(task_result.value, Exception):
+        errors.append(task_result)
+    return task_result
+
+
+@contextlib.contextmanager
+def log_ignored_errors():
+    """Log the error results of a decision that were never accessed.
+
+    The error results made inside the block are checked once, when it exits.
+    """
+    previous = getattr(_decision_errors, 'errors', None)
+    errors = _decision_errors.errors = []
+    try:
+        yield
+    finally:
+        _decision_errors.errors = previous
+        for task_result in errors:
+            if not task_result.called:
+                logger.warning("Result with error was ignored: %s",
+                               task_result.value)
 
 
 def wait(result):
@@ -66,10 +113,19 @@ def is_result_proxy(obj):
 
 
 class TaskResult(object):
-    def __init__(self, value=sentinel, order=None):
+    # Many of these are made on each decision, keep them small
+    __slots__ = ('value', 'order', 'raw', 'decode', 'cancel', 'called',
+                 'node_id')
+
+    def __init__(self, value=sentinel, order=None, raw=None, decode=None,
+                 cancel=None):
         self.value = value
         self.order = order
+        self.raw = raw
+        self.decode = decode
+        self.cancel = cancel
         self.called = False
+        self.node_id = None
 
     def __lt__(self, other):
         if not isinstance(other, TaskResult):
@@ -81,6 +137,9 @@ class TaskResult(object):
         return self.order < other.order
 
     def __call__(self):
+        if self.decode is not None:
+            self.value = self.decode(self.raw)
+            self.decode = None
         self.called = True
         if self.is_placeholder():
             raise SuspendTask
@@ -92,11 +151,11 @@ class TaskResult(object):
         return isinstance(self.value, Exception)
 
     def is_placeholder(self):
-        return self.value is sentinel
+        return self.value is sentinel and self.decode is None
 
-    def __del__(self):
-        if not self.called and isinstance(self.value, Exception):
-            logger.warning("Result with error was ignored: %s", self.value)
+    def is_forwardable(self):
+        """True if the raw result wasn't decoded and can be forwarded as is."""
+        return self.raw is not None and self.decode is not None
 
 
 class SuspendTask(BaseException):
@@ -12,21 +12,44 @@ if sys.version_info < (3,):
 else:
     uni = str
 
-import collections
+import datetime
+import decimal
+import functools
 import json
+import os
+import re
 import uuid
+import zlib
 from base64 import b64decode
 from base64 import b64encode
+from binascii import hexlify
+from itertools import islice
+try:
+    from collections.abc import Iterable, Mapping, Sized
+except ImportError:  # python 2
+    from collections import Iterable, Mapping, Sized
 
-from flowy.result import is_result_proxy, TaskError, SuspendTask, wait
+from flowy import binary
+from flowy.binary import RawPayload
+from flowy.blobs import blob_key
+from flowy.result import is_result_proxy, ResultProxy, TaskError, SuspendTask
+from flowy.result import wait
 from flowy.operations import first
+from flowy.utils import LRUCache
+from flowy.utils import sentinel
 
 
-__all__ = ['traverse_data', 'dumps', 'loads']
+__all__ = ['traverse_data', 'dumps', 'dumps_binary', 'loads', 'loads_many',
+           'DecodeCache', 'RawPayload', 'Serializer', 'raw_aware']
+
+
+_BLOB_REF_PREFIX = '{" r": '
 
 
 def check_err_and_placeholders(result, value):
     err, placeholders = result
+    if _is_forwarded(value):
+        return result
     try:
         wait(value)
     except TaskError:
@@ -43,94 +66,798 @@ def collect_err_and_results(result, value):
     err, results = result
     if not is_result_proxy(value):
         return result
-    try:
-        wait(value)
-    except TaskError:
-        if err is None:
-            err = value
-        else:
-            err = first(err, value)
-    except SuspendTask:
-        pass
-    else:
-        if results is None:
-            results = []
-        results.append(value)
+    if not _is_forwarded(value):
+        try:
+            wait(value)
+        except TaskError:
+            if err is None:
+                err = value
+            else:
+                err = first(err, value)
+            return err, results
+        except SuspendTask:
+            return err, results
+    if results is None:
+        results = []
+    results.append(value)
     return err, results
 
 
-def traverse_data(value, f=check_err_and_placeholders, initial=(None, False), seen=frozenset(), make_list=True):
-    if is_result_proxy(value):
+def collect_dependencies(result, value):
+    """Like check_err_and_placeholders but also collect the finished results.
+
+    This is used when the task dependencies are traced, so that the task
+    arguments are walked only once.
+    """
+    err, placeholders, results = result
+    if not is_result_proxy(value):
+        return result
+    if not _is_forwarded(value):
         try:
             wait(value)
         except TaskError:
-            return value, f(initial, value)
+            if err is None:
+                err = value
+            else:
+                err = first(err, value)
+            return err, placeholders, results
         except SuspendTask:
-            return value, f(initial, value)
+            return err, True, results
+    if results is None:
+        results = []
+    results.append(value)
+    return err, placeholders, results
 
-        return value.__wrapped__, f(initial, value)
 
-    if isinstance(value, (bytes, uni)):
-        return value, f(initial, value)
+def _is_forwarded(value):
+    # A result not decoded yet is a success, don't force its decoding
+    return is_result_proxy(value) and value.__factory__.is_forwardable()
+
 
+# These reducers ignore anything but result proxies
+_PROXY_REDUCERS = (check_err_and_placeholders, collect_err_and_results,
+                   collect_dependencies)
+
+
+def traverse_data(value, f=check_err_and_placeholders, initial=(None, False),
+                  make_list=True, forward_raw=False):
+    """Walk the data structure, unwrapping result proxies.
+
+    The structure is rebuilt only along the paths leading to result proxies,
+    lists, tuples, namedtuples and dicts keeping their type and any other
+    sequences as lists (tuples for dict keys). The lists, tuples, namedtuples
+    and dicts without result proxies are returned as they are. The list,
+    tuple and dict subclasses with a __json__ method are replaced by what it
+    returns, walked in turn.
+    f reduces, in order, the result proxies and the other leaf values found,
+    or only the result proxies if it's one of the reducers in this module.
+
+    If forward_raw is set, the successful results that were not accessed yet
+    are replaced by RawPayload values holding their serialized form, without
+    decoding them. Only the serializers marked with raw_aware know how to
+    serialize RawPayload values.
+    """
+    leaves = f not in _PROXY_REDUCERS
     res = initial
+    if not leaves and _is_plain(value):
+        return value, res
+    stack = []  # the frames of the containers being walked
+    on_stack = set()  # and their ids, to detect recursive structures
+    while 1:
+        t = type(value)
+        if t in _LEAF_TYPES:
+            out, copied = value, False
+            if leaves:
+                res = f(res, value)
+        elif t is ResultProxy:
+            out, copied = _unwrap(value, forward_raw), True
+            res = f(res, value)
+        else:
+            kind = _container_kind(value, t)
+            if kind is None:
+                out, copied = value, False
+                if leaves:
+                    res = f(res, value)
+            elif _has_json_method(value, t):
+                # The JSON encoder takes them for plain lists and dicts, they
+                # are replaced here by what their __json__ method returns
+                out, res = traverse_data(value.__json__(), f, res, make_list,
+                                         forward_raw)
+                copied = True
+            elif not leaves and _is_plain(value):
+                out, copied = value, False
+            else:
+                if id(value) in on_stack:
+                    raise ValueError('Recursive structure.')
+                on_stack.add(id(value))
+                stack.append(_Frame(value, kind, make_list, forward_raw))
+                out = copied = sentinel  # nothing to add to the frame yet
+        # Add the output to its container, move to the next value or, if the
+        # container is exhausted, pop its frame and add it to the parent.
+        # The leaf values that f doesn't want to see are added right away.
+        while stack:
+            frame = stack[-1]
+            if out is not sentinel:
+                frame.add(out, copied)
+            value = frame.next_value()
+            if value is not sentinel:
+                if not leaves and type(value) in _LEAF_TYPES:
+                    out, copied = value, False
+                    continue
+                make_list, forward_raw = frame.child_options()
+                break
+            stack.pop()
+            on_stack.discard(id(frame.value))
+            out, copied = frame.result()
+        else:
+            return out, res
+
+
+_SEQUENCE, _MAPPING = range(2)
+
+_LEAF_TYPES = set([type(None), bool, int, float, bytes, uni, RawPayload,
+                   uuid.UUID])
+if sys.version_info < (3,):
+    _LEAF_TYPES.add(long)
 
-    if isinstance(value, collections.Iterable):
+
+def _is_plain(value):
+    """True if value is made only of lists, tuples, dicts and leaf values.
+
+    Such values can't hold result proxies and are skipped by traverse_data,
+    unless f wants to see the leaf values.
+    """
+    stack = [value]
+    seen = set()  # shared or recursive containers take the slow path
+    pop, extend = stack.pop, stack.extend
+    leaf_types = _LEAF_TYPES
+    while stack:
+        value = pop()
+        t = type(value)
+        if t in leaf_types:
+            continue
+        if t is not list and t is not tuple and t is not dict:
+            if not _is_namedtuple_class(t):
+                return False
         if id(value) in seen:
-            raise ValueError('Recursive structure.')
-        seen = seen | frozenset([id(value)])
-
-    if isinstance(value, collections.Mapping):
-        d = {}
-        for k, v in value.items():
-            k_, res = traverse_data(k, f, res, seen, make_list=False)
-            v_, res = traverse_data(v, f, res, seen, make_list=make_list)
-            d[k_] = v_
-        return d, res
-    if (
-        isinstance(value, collections.Iterable)
-        and isinstance(value, collections.Sized)
-    ):
-        l = []
-        for x in value:
-            x_, res = traverse_data(x, f, res, seen, make_list=make_list)
-            l.append(x_)
-        if make_list:
-            return l, res
-        return tuple(l), res
-    if isinstance(value, collections.Iterable):
-        raise ValueError('Unsized iterables not allowed.')
-    return value, f(initial, value)
+            return False
+        seen.add(id(value))
+        extend(value)
+        if t is dict:
+            extend(value.values())
+    return True
+
+
+def _has_json_method(value, t):
+    return (t is not list and t is not tuple and t is not dict
+            and isinstance(value, (list, tuple, dict))
+            and callable(getattr(value, '__json__', None)))
+
+
+def _container_kind(value, t):
+    if t is list or t is tuple:
+        return _SEQUENCE
+    if t is dict:
+        return _MAPPING
+    if isinstance(value, (bytes, uni)):
+        return None
+    if isinstance(value, Mapping):
+        return _MAPPING
+    if isinstance(value, Iterable):
+        if not isinstance(value, Sized):
+            raise ValueError('Unsized iterables not allowed.')
+        return _SEQUENCE
+    return None
+
+
+def _unwrap(proxy, forward_raw):
+    factory = proxy.__factory__
+    if forward_raw and factory.is_forwardable():
+        return RawPayload(factory.raw)
+    try:
+        return proxy.__wrapped__
+    except (TaskError, SuspendTask):
+        return proxy
+
+
+class _Frame(object):
+    """A container being walked by traverse_data.
+
+    The container is copied only when one of its values is, or when it's not
+    a list, tuple or dict.
+    """
+
+    __slots__ = ['value', 'is_mapping', 'make_list', 'forward_raw', 'items',
+                 'out', 'count', 'key', 'key_copied', 'in_key', 'pending',
+                 'rebuild']
+
+    def __init__(self, value, kind, make_list, forward_raw):
+        self.value = value
+        self.is_mapping = kind == _MAPPING
+        self.make_list = make_list
+        self.forward_raw = forward_raw
+        self.items = iter(value.items() if self.is_mapping else value)
+        t = type(value)
+        exact = t is list or t is tuple or t is dict
+        # namedtuples are rebuilt as such, they may have a registered type
+        self.rebuild = t._make if _is_namedtuple_class(t) else None
+        if exact or self.rebuild is not None:
+            self.out = None
+        else:
+            self.out = {} if self.is_mapping else []
+        self.count = 0  # the values added so far, the pairs for mappings
+        self.key = self.key_copied = self.pending = None
+        self.in_key = False
+
+    def next_value(self):
+        if not self.is_mapping:
+            return next(self.items, sentinel)
+        if self.in_key:
+            self.in_key = False
+            return self.pending
+        item = next(self.items, sentinel)
+        if item is sentinel:
+            return sentinel
+        self.in_key = True
+        key, self.pending = item
+        return key
+
+    def child_options(self):
+        if self.is_mapping and self.in_key:
+            return False, False  # dict keys are hashed, they can't be lists
+        return self.make_list, self.forward_raw
+
+    def add(self, out, copied):
+        if self.is_mapping:
+            if self.in_key:
+                self.key, self.key_copied = out, copied
+                return
+            if self.out is None and (copied or self.key_copied):
+                self.out = dict(islice(self.value.items(), self.count))
+            if self.out is not None:
+                self.out[self.key] = out
+        else:
+            if self.out is None and copied:
+                self.out = list(islice(self.value, self.count))
+            if self.out is not None:
+                self.out.append(out)
+        self.count += 1
+
+    def result(self):
+        if self.out is None:
+            return self.value, False
+        if self.rebuild is not None:
+            return self.rebuild(self.out), True
+        t = type(self.value)
+        if t is tuple:
+            return tuple(self.out), True
+        if self.is_mapping or t is list or self.make_list:
+            return self.out, True
+        return tuple(self.out), True
+
+
+# The NUL character is always escaped by the JSON encoder
+_TOKEN_RE = re.compile(r'"\\u0000([0-9a-f]{16}):(\d+)"')
+
+
+class _Splicer(object):
+    """Replace RawPayload values with unique strings and splice them back."""
+
+    def __init__(self, json_default):
+        self.docs = []
+        self.nonce = None
+        self.json_default = json_default
+
+    def default(self, value):
+        """The default hook of the JSON encoder."""
+        if type(value) is RawPayload:
+            return self.token(value)
+        return self.json_default(value)
+
+    def token(self, raw):
+        if self.nonce is None:
+            self.nonce = hexlify(os.urandom(8)).decode('ascii')
+        data = raw.data
+        if not _is_json(data):
+            data = json.dumps({' p': data})
+        self.docs.append(data)
+        return '\x00%s:%s' % (self.nonce, len(self.docs) - 1)
+
+    def splice(self, encoded):
+        if not self.docs:
+            return encoded
+        return _TOKEN_RE.sub(self._replace, encoded)
+
+    def _replace(self, match):
+        if match.group(1) != self.nonce:
+            return match.group(0)  # user data that looks like a token
+        return self.docs[int(match.group(2))]
+
+
+def raw_aware(func):
+    """Mark a serializer that knows how to serialize RawPayload values.
+
+    Results that are passed unchanged to the tasks using a marked serializer
+    are forwarded in their serialized form, without decoding them. Marked
+    deserializers must be equivalent to loads, the results they decode can
+    be forwarded before being decoded.
+    """
+    func.raw_aware = True
+    return func
+
+
+def is_raw_aware(func):
+    return getattr(func, 'raw_aware', False)
+
+
+class Serializer(object):
+    """The serialization settings shared by the workers exchanging payloads.
+
+    The serialize_input, deserialize_input, serialize_result and
+    deserialize_result methods can be used as the serializers of configs and
+    dependencies, or the serializer can be passed to them as a whole, see
+    ActivityConfig. All the workers sharing payloads, including the results
+    forwarded to other tasks, must use the same blob store and types.
+
+    If binary is set, the payloads are serialized with the binary encoding
+    from flowy.binary, which keeps more types apart but is slower to decode
+    than JSON. Both formats can be loaded.
+
+    The types are (cls, tag, encode, decode) tuples, see register_type.
+
+    If blob_store is set, the payloads larger than blob_threshold characters
+    are stored in it, see flowy.blobs, and replaced by a small reference.
+    Loading a reference fetches the blob, keeping the most recent ones, up to
+    blob_cache_size characters, cached. Results that are only forwarded to
+    other tasks keep their reference and are never fetched by the decider.
+
+    If compress_threshold is set, the payloads larger than that are
+    compressed with zlib at compress_level. The compressed payloads are still
+    JSON, tagged so that loads can detect and decompress them, so they can be
+    mixed with uncompressed ones and forwarded as is. Payloads that don't
+    shrink are left uncompressed.
+    """
+
+    def __init__(self, binary=False, types=(), blob_store=None,
+                 blob_threshold=16384, blob_cache_size=2 ** 24,
+                 compress_threshold=None, compress_level=6):
+        self.binary = binary
+        self.blob_store = blob_store
+        self.blob_threshold = blob_threshold
+        self.blob_cache_size = blob_cache_size
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        self.blob_cache = LRUCache(blob_cache_size, _blob_length)
+        # The registered types: type -> (tag, encode) and tag -> decode
+        self.type_encoders = {}
+        self.type_decoders = {}
+        self.tuple_types = ()  # the tuple subclasses, tagged before encoding
+        # The tagged JSON objects, by key
+        self.json_decoders = {' u': uuid.UUID, ' b': b64decode}
+        for args in _BUILTIN_TYPES:
+            self.register_type(*args)
+        for args in types:
+            self.register_type(*args)
+
+    def __getstate__(self):
+        # The blob cache isn't shipped to the local backend processes
+        state = self.__dict__.copy()
+        del state['blob_cache']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.blob_cache = LRUCache(self.blob_cache_size, _blob_length)
+
+    def register_type(self, cls, tag, encode=None, decode=None):
+        """Serialize the instances of cls, and of its subclasses, as tagged values.
+
+        encode(value) returns a serializable value in place of the instance and
+        decode(data) builds the instance back. For namedtuple classes they
+        default to encoding the fields as a list. The tag identifies the type
+        in the payloads, so it must be the same on all the workers. Single
+        character tags are reserved for flowy.
+        """
+        if _is_namedtuple_class(cls):
+            if encode is None:
+                encode = list
+            if decode is None:
+                decode = functools.partial(_load_namedtuple, cls)
+        if encode is None or decode is None:
+            raise ValueError('Both encode and decode are needed for %r.' % cls)
+        key = ' ' + tag
+        registered = self.type_encoders.get(cls)
+        if key in _RESERVED_KEYS or (key in self.json_decoders and (
+                registered is None or registered[0] != tag)):
+            raise ValueError('The tag %r is already used.' % tag)
+        self.type_encoders[cls] = (tag, encode)
+        self.type_decoders[tag] = decode
+        self.json_decoders[key] = decode
+        if issubclass(cls, tuple):
+            # The JSON encoder doesn't call the default hook for tuples
+            self.tuple_types = tuple(set(self.tuple_types) | set([cls]))
+
+    @raw_aware
+    def serialize_input(self, *args, **kwargs):
+        """Serialize the task input."""
+        if self.binary:
+            return self.dumps_binary([list(args), kwargs])
+        return self.dumps([args, kwargs])
+
+    def deserialize_input(self, input_data):
+        """Deserialize the input data in args, kwargs."""
+        return _split_input(self.loads(input_data))
 
+    @raw_aware
+    def serialize_result(self, result):
+        """Serialize the task result."""
+        if self.binary:
+            return self.dumps_binary(result)
+        return self.dumps(result)
 
+    @raw_aware
+    def deserialize_result(self, result):
+        """Deserialize the task result."""
+        return self.loads(result)
+
+    @raw_aware
+    def dumps(self, value):
+        """Serialize the value as JSON in a single pass.
+
+        The types JSON doesn't support are encoded by the default hook of the
+        JSON encoder as tagged objects, see register_type. Other objects are
+        encoded as what their __json__ method returns, except for the list,
+        tuple and dict subclasses: the JSON encoder handles them as plain
+        containers, their __json__ method is only called by traverse_data,
+        which the task inputs and the workflow results go through.
+        """
+        if self.tuple_types or _PY2:
+            value = self._pretag(value)
+        splicer = _Splicer(self._json_default)
+        encoder = json.JSONEncoder(default=splicer.default)
+        data = splicer.splice(encoder.encode(value))
+        return self._offload(self._compress(data))
+
+    @raw_aware
+    def dumps_binary(self, value):
+        """Same as dumps but use the binary encoding from flowy.binary.
+
+        Unlike JSON, tuples are kept apart from lists. loads detects the
+        format by its header.
+        """
+        data = binary.encode(value, self._binary_extension)
+        return self._offload(self._compress(data))
+
+    @raw_aware
+    def loads(self, value):
+        if not _is_json(value):
+            return binary.decode(value, self.loads, self._load_extension)
+        return self._loads_json(value)
+
+    def loads_many(self, values):
+        """Same as [loads(x) for x in values] but parse all the values at once."""
+        values = list(values)
+        if not values:
+            return []
+        return self._loads_json('[%s]' % ','.join(values))
+
+    def _find_type_encoder(self, cls):
+        for base in cls.__mro__:
+            found = self.type_encoders.get(base)
+            if found is not None:
+                return found
+        return None
+
+    def _json_default(self, value):
+        encode = _JSON_ENCODERS.get(type(value))
+        if encode is not None:
+            return encode(value)
+        found = self._find_type_encoder(type(value))
+        if found is not None:
+            tag, encode = found
+            return {' ' + tag: encode(value)}
+        if callable(getattr(value, '__json__', None)):
+            return value.__json__()
+        if isinstance(value, uuid.UUID):
+            return _encode_uuid(value)
+        if isinstance(value, bytes):
+            return _encode_bytes(value)
+        raise TypeError('%r is not JSON serializable' % (value,))
+
+    def _binary_extension(self, value):
+        found = self._find_type_encoder(type(value))
+        if found is not None:
+            tag, encode = found
+            return tag, encode(value)
+        return None
+
+    def _pretag(self, value):
+        # The JSON encoder handles all tuples and, on python 2, str values
+        # without calling the default hook, so they're tagged beforehand.
+        if isinstance(value, self.tuple_types):
+            tag, encode = self._find_type_encoder(type(value))
+            return {' ' + tag: self._pretag(encode(value))}
+        if isinstance(value, bytes) and _PY2:
+            return _encode_bytes(value)
+        if isinstance(value, (list, tuple)):
+            return [self._pretag(x) for x in value]
+        if isinstance(value, dict):
+            return dict((k, self._pretag(v)) for k, v in value.items())
+        return value
+
+    def _compress(self, data):
+        threshold = self.compress_threshold
+        if threshold is None or len(data) <= threshold:
+            return data
+        compressed = zlib.compress(data.encode('utf-8'), self.compress_level)
+        compressed = json.dumps({' z': b64encode(compressed).decode('ascii')})
+        if len(compressed) >= len(data):
+            return data
+        return compressed
+
+    def _offload(self, data):
+        if self.blob_store is None or len(data) <= self.blob_threshold:
+            return data
+        key = blob_key(data)
+        self.blob_store.put(key, data)
+        return json.dumps({' r': key})
+
+    def _fetch_blob(self, key):
+        data = self.blob_cache.get(key)
+        if data is None:
+            if self.blob_store is None:
+                raise ValueError('No blob store set to load the blob %r.' % key)
+            data = self.blob_store.get(key)
+            self.blob_cache.put(key, data)
+        return data
+
+    def _loads_json(self, value):
+        # All tags are keys starting with a space, the object hook is needed
+        # only if some string starts with one.
+        if '" ' not in value:
+            return json.loads(value)
+        return json.loads(value, object_hook=self._obj_hook)
+
+    def _obj_hook(self, obj):
+        if len(obj) != 1:
+            return obj
+        key, value = next(iter(obj.items()))
+        decode = self.json_decoders.get(key)
+        if decode is not None:
+            return decode(value)
+        if key == ' r':
+            return self.loads(self._fetch_blob(value))
+        if key == ' p':
+            return self.loads(value)
+        if key == ' z':
+            data = zlib.decompress(b64decode(value)).decode('utf-8')
+            return self.loads(data)
+        return obj
+
+    def _load_extension(self, tag, data):
+        try:
+            decode = self.type_decoders[tag]
+        except KeyError:
+            raise ValueError('Unknown type tag: %r' % tag)
+        return decode(data)
+
+    def __repr__(self):
+        return '<Serializer binary=%s blob_store=%r compress_threshold=%r>' % (
+            self.binary, self.blob_store, self.compress_threshold)
+
+
+def _split_input(data):
+    args, kwargs = data  # raise TypeError if deconstructing fails
+    if not isinstance(args, list):
+        raise ValueError('Invalid args: %r' % (args,))
+    if not isinstance(kwargs, dict):
+        raise ValueError('Invalid kwargs: %r' % (kwargs,))
+    return args, kwargs
+
+
+def _blob_length(key, data):
+    return len(data)
+
+
+def _dump_datetime(value):
+    offset = value.utcoffset()
+    if offset is not None:
+        offset = offset.days * 86400 + offset.seconds
+    return [value.year, value.month, value.day, value.hour, value.minute,
+            value.second, value.microsecond, offset]
+
+
+def _load_datetime(data):
+    tz = None
+    if data[7] is not None:
+        tz = _FixedOffset(data[7])
+    return datetime.datetime(*data[:7], tzinfo=tz)
+
+
+def _dump_date(value):
+    return [value.year, value.month, value.day]
+
+
+def _load_date(data):
+    return datetime.date(*data)
+
+
+def _load_namedtuple(cls, data):
+    return cls(*data)
+
+
+class _FixedOffset(datetime.tzinfo):
+    """A timezone with a fixed UTC offset, in seconds."""
+
+    def __init__(self, seconds):
+        self.offset = datetime.timedelta(seconds=seconds)
+
+    def utcoffset(self, dt):
+        return self.offset
+
+    def dst(self, dt):
+        return datetime.timedelta(0)
+
+    def tzname(self, dt):
+        return None
+
+    def __reduce__(self):
+        return _FixedOffset, (self.offset.days * 86400 + self.offset.seconds,)
+
+    def __repr__(self):
+        return '<_FixedOffset %s>' % self.offset
+
+
+def _is_namedtuple_class(cls):
+    return issubclass(cls, tuple) and hasattr(cls, '_make')
+
+
+def _encode_uuid(value):
+    return {' u': value.hex}
+
+
+def _encode_bytes(value):
+    return {' b': b64encode(value).decode('ascii')}
+
+
+@raw_aware
 def dumps(value):
-    return json.dumps(_tag(value))
+    """Serialize the value as JSON with the default Serializer settings."""
+    return _default.dumps(value)
+
 
+@raw_aware
+def dumps_binary(value):
+    """Serialize the value with the binary encoding from flowy.binary.
 
-def _tag(value):
-    if isinstance(value, uuid.UUID):
-        return {' u': value.hex}
-    elif isinstance(value, bytes):
-        return {' b': b64encode(value).decode('ascii')}
-    elif callable(getattr(value, '__json__', None)):
-        return _tag(value.__json__())
-    elif isinstance(value, (list, tuple)):
-        return [_tag(x) for x in value]
-    elif isinstance(value, dict):
-        return dict((k, _tag(v)) for k, v in value.items())
-    return value
+    Unlike JSON, tuples are kept apart from lists. loads detects the format
+    by its header.
+    """
+    return _default.dumps_binary(value)
 
 
+def _is_json(payload):
+    return not payload.startswith(binary.HEADER)
+
+
+def _is_blob_ref(payload):
+    return payload.startswith(_BLOB_REF_PREFIX)
+
+
+@raw_aware
 def loads(value):
-    return json.loads(value, object_hook=_obj_hook)
+    """Deserialize a payload, in either format, with the default settings.
 
+    Offloaded payloads can't be loaded without the Serializer holding their
+    blob store.
+    """
+    return _default.loads(value)
 
-def _obj_hook(obj):
-    if len(obj) != 1:
-        return obj
-    key, value = next(iter(obj.items()))
-    if key == ' u':
-        return uuid.UUID(value)
-    elif key == ' b':
-        return b64decode(value)
-    return obj
+
+def loads_many(values):
+    """Same as [loads(x) for x in values] but parse all the values at once."""
+    return _default.loads_many(values)
+
+
+class DecodeCache(LRUCache):
+    """A cache of deserialized payloads, bounded by the payloads length.
+
+    The entries are keyed by (deserializer, payload) so the same payload
+    decoded by different deserializers doesn't collide. The size is the
+    maximum total length of the cached payloads. Only the immutable values
+    are cached, they are shared by everyone using the cache; copying a list
+    or a dict on every use costs about as much as parsing it again, so the
+    mutable values are decoded every time.
+    """
+
+    def __init__(self, size):
+        super(DecodeCache, self).__init__(size, _payload_length)
+
+    def decode(self, deserialize, payload):
+        """Return deserialize(payload), decoding it only on cache misses."""
+        key = (deserialize, payload)
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            value = deserialize(payload)
+            if _is_immutable(value):
+                self.put(key, value)
+        return value
+
+    def memoize(self, deserialize):
+        """Return a caching version of the deserialize callable."""
+        return functools.partial(self.decode, deserialize)
+
+    def prefill(self, deserialize, payloads):
+        """Decode all the payloads missing from the cache in a single parse.
+
+        The deserialize callable must be equivalent to loads, or be the loads
+        or deserialize_result method of a Serializer. If any of the payloads
+        is invalid nothing is cached and each payload fails on its own when
+        decoded. Offloaded payloads are left to be fetched only if they are
+        used and plain JSON arrays and objects to be decoded when used.
+        """
+        missing = []
+        length = 0
+        for payload in set(payloads):
+            if _is_blob_ref(payload) or not _is_json(payload):
+                continue
+            if _is_plain_container(payload):
+                continue  # decodes to a mutable value, it can't be cached
+            if (deserialize, payload) in self:
+                continue
+            if length + len(payload) <= self.size:
+                length += len(payload)
+                missing.append(payload)
+        if not missing:
+            return
+        owner = getattr(deserialize, '__self__', None)
+        if not isinstance(owner, Serializer):
+            owner = _default
+        try:
+            values = owner.loads_many(missing)
+        except ValueError:
+            return
+        for payload, value in zip(missing, values):
+            if _is_immutable(value):
+                self.put((deserialize, payload), value)
+
+
+def _payload_length(key, value):
+    return len(key[1])
+
+
+def _is_plain_container(payload):
+    # The tagged values are objects with a single key starting with a space
+    return payload[:1] == '[' or (payload[:1] == '{' and payload[:3] != '{" ')
+
+
+def _is_immutable(value):
+    t = type(value)
+    if t in _LEAF_TYPES or t in _IMMUTABLE_TYPES:
+        return True
+    if t is tuple:
+        return all(_is_immutable(x) for x in value)
+    return False
+
+
+_IMMUTABLE_TYPES = set([datetime.datetime, datetime.date, decimal.Decimal,
+                        frozenset])
+
+
+_PY2 = sys.version_info < (3,)
+
+_JSON_ENCODERS = {uuid.UUID: _encode_uuid, bytes: _encode_bytes}
+
+# The tags of the blob references, raw payloads and compressed payloads
+_RESERVED_KEYS = set([' r', ' p', ' z'])
+
+_BUILTIN_TYPES = [
+    (set, 's', list, set),
+    (frozenset, 'f', list, frozenset),
+    (datetime.datetime, 't', _dump_datetime, _load_datetime),
+    (datetime.date, 'd', _dump_date, _load_date),
+    (decimal.Decimal, 'n', str, decimal.Decimal),
+]
+
+# The settings used by the module level functions and default serializers
+_default = Serializer()
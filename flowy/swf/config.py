@@ -3,11 +3,15 @@ import functools
 from boto.exception import SWFResponseError
 from boto.swf.exceptions import SWFTypeAlreadyExistsError
 
+from flowy.swf.decision import request_cancel
+from flowy.swf.proxy import in_flight_counter
 from flowy.swf.proxy import SWFActivityProxyFactory
+from flowy.swf.proxy import SWFTimerProxyFactory
 from flowy.swf.proxy import SWFWorkflowProxyFactory
 from flowy.config import ActivityConfig
 from flowy.config import WorkflowConfig
-from flowy.utils import DescCounter
+from flowy.proxy import serialize_input_binary
+from flowy.result import SuspendTask
 from flowy.utils import logger
 from flowy.utils import str_or_none
 
@@ -30,10 +34,7 @@ class SWFConfigMixin(object):
             self.check_compatible(swf_layer1, domain, name, version)  # raises if incompatible
 
     def register(self, registry, key, func):
-        name, version = key
-        if name is None:
-            name = func.__name__
-        name, version = str(name), str(version)
+        name, version = _name_version(key, func)
         registry.register_task((name, version), self.wrap(func))
         registry.add_remote_reg_callback(
             functools.partial(self.register_remote, name=name, version=version))
@@ -54,7 +55,10 @@ class SWFActivityConfig(SWFConfigMixin, ActivityConfig):
                  default_schedule_to_start=None,
                  default_start_to_close=None,
                  deserialize_input=None,
-                 serialize_result=None):
+                 serialize_result=None,
+                 raw=False,
+                 binary=False,
+                 serializer=None):
         """Initialize the config object.
 
         The timer values are in seconds.
@@ -64,14 +68,28 @@ class SWFActivityConfig(SWFConfigMixin, ActivityConfig):
 
         The name is optional. If no name is set, it will default to the
         function name.
+
+        If raw is set, the activity gets the undecoded input and returns an
+        already serialized result. If binary is set, the result is serialized
+        with the binary encoding. The serializer, if set, is a
+        flowy.serialization.Serializer used for both the input and the result.
+        See ActivityConfig.
         """
-        super(SWFActivityConfig, self).__init__(deserialize_input, serialize_result)
+        super(SWFActivityConfig, self).__init__(deserialize_input,
+                                                serialize_result, raw, binary,
+                                                serializer)
         self.default_task_list = default_task_list
         self.default_heartbeat = default_heartbeat
         self.default_schedule_to_close = default_schedule_to_close
         self.default_schedule_to_start = default_schedule_to_start
         self.default_start_to_close = default_start_to_close
 
+    def register(self, registry, key, func):
+        """Register the activity and its default heartbeat with the worker."""
+        super(SWFActivityConfig, self).register(registry, key, func)
+        registry.set_default_heartbeat(_name_version(key, func),
+                                       self.default_heartbeat)
+
     def _cvt_values(self):
         """Convert values to their expected types or bailout."""
         d_t_l = str_or_none(self.default_task_list)
@@ -169,7 +187,10 @@ class SWFWorkflowConfig(SWFConfigMixin, WorkflowConfig):
                  rate_limit=64,
                  deserialize_input=None,
                  serialize_result=None,
-                 serialize_restart_input=None):
+                 serialize_restart_input=None,
+                 binary=False,
+                 cancel_abandoned=False,
+                 serializer=None):
         """Initialize the config object.
 
         The timer values are in seconds. The child policy should be one fo
@@ -178,16 +199,31 @@ class SWFWorkflowConfig(SWFConfigMixin, WorkflowConfig):
         For the default configs, a value of None means that the config is unset
         and must be set explicitly in proxies pointing to this activity.
 
-        The rate_limit is used to limit the number of concurrent tasks. A value
-        of None means no rate limit.
+        The rate_limit is the maximum number of tasks, across all the
+        dependencies, running at the same time; the tasks already running, as
+        recorded in the execution history, are counted too. A value of None
+        means no rate limit. Each dependency can have its own limit too, see
+        conf_activity.
+
+        If binary is set, the result and the restart input are serialized
+        with the binary encoding. The serializer, if set, is a
+        flowy.serialization.Serializer used for the input, the result and the
+        restart input. The dependencies have their own, see conf_activity.
+
+        If cancel_abandoned is set, the cancellation of the tasks that can no
+        longer affect the outcome is requested: the tasks that lose a first()
+        race and the tasks still running when the workflow closes. The
+        activities see the cancellation request on heartbeat.
         """
         super(SWFWorkflowConfig, self).__init__(
-            deserialize_input, serialize_result, serialize_restart_input)
+            deserialize_input, serialize_result, serialize_restart_input,
+            binary, serializer)
         self.default_task_list = default_task_list
         self.default_workflow_duration = default_workflow_duration
         self.default_decision_duration = default_decision_duration
         self.default_child_policy = default_child_policy
-        self.rate_limit = rate_limit
+        self.rate_limit = limit_encode(rate_limit, 'rate_limit')
+        self.cancel_abandoned = cancel_abandoned
         self.proxy_factory_registry = {}
 
     def _cvt_values(self):
@@ -274,7 +310,12 @@ class SWFWorkflowConfig(SWFConfigMixin, WorkflowConfig):
                       start_to_close=None,
                       serialize_input=None,
                       deserialize_result=None,
-                      retry=(0, 0, 0)):
+                      retry=(0, 0, 0),
+                      binary=False,
+                      rate_limit=None,
+                      max_rate=None,
+                      hedge=None,
+                      serializer=None):
         """Configure an activity dependency for a workflow implementation.
 
         dep_name is the name of one of the workflow factory arguments
@@ -293,9 +334,32 @@ class SWFWorkflowConfig(SWFConfigMixin, WorkflowConfig):
 
         For convenience, if the activity name is missing, it will be the same
         as the dependency name.
+
+        If binary is set, the activity input is serialized with the binary
+        encoding. The serializer, if set, is a flowy.serialization.Serializer
+        used for the activity input and result; it must match the one of the
+        activity config.
+
+        The rate_limit is the maximum number of tasks of this dependency
+        running at the same time, so each downstream system can get its own
+        concurrency budget. It applies on top of the workflow rate_limit.
+
+        The max_rate is the maximum number of tasks of this dependency started
+        per second, for APIs with request rate quotas. The tasks over the rate
+        wait, without using a worker, for a timer that wakes the workflow up
+        when they can start. Rates above one task per second are metered over
+        one second windows and must be whole numbers.
+
+        If hedge is set, an activity still running after hedge seconds, for
+        example its 95th latency percentile, gets a duplicate and the first of
+        the two to finish is used. The other one is canceled, the activities
+        see the cancellation request on heartbeat. Each attempt can have its
+        own duplicate and the duplicates don't use up the retries.
         """
         if name is None:
             name = dep_name
+        serialize_input, deserialize_result = _dep_serializers(
+            serialize_input, deserialize_result, binary, serializer)
         proxy_factory = SWFActivityProxyFactory(
             identity=str(dep_name),
             name=str(name),
@@ -307,7 +371,10 @@ class SWFWorkflowConfig(SWFConfigMixin, WorkflowConfig):
             start_to_close=timer_encode(start_to_close, 'start_to_close'),
             serialize_input=serialize_input,
             deserialize_result=deserialize_result,
-            retry=retry)
+            retry=retry,
+            rate_limit=limit_encode(rate_limit, 'rate_limit'),
+            max_rate=max_rate_encode(max_rate, 'max_rate'),
+            hedge=hedge_encode(hedge))
         self.conf_proxy_factory(dep_name, proxy_factory)
 
     def conf_workflow(self, dep_name, version,
@@ -318,10 +385,16 @@ class SWFWorkflowConfig(SWFConfigMixin, WorkflowConfig):
                       child_policy=None,
                       serialize_input=None,
                       deserialize_result=None,
-                      retry=(0, 0, 0)):
+                      retry=(0, 0, 0),
+                      binary=False,
+                      rate_limit=None,
+                      max_rate=None,
+                      serializer=None):
         """Same as conf_activity but for sub-workflows."""
         if name is None:
             name = dep_name
+        serialize_input, deserialize_result = _dep_serializers(
+            serialize_input, deserialize_result, binary, serializer)
         proxy_factory = SWFWorkflowProxyFactory(
             identity=str(dep_name),
             name=str(name),
@@ -332,25 +405,95 @@ class SWFWorkflowConfig(SWFConfigMixin, WorkflowConfig):
             child_policy=cp_encode(child_policy),
             serialize_input=serialize_input,
             deserialize_result=deserialize_result,
-            retry=retry)
+            retry=retry,
+            rate_limit=limit_encode(rate_limit, 'rate_limit'),
+            max_rate=max_rate_encode(max_rate, 'max_rate'))
         self.conf_proxy_factory(dep_name, proxy_factory)
 
+    def conf_timer(self, dep_name):
+        """Configure a dependency the workflow can sleep with.
+
+        Calling the dependency with a number of seconds, rounded up to whole
+        seconds, starts an SWF timer and returns a result that finishes, with
+        None, when the timer fires:
+
+            class MyWorkflow:
+                def __init__(self, a, sleep):
+                    self.a = a
+                    self.sleep = sleep
+
+                def run(self):
+                    return first(self.a(), self.sleep(60))  # a, or a timeout
+        """
+        self.conf_proxy_factory(dep_name, SWFTimerProxyFactory(str(dep_name)))
+
+    def input_deserializer(self, decision, execution_history, *extra_args):
+        """Cache the decoded input if the history has a result cache."""
+        cache = execution_history.result_cache
+        if cache is None:
+            return self.deserialize_input
+        return cache.memoize(self.deserialize_input)
+
     def wrap(self, func):
-        """Insert an additional DescCounter object for rate limiting."""
+        """Insert an additional DescCounter object for rate limiting.
+
+        The counter has a position for each task that can be scheduled
+        without going over the rate_limit, given the tasks already running.
+        With cancel_abandoned, the tasks still running when the workflow
+        closes are canceled.
+        """
         f = super(SWFWorkflowConfig, self).wrap(func)
+        # See ActivityConfig.wrap for why there isn't a closure here
+        return functools.partial(_swf_workflow_wrapper, self, f)
 
-        @functools.wraps(func)
-        def wrapper(input_data, *extra_args):
-            extra_args = extra_args + (DescCounter(int(self.rate_limit)), )
-            return f(input_data, *extra_args)
 
-        return wrapper
+def _swf_workflow_wrapper(self, f, input_data, decision, execution_history):
+    rate_limit = in_flight_counter(self.rate_limit, execution_history)
+    if not self.cancel_abandoned:
+        return f(input_data, decision, execution_history, rate_limit)
+    try:
+        result = f(input_data, decision, execution_history, rate_limit, True)
+    except SuspendTask:
+        raise
+    except Exception:
+        _cancel_running(decision, execution_history)
+        raise
+    _cancel_running(decision, execution_history)
+    return result
 
 
 class SWFRegistrationError(Exception):
     """Can't register a task remotely."""
 
 
+def _name_version(key, func):
+    name, version = key
+    if name is None:
+        name = func.__name__
+    return str(name), str(version)
+
+
+def _cancel_running(decision, execution_history):
+    """Cancel the tasks still running when the workflow closes."""
+    for call_key in execution_history.running_tasks():
+        request_cancel(decision, execution_history, call_key)
+
+
+def _dep_serializers(serialize_input, deserialize_result, binary,
+                     serializer):
+    if serializer is not None:
+        if (binary or serialize_input is not None
+                or deserialize_result is not None):
+            raise ValueError('A serializer cannot be used with custom '
+                             'serializers or binary.')
+        return serializer.serialize_input, serializer.deserialize_result
+    if not binary:
+        return serialize_input, deserialize_result
+    if serialize_input is not None:
+        raise ValueError('Custom serializers cannot be used with binary.')
+    return serialize_input_binary, deserialize_result
+
+
 def cp_encode(val):
     if val is not None:
         val = str(val).upper()
@@ -359,6 +502,44 @@ def cp_encode(val):
     return val
 
 
+def limit_encode(val, name):
+    if val is None:
+        return None
+    val = int(val)
+    if val < 1:
+        raise ValueError(
+            'The value of %r must be a strictly positive integer: %r' %
+            (name, val))
+    return val
+
+
+def rate_encode(val, name):
+    if val is None:
+        return None
+    val = float(val)
+    if not 0 < val < float('inf'):
+        raise ValueError(
+            'The value of %r must be a strictly positive number: %r' %
+            (name, val))
+    return val
+
+
+def max_rate_encode(val, name):
+    val = rate_encode(val, name)
+    if val is not None and val > 1 and val != int(val):
+        # Rates above one task per second are metered over one second
+        raise ValueError(
+            'The value of %r must be a whole number above 1: %r' %
+            (name, val))
+    return val
+
+
+def hedge_encode(val):
+    if val is None:
+        return None
+    return int(timer_encode(val, 'hedge'))
+
+
 def timer_encode(val, name):
     if val is None:
         return None
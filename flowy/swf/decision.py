@@ -1,3 +1,7 @@
+import bisect
+import math
+import threading
+import time
 import uuid
 
 from boto.exception import SWFResponseError
@@ -11,19 +15,56 @@ REASON_SIZE = 256
 
 
 class SWFActivityDecision(object):
-    def __init__(self, layer1, token):
+    def __init__(self, layer1, token, heartbeat_interval=None):
+        """Initialize the activity decision.
+
+        If heartbeat_interval is set, heartbeats requested less than that many
+        seconds after the last sent heartbeat are coalesced and not sent.
+        """
         self.layer1 = layer1
         self.token = token
+        self.heartbeat_interval = heartbeat_interval
+        self.last_heartbeat = None
+        self.cancel_requested = False
+        self.closed = False
+        self.lock = threading.Lock()
 
     def heartbeat(self):
-        try:
-            self.layer1.record_activity_task_heartbeat(task_token=str(self.token))
-        except SWFResponseError:
-            logger.exception('Error while sending the heartbeat:')
-            return False
-        return True
+        """Record a heartbeat for the activity.
+
+        Returns False if the heartbeat fails or if the cancellation of the
+        activity was requested, in which case the activity should stop.
+        """
+        if (self.heartbeat_interval is not None
+                and self.last_heartbeat is not None
+                and time.time() - self.last_heartbeat < self.heartbeat_interval):
+            return not self.cancel_requested
+        return self.send_heartbeat()
+
+    def send_heartbeat(self):
+        """Send a heartbeat now, regardless of the heartbeat interval."""
+        with self.lock:
+            if self.closed:
+                return False
+            self.last_heartbeat = time.time()
+            try:
+                r = self.layer1.record_activity_task_heartbeat(
+                    task_token=str(self.token))
+            except SWFResponseError:
+                logger.exception('Error while sending the heartbeat:')
+                return False
+        if r and r.get('cancelRequested'):
+            if not self.cancel_requested:
+                logger.info('Activity cancellation requested.')
+            self.cancel_requested = True
+        return not self.cancel_requested
 
     def fail(self, reason):
+        """Fail the activity or, if cancellation was requested, cancel it."""
+        with self.lock:
+            self.closed = True
+        if self.cancel_requested:
+            return self.cancel(reason)
         try:
             self.layer1.respond_activity_task_failed(
                 reason=str(reason)[:256], task_token=str(self.token))
@@ -32,6 +73,19 @@ class SWFActivityDecision(object):
             return False
         return True
 
+    def cancel(self, details=None):
+        with self.lock:
+            self.closed = True
+        if details is not None:
+            details = str(details)[:RESULT_SIZE]
+        try:
+            self.layer1.respond_activity_task_canceled(
+                task_token=str(self.token), details=details)
+        except SWFResponseError:
+            logger.exception('Error while canceling the activity:')
+            return False
+        return True
+
     def flush(self):
         self.fail("Cannot flush activities.")
 
@@ -39,6 +93,8 @@ class SWFActivityDecision(object):
         self.fail("Cannot restart activities.")
 
     def finish(self, result):
+        with self.lock:
+            self.closed = True
         result = str(result)
         if len(result) > RESULT_SIZE:
             self.fail("Result too large: %s/%s" % (len(result), RESULT_SIZE))
@@ -62,6 +118,9 @@ class SWFWorkflowDecision(object):
         self.tags = tags
         self.child_policy = child_policy
         self.decisions = Layer1Decisions()
+        # Kept apart, the cancellations are sent even if the workflow closes
+        self.cancels = Layer1Decisions()
+        self.canceled = set()
         self.closed = False
 
     def fail(self, reason):
@@ -81,7 +140,8 @@ class SWFWorkflowDecision(object):
         self.closed = True
         try:
             self.layer1.respond_decision_task_completed(
-                task_token=str(self.token), decisions=self.decisions._data)
+                task_token=str(self.token),
+                decisions=self.cancels._data + self.decisions._data)
         except SWFResponseError:
             logger.exception('Error while sending the decisions:')
             # ignore the error and let the decision timeout and retry
@@ -120,9 +180,23 @@ class SWFWorkflowDecision(object):
 
     def schedule_timer(self, call_key, delay):
         """Schedule a timer. This is used to delay execution of tasks."""
+        delay = int(math.ceil(delay))  # SWF timers have a one second resolution
         self.decisions.start_timer(timer_id=timer_key(call_key),
                                    start_to_fire_timeout=str(delay))
 
+    def request_cancel_activity(self, call_key):
+        """Request the cancellation of a running activity."""
+        if call_key not in self.canceled:
+            self.canceled.add(call_key)
+            self.cancels.request_cancel_activity_task(call_key)
+
+    def request_cancel_workflow(self, workflow_id):
+        """Request the cancellation of a running sub-workflow."""
+        if workflow_id not in self.canceled:
+            self.canceled.add(workflow_id)
+            self.cancels.request_cancel_external_workflow_execution(
+                workflow_id)
+
     def schedule_activity(self, call_key, name, version, input_data, task_list,
                           heartbeat, schedule_to_close, schedule_to_start,
                           start_to_close):
@@ -155,27 +229,120 @@ class SWFWorkflowDecision(object):
             child_policy=child_policy)
 
 
+class RateMeter(object):
+    """Meter the tasks of a proxy started per time window.
+
+    At most max_rate tasks can start in any window of one second or, for rates
+    below one task per second, one task in any window of 1 / max_rate
+    seconds. The earlier tasks are counted at the times they were scheduled
+    and the ones scheduled by this decision at the time of the decision.
+    """
+
+    def __init__(self, max_rate, start_times, now):
+        self.window = max(1.0, 1.0 / max_rate)
+        self.allowed = max(int(max_rate * self.window), 1)
+        self.now = now
+        since = bisect.bisect_right(start_times, now - self.window)
+        self.starts = start_times[since:]
+        self.waiting = False
+
+    def available(self):
+        """Returns True if a task can start now, without recording a start."""
+        return len(self.starts) < self.allowed
+
+    def consume(self):
+        """Consume one start; returns True if the task can start now."""
+        if not self.available():
+            return False
+        self.starts.append(self.now)
+        return True
+
+    def wait_time(self):
+        """Return the seconds, at least one, until another task can start."""
+        free_at = self.starts[-self.allowed] + self.window
+        return max(int(math.ceil(free_at - self.now)), 1)
+
+
 class SWFWorkflowTaskDecision(object):
-    def __init__(self, decision, execution_history, proxy_factory, rate_limit):
+    def __init__(self, decision, execution_history, proxy_factory, rate_limit,
+                 dep_rate_limit=None, rate_meter=None):
+        """Initialize the task decision.
+
+        The rate_limit counter is shared by all the proxies of a workflow and
+        the dep_rate_limit counter, if set, is this proxy's own. A task is
+        scheduled only if there are positions left in both of them; the
+        timers that delay the tasks don't consume any positions.
+
+        If a rate_meter is set and the task can't start yet, a timer wakes the
+        workflow up when it can and the task is scheduled by that decision.
+        """
         self.decision = decision
         self.execution_history = execution_history
         self.proxy_factory = proxy_factory
         self.rate_limit = rate_limit
+        self.dep_rate_limit = dep_rate_limit
+        self.rate_meter = rate_meter
 
     def fail(self, reason):
         self.decision.fail(reason)
 
-    def schedule(self, call_number, retry_number, delay, input_data):
-        if not self.rate_limit.consume():
-            return
-        tk = task_key(self.proxy_factory.identity, call_number, retry_number)
+    def schedule(self, call_number, retry_number, delay, input_data,
+                 hedge=False):
+        """Schedule a task, after a timer if there is a delay.
+
+        If hedge is set, the task is the duplicate of the retry_number attempt.
+        Returns True if the task is scheduled by this decision.
+        """
+        tk = self._task_key(call_number, retry_number, hedge)
         if delay > 0:
             if self.execution_history.is_timer_ready(tk):
-                self._schedule(tk, input_data)
+                return self._schedule_limited(tk, input_data)
             elif not self.execution_history.is_timer_running(tk):
                 self.decision.schedule_timer(tk, delay)
-        else:
-            self._schedule(tk, input_data)
+            return False
+        return self._schedule_limited(tk, input_data)
+
+    def _schedule_limited(self, task_key, input_data):
+        # Check all the limits before consuming any of them, a task held back
+        # by one limit must not use up the others.
+        if self.rate_meter is not None and not self.rate_meter.available():
+            self._wait_for_rate()
+            return False
+        if (self.dep_rate_limit is not None
+                and not self.dep_rate_limit.available()):
+            return False
+        if not self.rate_limit.available():
+            return False
+        if self.rate_meter is not None:
+            self.rate_meter.consume()
+        if self.dep_rate_limit is not None:
+            self.dep_rate_limit.consume()
+        self.rate_limit.consume()
+        self._schedule(task_key, input_data)
+        return True
+
+    def cancel(self, call_number, retry_number, hedge=False):
+        """Request the cancellation of a running task."""
+        tk = self._task_key(call_number, retry_number, hedge)
+        request_cancel(self.decision, self.execution_history, tk)
+
+    def _task_key(self, call_number, retry_number, hedge):
+        identity = self.proxy_factory.identity
+        if hedge:
+            identity = hedge_identity(identity)
+        return task_key(identity, call_number, retry_number)
+
+    def _wait_for_rate(self):
+        meter = self.rate_meter
+        if meter.waiting:  # one timer for all the waiting tasks
+            return
+        meter.waiting = True
+        delay = meter.wait_time()
+        # A key per wake up time, not to be confused with earlier timers
+        wake_key = '%s:r:%d' % (self.proxy_factory.identity,
+                                int(math.ceil(meter.now)) + delay)
+        if not self.execution_history.is_timer_running(wake_key):
+            self.decision.schedule_timer(wake_key, delay)
 
     def _schedule(self, task_key, input_data):
         self.decision.schedule_workflow(
@@ -193,6 +360,15 @@ class SWFActivityTaskDecision(SWFWorkflowTaskDecision):
             self.proxy_factory.start_to_close)
 
 
+def request_cancel(decision, execution_history, call_key):
+    """Request the cancellation of a running task, unless already requested."""
+    if execution_history.is_cancel_requested(call_key):
+        return
+    workflow_id = execution_history.workflow_id(call_key)
+    if workflow_id is None:
+        decision.request_cancel_activity(call_key)
+    else:
+        decision.request_cancel_workflow(workflow_id)
 
 
 def timer_key(call_key):
@@ -201,3 +377,13 @@ def timer_key(call_key):
 
 def task_key(identity, call_number, retry_number):
     return '%s-%s-%s' % (identity, call_number, retry_number)
+
+
+def hedge_identity(identity):
+    """The identity of the duplicates of a proxy's tasks."""
+    return '%s:h' % identity
+
+
+def base_identity(identity):
+    """The identity of the proxy a task, or its duplicate, belongs to."""
+    return identity.split(':', 1)[0]
@@ -1,19 +1,84 @@
+from flowy.history import HistoryIndex
+from flowy.history import parse_task_key
+from flowy.swf.decision import base_identity, hedge_identity
 from flowy.swf.decision import task_key, timer_key
 
 
 class SWFExecutionHistory(object):
-    def __init__(self, running, timedout, results, errors, order):
+    def __init__(self, running, timedout, results, errors, order, index=None,
+                 result_cache=None, starts=None, now=None,
+                 cancel_requested=None, workflow_ids=None):
+        """Initialize the execution history.
+
+        An already built HistoryIndex can be passed, otherwise one is built
+        from the running/timedout/results/errors/order.
+
+        The result_cache, if set, is a DecodeCache shared between decisions
+        and used by the proxies to avoid decoding the same payloads again.
+
+        The starts map each identity to the times, in seconds since the epoch,
+        its tasks were scheduled and now is the time of the decision. They are
+        used to meter the tasks started per second; if now is missing the
+        current time is used. The cancel_requested are the ids of the tasks
+        whose cancellation was already requested and the workflow_ids map the
+        ids of the sub-workflows to their SWF workflow ids.
+        """
         self.running = running
         self.timedout = timedout
         self.results = results
         self.errors = errors
         self.order_ = order
+        if index is None:
+            index = HistoryIndex.from_sets(running, timedout, results, errors,
+                                           order)
+        self.index = index
+        self.result_cache = result_cache
+        if starts is None:
+            starts = {}
+        self.starts = starts
+        self.now = now
+        if cancel_requested is None:
+            cancel_requested = set()
+        self.cancel_requested = cancel_requested
+        if workflow_ids is None:
+            workflow_ids = {}
+        self.workflow_ids = workflow_ids
+        self._running_counts = None
+        self._timer_positions = None
+
+    def start_times(self, identity):
+        """Return the sorted times the tasks of a proxy were scheduled."""
+        return self.starts.get(identity, [])
+
+    def running_count(self, identity=None):
+        """Return the number of running tasks, of a proxy or in total.
+
+        The timers aren't tasks and aren't counted, the duplicates of hedged
+        tasks count for their proxy.
+        """
+        counts = self._running_counts
+        if counts is None:
+            counts = self._running_counts = {None: 0}
+            for call_key in self.running:
+                parsed = parse_task_key(call_key)
+                if parsed is None:  # a timer
+                    continue
+                identity = base_identity(parsed[0])
+                counts[None] += 1
+                counts[identity] = counts.get(identity, 0) + 1
+        return counts.get(identity, 0)
+
+    def retries(self, identity, call_number):
+        return self.index.retries(identity, call_number)
 
     def is_running(self, call_key):
         return str(call_key) in self.running
 
     def order(self, call_key):
-        return self.order_.index(str(call_key))
+        entry = self.index.get(call_key)
+        if entry is None or entry[1] is None:
+            return self.order_.index(str(call_key))
+        return entry[1]
 
     def has_result(self, call_key):
         return str(call_key) in self.results
@@ -36,12 +101,40 @@ class SWFExecutionHistory(object):
     def is_timer_running(self, call_key):
         return timer_key(call_key) in self.running
 
+    def timer_order(self, call_key):
+        """Return the finish order of a fired timer."""
+        positions = self._timer_positions
+        if positions is None:
+            positions = self._timer_positions = dict(
+                (k, i) for i, k in enumerate(self.order_) if k.endswith(':t'))
+        return positions[timer_key(call_key)]
+
+    def is_cancel_requested(self, call_key):
+        return str(call_key) in self.cancel_requested
+
+    def workflow_id(self, call_key):
+        """Return the SWF workflow id of a sub-workflow or None."""
+        return self.workflow_ids.get(str(call_key))
+
+    def running_tasks(self):
+        """Return the sorted ids of the running tasks, without the timers."""
+        return sorted(k for k in self.running if parse_task_key(k) is not None)
+
 
 class SWFTaskExecutionHistory(object):
     def __init__(self, exec_history, identity):
         self.exec_history = exec_history
         self.identity = identity
 
+    def retries(self, call_number):
+        """Return a mapping of retry_number -> (state, order, payload)."""
+        return self.exec_history.retries(self.identity, call_number)
+
+    def hedges(self, call_number):
+        """Return a mapping of retry_number -> the entry of its duplicate."""
+        return self.exec_history.retries(hedge_identity(self.identity),
+                                         call_number)
+
     def __getattr__(self, fname):
         """Compute the key and delegate to exec_history."""
         if fname not in ['is_running', 'is_timeout', 'is_error', 'has_result',
@@ -1,10 +1,60 @@
+import time
+
+from flowy.swf.decision import RateMeter
 from flowy.swf.decision import SWFActivityTaskDecision
 from flowy.swf.decision import SWFWorkflowTaskDecision
 from flowy.swf.history import SWFTaskExecutionHistory
 from flowy.proxy import Proxy
+from flowy.proxy import SleepProxy
+from flowy.serialization import is_raw_aware
 from flowy.utils import DescCounter
 
 
+def _result_cache(proxy_factory, execution_history):
+    """Return the result cache for the proxy, if there is one.
+
+    With the default deserializer, or that of a Serializer, all the results
+    of this proxy that aren't cached yet are decoded in a single parse.
+    """
+    cache = execution_history.result_cache
+    deserialize = proxy_factory.deserialize_result
+    if deserialize is None:
+        deserialize = Proxy.deserialize_result
+    if cache is not None and is_raw_aware(deserialize):
+        index = execution_history.index
+        cache.prefill(deserialize, index.results(proxy_factory.identity))
+    return cache
+
+
+def in_flight_counter(limit, execution_history, identity=None):
+    """Return a counter of the tasks that can still be scheduled.
+
+    The limit is the maximum number of tasks, of a proxy or in total, running
+    at the same time. The tasks already running, as recorded in the execution
+    history, take their positions first. A limit of None means no limit.
+    """
+    if limit is None:
+        return DescCounter()
+    running = execution_history.running_count(identity)
+    return DescCounter(max(limit - running, 0))
+
+
+def _dep_limits(proxy_factory, execution_history):
+    """Return the concurrency counter and the rate meter of the proxy."""
+    dep_rate_limit = rate_meter = None
+    identity = proxy_factory.identity
+    if proxy_factory.rate_limit is not None:
+        dep_rate_limit = in_flight_counter(proxy_factory.rate_limit,
+                                           execution_history, identity)
+    if proxy_factory.max_rate is not None:
+        now = execution_history.now
+        if now is None:
+            now = time.time()
+        rate_meter = RateMeter(proxy_factory.max_rate,
+                               execution_history.start_times(identity), now)
+    return dep_rate_limit, rate_meter
+
+
 class SWFActivityProxyFactory(object):
     """A proxy factory for activities."""
 
@@ -16,7 +66,10 @@ class SWFActivityProxyFactory(object):
                  start_to_close=None,
                  retry=(0, 0, 0),
                  serialize_input=None,
-                 deserialize_result=None):
+                 deserialize_result=None,
+                 rate_limit=None,
+                 max_rate=None,
+                 hedge=None):
         # This is a unique name used to generate unique identifiers
         self.identity = identity
         self.name = name
@@ -29,13 +82,22 @@ class SWFActivityProxyFactory(object):
         self.retry = retry
         self.serialize_input = serialize_input
         self.deserialize_result = deserialize_result
+        self.rate_limit = rate_limit
+        self.max_rate = max_rate
+        self.hedge = hedge
 
-    def __call__(self, decision, execution_history, rate_limit=DescCounter()):
+    def __call__(self, decision, execution_history, rate_limit=DescCounter(),
+                 cancel_abandoned=False):
         """Instantiate Proxy."""
         task_exec_hist = SWFTaskExecutionHistory(execution_history, self.identity)
-        task_decision = SWFActivityTaskDecision(decision, execution_history, self, rate_limit)
+        dep_rate_limit, rate_meter = _dep_limits(self, execution_history)
+        task_decision = SWFActivityTaskDecision(decision, execution_history, self,
+                                                rate_limit, dep_rate_limit,
+                                                rate_meter)
         return Proxy(task_exec_hist, task_decision, self.retry,
-                     self.serialize_input, self.deserialize_result)
+                     self.serialize_input, self.deserialize_result,
+                     _result_cache(self, execution_history), self.hedge,
+                     cancel_abandoned)
 
 
 class SWFWorkflowProxyFactory(object):
@@ -48,7 +110,9 @@ class SWFWorkflowProxyFactory(object):
                  child_policy=None,
                  retry=(0, 0, 0),
                  serialize_input=None,
-                 deserialize_result=None):
+                 deserialize_result=None,
+                 rate_limit=None,
+                 max_rate=None):
         self.identity = identity
         self.name = name
         self.version = version
@@ -59,10 +123,29 @@ class SWFWorkflowProxyFactory(object):
         self.retry = retry
         self.serialize_input = serialize_input
         self.deserialize_result = deserialize_result
+        self.rate_limit = rate_limit
+        self.max_rate = max_rate
 
-    def __call__(self, decision, execution_history, rate_limit):
+    def __call__(self, decision, execution_history, rate_limit,
+                 cancel_abandoned=False):
         """Instantiate Proxy."""
         task_exec_hist = SWFTaskExecutionHistory(execution_history, self.identity)
-        task_decision = SWFWorkflowTaskDecision(decision, execution_history, self, rate_limit)
+        dep_rate_limit, rate_meter = _dep_limits(self, execution_history)
+        task_decision = SWFWorkflowTaskDecision(decision, execution_history, self,
+                                                rate_limit, dep_rate_limit,
+                                                rate_meter)
         return Proxy(task_exec_hist, task_decision, self.retry,
-                     self.serialize_input, self.deserialize_result)
+                     self.serialize_input, self.deserialize_result,
+                     _result_cache(self, execution_history),
+                     cancel_abandoned=cancel_abandoned)
+
+
+class SWFTimerProxyFactory(object):
+    """A proxy factory for sleeping on SWF timers."""
+
+    def __init__(self, identity):
+        self.identity = identity
+
+    def __call__(self, decision, execution_history, *extra_args):
+        """Instantiate SleepProxy."""
+        return SleepProxy(self.identity, execution_history, decision)
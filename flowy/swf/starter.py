@@ -1,7 +1,14 @@
+import collections
+import threading
+import time
 import uuid
 
 from boto.exception import SWFResponseError
+from boto.swf.exceptions import SWFWorkflowExecutionAlreadyStartedError
 from boto.swf.layer1 import Layer1
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 
 from flowy.swf.config import cp_encode
 from flowy.swf.decision import INPUT_SIZE
@@ -10,6 +17,14 @@ from flowy.utils import str_or_none
 from flowy.proxy import Proxy
 
 
+__all__ = ['SWFWorkflowStarter', 'StartResult']
+
+
+# The outcome of starting one of the inputs of start_many. The status is one
+# of 'started', 'already_started' or 'failed'.
+StartResult = collections.namedtuple('StartResult', 'wid run_id status error')
+
+
 def SWFWorkflowStarter(domain, name, version,
                        layer1=None,
                        task_list=None,
@@ -23,13 +38,11 @@ def SWFWorkflowStarter(domain, name, version,
 
     The callable should be called only with the input arguments and will
     start the workflow.
+
+    The callable also has a start_many attribute, see _start_many, to start
+    many workflows with the same configuration.
     """
-    def really_start(*args, **kwargs):
-        """Use this function to start a workflow by passing in the args."""
-        l1 = layer1 if layer1 is not None else Layer1()
-        l_wid = wid  # closue hack
-        if l_wid is None:
-            l_wid = uuid.uuid4()
+    def encode_input(args, kwargs):
         if serialize_input is None:
             input_data = Proxy.serialize_input(*args, **kwargs)
         else:
@@ -37,23 +50,112 @@ def SWFWorkflowStarter(domain, name, version,
         if len(input_data) > INPUT_SIZE:
             logger.error("Input too large: %s/%s" % (len(input_data), INPUT_SIZE))
             raise ValueError('Input too large.')
+        return input_data
+
+    def start(l1, l_wid, input_data):
+        r = l1.start_workflow_execution(
+            str(domain), str(l_wid), str(name), str(version),
+            task_list=str_or_none(task_list),
+            execution_start_to_close_timeout=str_or_none(workflow_duration),
+            task_start_to_close_timeout=str_or_none(decision_duration),
+            input=str(input_data),
+            child_policy=cp_encode(child_policy),
+            tag_list=tags_encode(tags))
+        return r['runId']
+
+    def really_start(*args, **kwargs):
+        """Use this function to start a workflow by passing in the args."""
+        l1 = layer1 if layer1 is not None else Layer1()
+        l_wid = wid  # closue hack
+        if l_wid is None:
+            l_wid = uuid.uuid4()
+        input_data = encode_input(args, kwargs)
         try:
-            r = l1.start_workflow_execution(
-                str(domain), str(l_wid), str(name), str(version),
-                task_list=str_or_none(task_list),
-                execution_start_to_close_timeout=str_or_none(workflow_duration),
-                task_start_to_close_timeout=str_or_none(decision_duration),
-                input=str(input_data),
-                child_policy=cp_encode(child_policy),
-                tag_list=tags_encode(tags))
+            return start(l1, l_wid, input_data)
         except SWFResponseError:
             logger.exception('Error while starting the workflow:')
             raise RuntimeError('Cannot start the workflow.')
-        return r['runId']
 
+    def start_one(l1, item):
+        l_wid = item.get('wid')
+        if l_wid is None:
+            l_wid = uuid.uuid4()
+        try:
+            input_data = encode_input(item.get('args', []),
+                                      item.get('kwargs', {}))
+            run_id = start(l1, l_wid, input_data)
+        except SWFWorkflowExecutionAlreadyStartedError:
+            return StartResult(str(l_wid), None, 'already_started', None)
+        except Exception as e:
+            return StartResult(str(l_wid), None, 'failed', str(e))
+        return StartResult(str(l_wid), run_id, 'started', None)
+
+    def start_many(inputs, concurrency=8):
+        return _start_many(start_one, inputs, concurrency, layer1)
+
+    really_start.start_many = start_many
     return really_start
 
 
+def _start_many(start_one, inputs, concurrency=8, layer1=None):
+    """Start a workflow for each input, concurrency starts at a time.
+
+    Each input is a dict with optional args, kwargs and wid (workflow id)
+    keys. Inputs without a wid get a random one; set it to make retrying a
+    batch safe, since the inputs that were already started are reported as
+    such instead of failing.
+
+    The requests are made from a pool of threads, each with its own SWF
+    client unless one is passed in layer1. The inputs are consumed lazily, so
+    they can come from a large file.
+
+    Returns a list with a StartResult for each input, in the input order. The
+    failures and the throughput are logged.
+    """
+    concurrency = max(int(concurrency), 1)
+    clients = threading.local()
+
+    def start_in_thread(item):
+        l1 = layer1
+        if l1 is None:
+            l1 = getattr(clients, 'layer1', None)
+            if l1 is None:
+                l1 = clients.layer1 = Layer1()
+        return start_one(l1, item)
+
+    results = []
+    pending = {}
+    begin = time.time()
+
+    def collect(futures):
+        for future in futures:
+            index = pending.pop(future)
+            result = results[index] = future.result()
+            if result.status == 'failed':
+                logger.error('Cannot start input %s (%s): %s',
+                             index, result.wid, result.error)
+
+    executor = ThreadPoolExecutor(concurrency)
+    try:
+        for index, item in enumerate(inputs):
+            # Keep enough requests queued for the threads to never wait
+            while len(pending) >= concurrency * 2:
+                done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+                collect(done)
+            results.append(None)
+            pending[executor.submit(start_in_thread, item)] = index
+        collect(wait(list(pending))[0])
+    finally:
+        executor.shutdown(wait=True)
+    duration = time.time() - begin
+    statuses = collections.Counter(r.status for r in results)
+    logger.info('Started %s workflows in %.1fs (%.1f/s): %s already started, '
+                '%s failed', statuses['started'], duration,
+                len(results) / duration if duration > 0 else 0.0,
+                statuses['already_started'], statuses['failed'])
+    return results
+
+
 def tags_encode(tags):
     if tags is None:
         return None
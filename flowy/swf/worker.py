@@ -1,14 +1,38 @@
+import collections
+import functools
+import heapq
+import itertools
+import multiprocessing
 import os
+import signal
 import socket
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 import venusian
 from boto.exception import SWFResponseError
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
 from boto.swf.layer1 import Layer1
 
+from flowy.swf.decision import base_identity
 from flowy.swf.decision import SWFActivityDecision
 from flowy.swf.decision import SWFWorkflowDecision
+from flowy.history import ERROR
+from flowy.history import HistoryIndex
+from flowy.history import parse_task_key
+from flowy.history import RESULT
+from flowy.history import RUNNING
+from flowy.history import TIMEDOUT
 from flowy.swf.history import SWFExecutionHistory
+from flowy.serialization import DecodeCache
 from flowy.utils import logger
+from flowy.utils import LRUCache
 from flowy.utils import setup_default_logger
 from flowy.utils import str_or_none
 from flowy.worker import Worker
@@ -18,6 +42,7 @@ __all__ = ['SWFWorkflowWorker', 'SWFActivityWorker']
 
 
 _IDENTITY_SIZE = 256
+_MAX_PAGE_SIZE = 1000
 
 
 class SWFWorker(Worker):
@@ -49,6 +74,7 @@ class SWFWorker(Worker):
 
 class SWFWorkflowWorker(SWFWorker):
     categories = ['swf_workflow']
+    result_cache = None  # set by run_forever
 
     # Be explicit about what arguments are expected
     def __call__(self, name, version, input_data, decision, execution_history):
@@ -64,8 +90,13 @@ class SWFWorkflowWorker(SWFWorker):
                     layer1=None,
                     setup_log=True,
                     register_remote=True,
-                    identity=None):
-        """Start an endless single threaded/single process worker loop.
+                    identity=None,
+                    history_cache_size=0,
+                    result_cache_size=0,
+                    prefetch_pages=0,
+                    pollers=1,
+                    mode='thread'):
+        """Start an endless worker loop or a pool of worker loops.
 
         The worker polls endlessly for new decisions from the specified domain
         and task list and runs them.
@@ -81,28 +112,126 @@ class SWFWorkflowWorker(SWFWorker):
         A custom SWF client can be passed in layer1, otherwise a default client
         is used.
 
+        If history_cache_size is set, the parsed histories of that many
+        workflow executions are kept between decisions, so that only the new
+        events are downloaded and parsed.
+
+        If result_cache_size is set, the decoded results and workflow inputs
+        whose payloads add up to that many characters are kept between
+        decisions, keyed by their payload, so that they don't have to be
+        decoded again on every decision. The new results are decoded in bulk.
+        Each decision gets its own copy of the mutable values. The cache is
+        available as the result_cache attribute and its hits and misses are
+        logged along with the poller utilisation.
+
+        If prefetch_pages is set, the history is requested in pages of the
+        maximum size and up to that many pages are loaded on a background
+        thread while the previous ones are parsed. The page latencies are
+        logged along with the poller utilisation.
+
+        If pollers is greater than one, that many poll/decide/respond loops
+        run concurrently, as threads or processes depending on the mode. The
+        remote registration happens only once, before the loops are started.
+        Each loop creates its own default SWF client; in thread mode a client
+        passed in layer1 is shared and must be thread safe. In thread mode
+        the loops share the history and result caches, in process mode each
+        loop creates its own and the worker, with its workflows and their
+        configs, must be picklable unless the processes are forked. Each
+        loop logs its utilisation periodically and when it exits. On
+        KeyboardInterrupt the loops finish the decision they are working on,
+        or the poll request in progress, and exit; a second KeyboardInterrupt
+        exits without waiting for them.
         """
         if setup_log:
             setup_default_logger()
         identity = identity if identity is not None else default_identity()
         identity = str(identity)[:_IDENTITY_SIZE]
+        custom_layer1 = layer1
         layer1 = layer1 if layer1 is not None else Layer1()
         if register_remote:
             self.register_remote(layer1, domain)
+        history_cache = None
+        if history_cache_size:
+            history_cache = LRUCache(history_cache_size)
+        result_cache = None
+        if result_cache_size:
+            result_cache = DecodeCache(result_cache_size)
+        if pollers <= 1:
+            self.result_cache = result_cache
+            try:
+                self._decision_loop(domain, task_list, layer1, identity,
+                                    history_cache, result_cache,
+                                    prefetch_pages)
+            except KeyboardInterrupt:
+                pass
+            return
+        layer1 = custom_layer1  # boto clients can't be used concurrently
+        if mode == 'process':
+            layer1 = history_cache = result_cache = None  # created in each process
+        self.result_cache = result_cache
+        # Not a closure, the loop is pickled for the poller processes
+        loop = functools.partial(_poller_loop, self, domain, task_list, layer1,
+                                 identity, history_cache, history_cache_size,
+                                 result_cache, result_cache_size,
+                                 prefetch_pages)
+        run_pollers(loop, pollers, mode)
+
+    def _decision_loop(self, domain, task_list, layer1, identity,
+                       history_cache=None, result_cache=None,
+                       prefetch_pages=0, stop=None):
+        stats = PollerStats(identity, result_cache)
         try:
             while 1:
-                if self.break_loop():
+                if self.break_loop() or stop is not None and stop.is_set():
                     break
-                name, version, input_data, exec_history, decision = poll_decision(
-                    layer1, domain, task_list, identity)
+                polled = poll_decision(layer1, domain, task_list, identity,
+                                       history_cache, result_cache,
+                                       prefetch_pages, stats, stop)
+                if polled is None:
+                    break  # stopped while polling
+                name, version, input_data, exec_history, decision = polled
+                start = time.time()
                 self(name, version, input_data, decision, exec_history)
-        except KeyboardInterrupt:
-            pass
+                stats.record(time.time() - start)
+        finally:
+            stats.report()
+
+
+def _poller_loop(worker, domain, task_list, layer1, identity, history_cache,
+                 history_cache_size, result_cache, result_cache_size,
+                 prefetch_pages, number, stop):
+    """Run the decision loop of a poller in a pool.
+
+    The client and the caches that aren't shared are created by each poller.
+    """
+    identity = poller_identity(identity, number)
+    if layer1 is None:
+        layer1 = Layer1()
+    if history_cache is None and history_cache_size:
+        history_cache = LRUCache(history_cache_size)
+    if result_cache is None and result_cache_size:
+        result_cache = DecodeCache(result_cache_size)
+    worker._decision_loop(domain, task_list, layer1, identity, history_cache,
+                          result_cache, prefetch_pages, stop)
 
 
 class SWFActivityWorker(SWFWorker):
     categories = ['swf_activity']
 
+    def __init__(self, *args, **kwargs):
+        super(SWFActivityWorker, self).__init__(*args, **kwargs)
+        self.default_heartbeats = {}
+
+    def set_default_heartbeat(self, key, heartbeat):
+        """Set the registered default heartbeat timeout for an activity."""
+        self.default_heartbeats[key] = heartbeat
+
+    def make_scanner(self):
+        return venusian.Scanner(
+            register_task=self.register_task,
+            add_remote_reg_callback=self.add_remote_reg_callback,
+            set_default_heartbeat=self.set_default_heartbeat)
+
     #Be explicit about what arguments are expected
     def __call__(self, name, version, input_data, decision):
         # No extra arguments are used
@@ -118,35 +247,392 @@ class SWFActivityWorker(SWFWorker):
                     layer1=None,
                     setup_log=True,
                     register_remote=True,
-                    identity=None):
-        """Same as SWFWorkflowWorker.run_forever but for activities."""
+                    identity=None,
+                    max_in_flight=1,
+                    mode='thread',
+                    limits=None,
+                    auto_heartbeat=None):
+        """Same as SWFWorkflowWorker.run_forever but for activities.
+
+        If max_in_flight is greater than one, up to that many activities run
+        concurrently on a pool of threads, for I/O bound activities, or
+        processes, for CPU bound activities, depending on the mode. A new task
+        is polled only when there is a free slot to run it, so tasks are never
+        taken only to wait for capacity.
+
+        The limits is an optional mapping of activity names or (name, version)
+        pairs to the maximum number of concurrent activities of that type.
+        Because SWF doesn't allow polling for a specific activity type, a task
+        that exceeds its limit waits for a task of the same type to finish,
+        while holding its slot. Use different task lists for strict isolation.
+
+        Each thread, including the ones running the activities and sending
+        the heartbeats, uses its own default SWF client; a client passed in
+        layer1 is shared and must be thread safe. In process mode the
+        activities and their arguments must be picklable and the heartbeats
+        are sent using a default client in each process.
+
+        If auto_heartbeat is set, it is a fraction of the registered default
+        heartbeat timeout, like 0.25. At that interval, heartbeats are sent in
+        the background for every running activity with a default heartbeat
+        timeout. The heartbeat calls made by the activities are coalesced over
+        the same interval. The heartbeat returns False after the cancellation
+        of the activity was requested and an activity failing afterwards is
+        reported as canceled.
+        """
         if setup_log:
             setup_default_logger()
         identity = identity if identity is not None else default_identity()
         identity = str(identity)[:_IDENTITY_SIZE]
-        layer1 = layer1 if layer1 is not None else Layer1()
+        # boto clients can't be used concurrently
+        layer1 = layer1 if layer1 is not None else ThreadLocalLayer1()
         if register_remote:
             self.register_remote(layer1, domain)
+        heartbeater = None
+        if auto_heartbeat:
+            heartbeater = Heartbeater(auto_heartbeat)
+        if max_in_flight <= 1 and not limits:
+            try:
+                while 1:
+                    if self.break_loop():
+                        break
+                    swf_response = poll_activity(layer1, domain, task_list,
+                                                 identity)
+                    at = swf_response['activityType']
+                    decision = self.make_decision(layer1, swf_response,
+                                                  heartbeater)
+                    self(at['name'], at['version'], swf_response['input'],
+                         decision)
+            except KeyboardInterrupt:
+                pass
+            return
+        if mode == 'thread':
+            executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        elif mode == 'process':
+            executor = ProcessPoolExecutor(max_workers=max_in_flight)
+        else:
+            raise ValueError('Invalid execution mode: %r' % (mode, ))
+        pool = BoundedExecutor(executor, max_in_flight, limits)
         try:
             while 1:
+                pool.wait_for_slot()
                 if self.break_loop():
+                    pool.release_slot()
                     break
-                swf_response = {}
-                while ('taskToken' not in swf_response or not swf_response['taskToken']):
-                    try:
-                        swf_response = layer1.poll_for_activity_task(
-                            domain=domain,
-                            task_list=task_list,
-                            identity=identity)
-                    except SWFResponseError:
-                        # add a delay before retrying?
-                        logger.exception('Error while polling for activities:')
-
-                at = swf_response['activityType']
-                decision = SWFActivityDecision(layer1, swf_response['taskToken'])
-                self(at['name'], at['version'], swf_response['input'], decision)
+                swf_response = poll_activity(layer1, domain, task_list, identity)
+                self.submit(pool, mode, layer1, swf_response, heartbeater)
         except KeyboardInterrupt:
-            pass
+            logger.info('Waiting for the running activities to finish.')
+        finally:
+            executor.shutdown(wait=True)
+
+    def make_decision(self, layer1, swf_response, heartbeater=None):
+        """Create the decision for a task, with optional auto heartbeats."""
+        at = swf_response['activityType']
+        default_heartbeat = self.default_heartbeats.get(
+            (str(at['name']), str(at['version'])))
+        if heartbeater is None or not default_heartbeat:
+            return SWFActivityDecision(layer1, swf_response['taskToken'])
+        interval = float(default_heartbeat) * heartbeater.fraction
+        decision = SWFActivityDecision(layer1, swf_response['taskToken'],
+                                       interval)
+        heartbeater.add(decision)
+        return decision
+
+    def submit(self, pool, mode, layer1, swf_response, heartbeater=None):
+        """Submit a polled activity task to the pool, releasing its slot."""
+        at = swf_response['activityType']
+        name, version = str(at['name']), str(at['version'])
+        if (name, version) not in self.registry:
+            logger.error("Could not find implementation for key: %r",
+                         ((name, version),))
+            pool.release_slot()
+            return  # Let it timeout
+        decision = self.make_decision(layer1, swf_response, heartbeater)
+        if mode == 'thread':
+            pool.submit((name, version), self,
+                        (name, version, swf_response['input'], decision))
+        else:
+            heartbeat = functools.partial(_process_heartbeat,
+                                          str(decision.token),
+                                          decision.heartbeat_interval)
+            pool.submit((name, version), _call_ignoring_sigint,
+                        (self.registry[(name, version)], swf_response['input'],
+                         heartbeat),
+                        callback=functools.partial(_finish_activity, decision))
+
+
+class ThreadLocalLayer1(object):
+    """An SWF client that delegates to a default client for each thread."""
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def __getattr__(self, name):
+        layer1 = getattr(self.local, 'layer1', None)
+        if layer1 is None:
+            layer1 = self.local.layer1 = Layer1()
+        return getattr(layer1, name)
+
+
+class BoundedExecutor(object):
+    """Run tasks on an executor with a bounded number of tasks in flight.
+
+    A slot must be reserved with wait_for_slot before each task is submitted.
+    Tasks whose type reached its limit wait, in order, for a task with the
+    same type to finish. The limits map task types, either (name, version)
+    pairs or only the name, to their maximum concurrency.
+    """
+
+    def __init__(self, executor, max_in_flight, limits=None):
+        self.executor = executor
+        self.max_in_flight = max(int(max_in_flight), 1)
+        self.limits = dict(limits or {})
+        self.in_flight = 0
+        self.running = collections.defaultdict(int)
+        self.pending = collections.defaultdict(collections.deque)
+        self.lock = threading.Condition()
+
+    def wait_for_slot(self):
+        """Block until a slot is free and reserve it."""
+        with self.lock:
+            while self.in_flight >= self.max_in_flight:
+                self.lock.wait(1)  # a timeout keeps KeyboardInterrupt working
+            self.in_flight += 1
+
+    def release_slot(self):
+        with self.lock:
+            self.in_flight -= 1
+            self.lock.notify()
+
+    def limit(self, key):
+        name, _ = key
+        return self.limits.get(key, self.limits.get(name))
+
+    def submit(self, key, func, args, callback=None):
+        """Run func(*args) using a reserved slot, when its type allows it."""
+        with self.lock:
+            limit = self.limit(key)
+            if limit is not None and self.running[key] >= limit:
+                self.pending[key].append((func, args, callback))
+                return
+            self.running[key] += 1
+        self._submit(key, func, args, callback)
+
+    def _submit(self, key, func, args, callback):
+        try:
+            future = self.executor.submit(func, *args)
+        except RuntimeError:
+            logger.exception('Cannot submit the task:')
+            self._done(key, None)
+            return
+        if callback is not None:
+            future.add_done_callback(callback)
+        future.add_done_callback(functools.partial(self._done, key))
+
+    def _done(self, key, _future):
+        next_task = None
+        with self.lock:
+            if self.pending[key]:
+                next_task = self.pending[key].popleft()
+            else:
+                self.running[key] -= 1
+            self.in_flight -= 1
+            self.lock.notify()
+        if next_task is not None:
+            self._submit(key, *next_task)
+
+
+def poll_activity(layer1, domain, task_list, identity=None):
+    """Poll for an activity task until a valid response is received."""
+    swf_response = {}
+    while ('taskToken' not in swf_response or not swf_response['taskToken']):
+        try:
+            swf_response = layer1.poll_for_activity_task(
+                domain=domain,
+                task_list=task_list,
+                identity=identity)
+        except SWFResponseError:
+            # add a delay before retrying?
+            logger.exception('Error while polling for activities:')
+    return swf_response
+
+
+def _call_ignoring_sigint(func, *args):
+    # The parent process handles KeyboardInterrupt and waits for the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    return func(*args)
+
+
+_process_layer1 = None
+_process_decision = None
+
+
+def _process_heartbeat(token, heartbeat_interval=None):
+    global _process_layer1, _process_decision
+    if _process_layer1 is None:
+        _process_layer1 = Layer1()
+    if _process_decision is None or _process_decision.token != token:
+        # Keep the decision of the current task to coalesce its heartbeats
+        _process_decision = SWFActivityDecision(_process_layer1, token,
+                                                heartbeat_interval)
+    return _process_decision.heartbeat()
+
+
+class Heartbeater(object):
+    """Send heartbeats in the background for all the running activities.
+
+    A single daemon thread sends the heartbeats for all the decisions added,
+    every decision.heartbeat_interval seconds, until the decisions are closed.
+    Heartbeats sent by the activities themselves postpone the next one.
+    """
+
+    def __init__(self, fraction):
+        self.fraction = float(fraction)
+        self.heap = []
+        self.counter = itertools.count()
+        self.lock = threading.Condition()
+        self.thread = None
+
+    def add(self, decision):
+        due = time.time() + decision.heartbeat_interval
+        with self.lock:
+            heapq.heappush(self.heap, (due, next(self.counter), decision))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.lock.notify()
+
+    def run(self):
+        while 1:
+            with self.lock:
+                while not self.heap:
+                    self.lock.wait()
+                due, _, decision = self.heap[0]
+                now = time.time()
+                if due > now:
+                    self.lock.wait(due - now)
+                    continue
+                heapq.heappop(self.heap)
+            if decision.closed:
+                continue
+            last = decision.last_heartbeat
+            if last is None or time.time() - last >= decision.heartbeat_interval:
+                decision.send_heartbeat()
+                last = decision.last_heartbeat
+            if decision.closed or last is None:
+                continue
+            with self.lock:
+                heapq.heappush(self.heap, (last + decision.heartbeat_interval,
+                                           next(self.counter), decision))
+
+
+def _finish_activity(decision, future):
+    try:
+        result = future.result()
+    except Exception as e:
+        logger.error('Unhandled exception in task: %s', e)
+        decision.fail(e)
+    else:
+        decision.finish(result)
+
+
+def run_pollers(loop, pollers, mode='thread'):
+    """Run a number of poller loops concurrently, until all of them exit.
+
+    Each loop is called as loop(number, stop), where stop is an event that is
+    set when the pool must shut down. The mode can be either 'thread' or
+    'process'.
+    """
+    if mode == 'thread':
+        stop = threading.Event()
+        workers = [threading.Thread(target=_run_poller, args=(loop, i, stop))
+                   for i in range(pollers)]
+    elif mode == 'process':
+        stop = multiprocessing.Event()
+        workers = [multiprocessing.Process(target=_run_poller,
+                                           args=(loop, i, stop, True))
+                   for i in range(pollers)]
+    else:
+        raise ValueError('Invalid poller mode: %r' % (mode, ))
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    try:
+        while any(worker.is_alive() for worker in workers):
+            for worker in workers:
+                worker.join(1)
+    except KeyboardInterrupt:
+        logger.info('Waiting for the pollers to finish their current tasks.')
+        stop.set()
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            logger.info('Exiting without waiting for the pollers.')
+
+
+def _run_poller(loop, number, stop, ignore_sigint=False):
+    if ignore_sigint:
+        # The parent process sets the stop event instead
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        loop(number, stop)
+    except Exception:
+        logger.exception('Unhandled exception in poller %s:', number)
+
+
+class PollerStats(object):
+    """Track the fraction of time a poller loop spends running tasks."""
+
+    report_interval = 60  # seconds
+
+    def __init__(self, name, result_cache=None):
+        self.name = name
+        self.result_cache = result_cache
+        self.start = self.last_report = time.time()
+        self.busy = 0.0
+        self.tasks = 0
+        self.pages = 0
+        self.page_latency = 0.0
+
+    def record(self, duration):
+        """Record a finished task and report if enough time has passed."""
+        self.busy += duration
+        self.tasks += 1
+        if time.time() - self.last_report >= self.report_interval:
+            self.report()
+
+    def record_pages(self, latencies):
+        """Record the latencies of the history pages loaded for a task."""
+        self.pages += len(latencies)
+        self.page_latency += sum(latencies)
+
+    def utilisation(self):
+        elapsed = time.time() - self.start
+        if elapsed <= 0:
+            return 0.0
+        return min(self.busy / elapsed, 1.0)
+
+    def report(self):
+        self.last_report = time.time()
+        logger.info('Poller %s: %s tasks, %.1f%% utilisation',
+                    self.name, self.tasks, self.utilisation() * 100)
+        if self.result_cache is not None:
+            logger.info('Poller %s: result cache %s hits, %s misses',
+                        self.name, self.result_cache.hits,
+                        self.result_cache.misses)
+        if self.pages:
+            logger.info('Poller %s: %s history pages, %.1fms average latency',
+                        self.name, self.pages,
+                        self.page_latency / self.pages * 1000)
+
+
+def poller_identity(identity, number):
+    """Derive an unique identity for each poller in a pool."""
+    suffix = '-%s' % number
+    return identity[:_IDENTITY_SIZE - len(suffix)] + suffix
 
 
 def default_identity():
@@ -155,59 +641,105 @@ def default_identity():
     return identity[-_IDENTITY_SIZE:]  # keep the most important part
 
 
-def poll_decision(layer1, domain, task_list, identity=None):
-    """Poll a decision and create a SWFWorkflowContext instance."""
-    first_page = poll_first_page(layer1, domain, task_list, identity)
+def poll_decision(layer1, domain, task_list, identity=None, history_cache=None,
+                  result_cache=None, prefetch_pages=0, stats=None, stop=None):
+    """Poll a decision and create a SWFWorkflowContext instance.
+
+    If a stop event is passed and it's set while polling, None is returned.
+
+    If a history_cache is passed, the history is paged in reverse order and
+    only the events newer than the cached parsed history are applied to it.
+    Cache misses and mismatches fall back on loading the entire history.
+
+    The result_cache, if passed, is attached to the execution history.
+
+    If prefetch_pages is set, the pages have the maximum size and are loaded
+    ahead by a PagePrefetcher. Their latencies are recorded in the stats.
+    """
+    reverse_order = history_cache is not None
+    page_size = _MAX_PAGE_SIZE if prefetch_pages else None
+    first_page = poll_first_page(layer1, domain, task_list, identity,
+                                 reverse_order=reverse_order,
+                                 page_size=page_size, stop=stop)
+    if first_page is None:
+        return None
     token = first_page['taskToken']
-    all_events = events(layer1, domain, task_list, first_page, identity)
-    # Sometimes the first event in on the second page,
-    # and the first page is empty
-    first_event = next(all_events)
-    assert first_event['eventType'] == 'WorkflowExecutionStarted'
-    wesea = 'workflowExecutionStartedEventAttributes'
-    assert first_event[wesea]['taskList']['name'] == task_list
-    decision_duration = first_event[wesea]['taskStartToCloseTimeout']
-    workflow_duration = first_event[wesea]['executionStartToCloseTimeout']
-    tags = first_event[wesea].get('tagList', None)
-    child_policy = first_event[wesea]['childPolicy']
-    name = first_event[wesea]['workflowType']['name']
-    version = first_event[wesea]['workflowType']['version']
-    input_data = first_event[wesea]['input']
+    if prefetch_pages:
+        fetch = functools.partial(poll_response_page, layer1, domain,
+                                  task_list, identity=identity,
+                                  reverse_order=reverse_order,
+                                  page_size=page_size)
+        prefetcher = PagePrefetcher(fetch, first_page, prefetch_pages)
+        all_events = prefetcher.events()
+    else:
+        all_events = events(layer1, domain, task_list, first_page, identity,
+                            reverse_order=reverse_order)
     try:
-        running, timedout, results, errors, order = load_events(all_events)
+        if history_cache is None:
+            history = load_history(all_events)
+        else:
+            run_key = _run_key(first_page)
+            history = load_history_tail(all_events, history_cache.get(run_key))
+            history_cache.put(run_key, history)
     except _PaginationError:
         # There's nothing better to do than to retry
-        return poll_decision(layer1, task_list, domain, identity)
-    execution_history = SWFExecutionHistory(running, timedout, results, errors, order)
+        return poll_decision(layer1, domain, task_list, identity, history_cache,
+                             result_cache, prefetch_pages, stats, stop)
+    finally:
+        all_events.close()  # stop loading pages that aren't needed anymore
+    if prefetch_pages and stats is not None:
+        stats.record_pages(prefetcher.latencies)
+    started = history.started
+    assert started['taskList']['name'] == task_list
+    decision_duration = started['taskStartToCloseTimeout']
+    workflow_duration = started['executionStartToCloseTimeout']
+    tags = started.get('tagList', None)
+    child_policy = started['childPolicy']
+    name = started['workflowType']['name']
+    version = started['workflowType']['version']
+    input_data = started['input']
+    execution_history = SWFExecutionHistory(
+        history.running, history.timedout, history.results, history.errors,
+        history.order, history.index, result_cache, history.starts,
+        history.now, history.cancel_requested, history.workflow_ids)
     decision = SWFWorkflowDecision(layer1, token, name, version, task_list,
                                    decision_duration, workflow_duration, tags,
                                    child_policy)
     return name, version, input_data, execution_history, decision
 
 
-def poll_first_page(layer1, domain, task_list, identity=None):
+def poll_first_page(layer1, domain, task_list, identity=None,
+                    reverse_order=False, page_size=None, stop=None):
     """Return the response from loading the first page.
 
-    In case of errors, empty responses or whatnot retry until a valid response.
+    In case of errors, empty responses or whatnot retry until a valid response
+    or, if a stop event is passed, until it's set and then return None.
     """
     swf_response = {}
     while 'taskToken' not in swf_response or not swf_response['taskToken']:
+        if stop is not None and stop.is_set():
+            return None
         try:
             swf_response = layer1.poll_for_decision_task(
-                str(domain), str(task_list), str_or_none(identity))
+                str(domain), str(task_list), str_or_none(identity),
+                maximum_page_size=page_size,
+                reverse_order=reverse_order or None)
         except SWFResponseError:
             logger.exception('Error while polling for decisions:')
     return swf_response
 
 
-def poll_response_page(layer1, domain, task_list, token, identity=None):
+def poll_response_page(layer1, domain, task_list, token, identity=None,
+                       reverse_order=False, page_size=None):
     """Return a specific page. In case of errors retry a number of times."""
     swf_response = None
     for _ in range(7):  # give up after a limited number of retries
         try:
             swf_response = layer1.poll_for_decision_task(
                 str(domain), str(task_list), str_or_none(identity),
-                next_page_token=str(token))
+                maximum_page_size=page_size,
+                next_page_token=str(token),
+                reverse_order=reverse_order or None)
             break
         except SWFResponseError:
             logger.exception('Error while polling for decision page:')
@@ -216,7 +748,8 @@ def poll_response_page(layer1, domain, task_list, token, identity=None):
     return swf_response
 
 
-def events(layer1, domain, task_list, first_page, identity=None):
+def events(layer1, domain, task_list, first_page, identity=None,
+           reverse_order=False):
     """Load pages one by one and generate all events found."""
     page = first_page
     while 1:
@@ -225,7 +758,71 @@ def events(layer1, domain, task_list, first_page, identity=None):
         if not page.get('nextPageToken'):
             break
         page = poll_response_page(layer1, domain, task_list,
-                                  page['nextPageToken'], identity)
+                                  page['nextPageToken'], identity,
+                                  reverse_order=reverse_order)
+
+
+class PagePrefetcher(object):
+    """Load the history pages on a background thread, ahead of the parsing.
+
+    The fetch callable loads the page for a next page token. Up to depth
+    pages are loaded ahead of the consumer and the latency of each page is
+    recorded in latencies.
+    """
+
+    def __init__(self, fetch, first_page, depth=1):
+        self.fetch = fetch
+        self.first_page = first_page
+        self.pages = queue.Queue(max(int(depth), 1))
+        self.latencies = []
+        self.stopped = threading.Event()
+
+    def events(self):
+        """Generate all the events; close it to stop loading pages."""
+        page = self.first_page
+        thread = None
+        if page.get('nextPageToken'):
+            thread = threading.Thread(target=self._load_pages,
+                                      args=(page['nextPageToken'],))
+            thread.daemon = True
+            thread.start()
+        try:
+            while 1:
+                for event in page['events']:
+                    yield event
+                if not page.get('nextPageToken'):
+                    break
+                page = self.pages.get()
+                if isinstance(page, Exception):
+                    raise page
+        finally:
+            self.stopped.set()
+            if thread is not None:
+                try:
+                    self.pages.get_nowait()  # unblock a pending put
+                except queue.Empty:
+                    pass
+                thread.join()
+
+    def _load_pages(self, token):
+        while token and not self.stopped.is_set():
+            start = time.time()
+            try:
+                page = self.fetch(token)
+            except Exception as e:
+                self._put(e)
+                return
+            self.latencies.append(time.time() - start)
+            self._put(page)
+            token = page.get('nextPageToken')
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.pages.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
 
 
 def load_events(event_iter):
@@ -236,24 +833,148 @@ def load_events(event_iter):
         timedout - a set of the ids of tasks that have timedout
         results  - a dictionary of id -> result for each finished task
         errors   - a dictionary of id -> error message for each failed task
-        order    - an list of task ids in the order they finished
+        order    - an list of task and timer ids in the order they finished
     """
-    running, timedout = set(), set()
-    results, errors = {}, {}
-    order = []
-    event2call = {}
+    history = ParsedHistory()
     for event in event_iter:
+        history.apply(event)
+    return (history.running, history.timedout, history.results,
+            history.errors, history.order)
+
+
+def load_history(event_iter):
+    """Parse an entire history, in its natural order."""
+    # Sometimes the first event in on the second page,
+    # and the first page is empty
+    event_iter = iter(event_iter)
+    first_event = next(event_iter)
+    assert first_event['eventType'] == 'WorkflowExecutionStarted'
+    history = ParsedHistory()
+    history.apply(first_event)
+    for event in event_iter:
+        history.apply(event)
+    return history
+
+
+def load_history_tail(reversed_event_iter, history=None):
+    """Apply only the new events, newest first, to a cached parsed history.
+
+    The events are consumed until one that was already applied is found. If
+    there is no cached history or the new events don't continue it, all the
+    remaining events are consumed and the entire history is parsed again.
+    The cached history is never modified, the new events are applied to a
+    copy of it, as it may be in use by a concurrent decision of the same
+    workflow execution.
+    """
+    reversed_event_iter = iter(reversed_event_iter)
+    tail = []
+    if history is None:
+        logger.debug('No cached history, loading the entire history.')
+    else:
+        for event in reversed_event_iter:
+            if event['eventId'] <= history.last_event_id:
+                tail.append(event)
+                break
+            tail.append(event)
+        if tail and tail[-1]['eventId'] == history.last_event_id:
+            new_events = tail[-2::-1]
+            if history.can_apply(new_events):
+                updated = history.copy()
+                try:
+                    for event in new_events:
+                        updated.apply(event)
+                except KeyError:
+                    pass  # the cached state is inconsistent, discard it
+                else:
+                    return updated
+        logger.info('Cached history mismatch, loading the entire history.')
+    tail.extend(reversed_event_iter)
+    tail.reverse()
+    return load_history(tail)
+
+
+class ParsedHistory(object):
+    """The parsed state of an execution history.
+
+    The events must be applied one by one in their history order. Because the
+    history of a workflow execution only grows, the parsed state can be cached
+    and updated later only with the new events.
+
+        started  - the attributes of the WorkflowExecutionStarted event
+        running  - a set of the ids of running tasks
+        timedout - a set of the ids of tasks that have timedout
+        results  - a dictionary of id -> result for each finished task
+        errors   - a dictionary of id -> error message for each failed task
+        order    - an list of task and timer ids in the order they finished
+        index    - a HistoryIndex of the same information
+        starts   - a dictionary of identity -> the times tasks were scheduled
+        now      - the time of the last event
+        cancel_requested - a set of the ids of tasks requested to cancel
+        workflow_ids - a dictionary of id -> workflow id for each sub-workflow
+    """
+
+    def __init__(self):
+        self.started = None
+        self.running, self.timedout = set(), set()
+        self.results, self.errors = {}, {}
+        self.order = []
+        self.index = HistoryIndex()
+        self.starts = {}
+        self.now = None
+        self.cancel_requested = set()
+        self.workflow_ids = {}
+        self.event2call = {}
+        self.last_event_id = 0
+
+    def copy(self):
+        """Return a copy that can be updated without changing this one."""
+        other = self.__class__()
+        other.started = self.started
+        other.running, other.timedout = set(self.running), set(self.timedout)
+        other.results, other.errors = dict(self.results), dict(self.errors)
+        other.order = list(self.order)
+        other.index = self.index.copy()
+        other.starts = dict((k, list(v)) for k, v in self.starts.items())
+        other.now = self.now
+        other.cancel_requested = set(self.cancel_requested)
+        other.workflow_ids = dict(self.workflow_ids)
+        other.event2call = dict(self.event2call)
+        other.last_event_id = self.last_event_id
+        return other
+
+    def can_apply(self, event_list):
+        """Check if the events are the contiguous continuation of this state."""
+        expected_id = self.last_event_id + 1
+        for event in event_list:
+            if event['eventId'] != expected_id:
+                return False
+            expected_id += 1
+        return True
+
+    def apply(self, event):
+        """Update the parsed state with a new event."""
+        self.last_event_id = event.get('eventId', self.last_event_id)
+        self.now = event.get('eventTimestamp', self.now)
+        running, timedout = self.running, self.timedout
+        results, errors = self.results, self.errors
+        order, event2call = self.order, self.event2call
+        index = self.index
         e_type = event.get('eventType')
-        if e_type == 'ActivityTaskScheduled':
+        if e_type == 'WorkflowExecutionStarted':
+            self.started = event['workflowExecutionStartedEventAttributes']
+        elif e_type == 'ActivityTaskScheduled':
             eid = event['activityTaskScheduledEventAttributes']['activityId']
             event2call[event['eventId']] = eid
             running.add(eid)
+            index.set(eid, RUNNING)
+            self._record_start(eid)
         elif e_type == 'ActivityTaskCompleted':
             atcea = 'activityTaskCompletedEventAttributes'
             eid = event2call[event[atcea]['scheduledEventId']]
             result = event[atcea]['result']
             running.remove(eid)
             results[eid] = result
+            index.set(eid, RESULT, len(order), result)
             order.append(eid)
         elif e_type == 'ActivityTaskFailed':
             atfea = 'activityTaskFailedEventAttributes'
@@ -261,12 +982,25 @@ def load_events(event_iter):
             reason = event[atfea]['reason']
             running.remove(eid)
             errors[eid] = reason
+            index.set(eid, ERROR, len(order), reason)
             order.append(eid)
         elif e_type == 'ActivityTaskTimedOut':
             attoea = 'activityTaskTimedOutEventAttributes'
             eid = event2call[event[attoea]['scheduledEventId']]
             running.remove(eid)
             timedout.add(eid)
+            index.set(eid, TIMEDOUT, len(order))
+            order.append(eid)
+        elif e_type == 'ActivityTaskCancelRequested':
+            atcrea = 'activityTaskCancelRequestedEventAttributes'
+            self.cancel_requested.add(event[atcrea]['activityId'])
+        elif e_type == 'ActivityTaskCanceled':
+            atcea = 'activityTaskCanceledEventAttributes'
+            eid = event2call[event[atcea]['scheduledEventId']]
+            reason = event[atcea].get('details') or 'The task was canceled.'
+            running.remove(eid)
+            errors[eid] = reason
+            index.set(eid, ERROR, len(order), reason)
             order.append(eid)
         elif e_type == 'ScheduleActivityTaskFailed':
             satfea = 'scheduleActivityTaskFailedEventAttributes'
@@ -274,11 +1008,15 @@ def load_events(event_iter):
             reason = event[satfea]['cause']
             # when a job is not found it's not even started
             errors[eid] = reason
+            index.set(eid, ERROR, len(order), reason)
             order.append(eid)
         elif e_type == 'StartChildWorkflowExecutionInitiated':
             scweiea = 'startChildWorkflowExecutionInitiatedEventAttributes'
             eid = _subworkflow_call_key(event[scweiea]['workflowId'])
             running.add(eid)
+            index.set(eid, RUNNING)
+            self._record_start(eid)
+            self.workflow_ids[eid] = event[scweiea]['workflowId']
         elif e_type == 'ChildWorkflowExecutionCompleted':
             cwecea = 'childWorkflowExecutionCompletedEventAttributes'
             eid = _subworkflow_call_key(
@@ -286,6 +1024,7 @@ def load_events(event_iter):
             result = event[cwecea]['result']
             running.remove(eid)
             results[eid] = result
+            index.set(eid, RESULT, len(order), result)
             order.append(eid)
         elif e_type == 'ChildWorkflowExecutionFailed':
             cwefea = 'childWorkflowExecutionFailedEventAttributes'
@@ -294,6 +1033,7 @@ def load_events(event_iter):
             reason = event[cwefea]['reason']
             running.remove(eid)
             errors[eid] = reason
+            index.set(eid, ERROR, len(order), reason)
             order.append(eid)
         elif e_type == 'ChildWorkflowExecutionTimedOut':
             cwetoea = 'childWorkflowExecutionTimedOutEventAttributes'
@@ -301,12 +1041,28 @@ def load_events(event_iter):
                 event[cwetoea]['workflowExecution']['workflowId'])
             running.remove(eid)
             timedout.add(eid)
+            index.set(eid, TIMEDOUT, len(order))
+            order.append(eid)
+        elif e_type == 'RequestCancelExternalWorkflowExecutionInitiated':
+            rcewseia = ('requestCancelExternalWorkflowExecution'
+                        'InitiatedEventAttributes')
+            eid = _subworkflow_call_key(event[rcewseia]['workflowId'])
+            self.cancel_requested.add(eid)
+        elif e_type == 'ChildWorkflowExecutionCanceled':
+            cweca = 'childWorkflowExecutionCanceledEventAttributes'
+            eid = _subworkflow_call_key(
+                event[cweca]['workflowExecution']['workflowId'])
+            reason = event[cweca].get('details') or 'The task was canceled.'
+            running.remove(eid)
+            errors[eid] = reason
+            index.set(eid, ERROR, len(order), reason)
             order.append(eid)
         elif e_type == 'StartChildWorkflowExecutionFailed':
             scwefea = 'startChildWorkflowExecutionFailedEventAttributes'
             eid = _subworkflow_call_key(event[scwefea]['workflowId'])
             reason = event[scwefea]['cause']
             errors[eid] = reason
+            index.set(eid, ERROR, len(order), reason)
             order.append(eid)
         elif e_type == 'TimerStarted':
             eid = event['timerStartedEventAttributes']['timerId']
@@ -315,7 +1071,17 @@ def load_events(event_iter):
             eid = event['timerFiredEventAttributes']['timerId']
             running.remove(eid)
             results[eid] = None
-    return running, timedout, results, errors, order
+            order.append(eid)
+
+    def _record_start(self, call_key):
+        parsed = parse_task_key(call_key)
+        if parsed is None or self.now is None:
+            return
+        identity = base_identity(parsed[0])
+        starts = self.starts.get(identity)
+        if starts is None:
+            starts = self.starts[identity] = []
+        starts.append(self.now)
 
 
 class _PaginationError(Exception):
@@ -324,3 +1090,8 @@ class _PaginationError(Exception):
 
 def _subworkflow_call_key(w_id):
     return w_id.split(':')[-1]
+
+
+def _run_key(first_page):
+    w_exec = first_page['workflowExecution']
+    return w_exec['workflowId'], w_exec['runId']
@@ -6,8 +6,7 @@ import webbrowser
 from flowy.operations import first
 from flowy.proxy import Proxy
 from flowy.result import is_result_proxy
-from flowy.serialization import collect_err_and_results
-from flowy.serialization import traverse_data
+from flowy.serialization import collect_dependencies
 from flowy.utils import logger
 from flowy.utils import short_repr
 
@@ -35,10 +34,10 @@ class TracingProxy(Proxy):
 
     def __call__(self, *args, **kwargs):
         node_id = "%s-%s" % (self.trace_name, self.call_number)
-        ((t_args, t_kwargs), (err, results)) = traverse_data(
-            [args, kwargs], f=collect_err_and_results, initial=(None, None)
-        )
-        r = super(TracingProxy, self).__call__(*t_args, **t_kwargs)
+        # Walk the arguments once, for both the dependencies and scheduling
+        traversed, (err, placeholders, results) = self._traverse_input(
+            args, kwargs, f=collect_dependencies, initial=(None, False, None))
+        r = self._call(args, kwargs, (traversed, (err, placeholders)))
         assert is_result_proxy(r)
         factory = r.__factory__
         factory.node_id = node_id
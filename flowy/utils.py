@@ -1,6 +1,8 @@
+import collections
 import itertools
 import logging
 import sys
+import threading
 
 try:
     import repr as r
@@ -9,7 +11,7 @@ except ImportError:
 
 
 __all__ = ['logger', 'sentinel', 'setup_default_logger', 'i_or_args',
-           'short_repr', 'caller_module']
+           'short_repr', 'caller_module', 'LRUCache']
 
 
 logger = logging.getLogger(__name__.split('.', 1)[0])
@@ -92,15 +94,81 @@ class DescCounter(object):
     """A simple semaphore-like descendent counter."""
 
     def __init__(self, to=None):
-        if to is None:
-            self.iterator = itertools.repeat(True)
-        else:
-            self.iterator = itertools.chain(itertools.repeat(True, to),
-                                            itertools.repeat(False))
+        self.left = to  # None means unbounded
+
+    def available(self):
+        """Returns True if positions are available, without consuming one."""
+        return self.left is None or self.left > 0
 
     def consume(self):
         """Conusme one position; returns True if positions are available."""
-        return next(self.iterator)
+        if not self.available():
+            return False
+        if self.left is not None:
+            self.left -= 1
+        return True
+
+
+class LRUCache(object):
+    """A thread safe, size bounded, least recently used cache.
+
+    If weigh is set, the size bounds the sum of weigh(key, value) over the
+    entries instead of their number. Entries heavier than the size aren't
+    cached at all.
+    """
+
+    def __init__(self, size, weigh=None):
+        self.size = int(size)
+        self.weigh = weigh
+        self.data = collections.OrderedDict()
+        self.weights = {}
+        self.weight = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Return the value for key and mark it as recently used."""
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Set the value for key, evicting the least recently used entries."""
+        weight = 1 if self.weigh is None else self.weigh(key, value)
+        with self.lock:
+            self._discard(key)
+            if weight > self.size:
+                return
+            self.data[key] = value
+            self.weights[key] = weight
+            self.weight += weight
+            while self.weight > self.size:
+                self._discard(next(iter(self.data)))
+
+    def discard(self, key):
+        with self.lock:
+            self._discard(key)
+
+    def _discard(self, key):
+        if self.data.pop(key, sentinel) is not sentinel:
+            self.weight -= self.weights.pop(key)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return '<LRUCache %s/%s hits=%s misses=%s>' % (
+            self.weight, self.size, self.hits, self.misses)
 
 
 # Stolen from Pyramid
@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+"""Micro-benchmarks for the decision and serialization hot paths.
+
+Run all of them with `python tests/benchmarks.py` or only some of them by
+passing their names as arguments.
+"""
+from __future__ import print_function
+
+import sys
+import time
+
+from flowy import SWFWorkflowConfig
+from flowy import SWFWorkflowWorker
+from flowy import parallel_map
+from flowy import parallel_reduce
+from flowy.proxy import Proxy
+from flowy.swf.history import SWFExecutionHistory
+
+
+class NullDecision(object):
+    """A decision that only records how the workflow finished."""
+
+    def __init__(self):
+        self.result = None
+
+    def fail(self, reason):
+        self.result = ('fail', reason)
+
+    def flush(self):
+        self.result = ('flush', None)
+
+    def restart(self, input_data):
+        self.result = ('restart', input_data)
+
+    def finish(self, result):
+        self.result = ('finish', result)
+
+    def schedule_activity(self, *args, **kwargs):
+        pass
+
+    def schedule_workflow(self, *args, **kwargs):
+        pass
+
+    def schedule_timer(self, *args, **kwargs):
+        pass
+
+
+class FanOut(object):
+    def __init__(self, task):
+        self.task = task
+
+    def __call__(self, n):
+        return [self.task(i) for i in range(n)]
+
+
+def replay_worker():
+    config = SWFWorkflowConfig()
+    config.conf_activity('task', version=1)
+    worker = SWFWorkflowWorker()
+    worker.register(config, FanOut, version=1)
+    return worker
+
+
+def completed_history(n, result='1'):
+    """An execution history where n tasks finished in reverse order."""
+    keys = ['task-%s-0' % i for i in range(n)]
+    results = dict((k, result) for k in keys)
+    return SWFExecutionHistory(set(), set(), results, {}, keys[::-1])
+
+
+def bench_replay(sizes=(100, 1000, 10000, 50000)):
+    """Replay a decision with n finished tasks; time per task should be flat."""
+    worker = replay_worker()
+    for n in sizes:
+        history = completed_history(n)
+        input_data = Proxy.serialize_input(n)
+        decision = NullDecision()
+        start = time.time()
+        worker('FanOut', 1, input_data, decision, history)
+        duration = time.time() - start
+        assert decision.result[0] == 'finish', decision.result
+        report('replay', n, duration)
+
+
+class SlowLayer1(object):
+    """Serve a history in pages, each one taking latency seconds."""
+
+    def __init__(self, history, latency):
+        self.history = history
+        self.latency = latency
+
+    def poll_for_decision_task(self, domain, task_list, identity=None,
+                               maximum_page_size=None, next_page_token=None,
+                               reverse_order=None):
+        page_size = maximum_page_size or 1000
+        start = int(next_page_token or 0)
+        if next_page_token is not None:
+            time.sleep(self.latency)
+        end = start + page_size
+        page = {'taskToken': 'token',
+                'workflowExecution': {'workflowId': 'wid', 'runId': 'rid'},
+                'events': self.history[start:end]}
+        if end < len(self.history):
+            page['nextPageToken'] = str(end)
+        return page
+
+
+def task_events(n):
+    """The events of a workflow execution with n completed tasks."""
+    history = [{
+        'eventId': 1,
+        'eventType': 'WorkflowExecutionStarted',
+        'workflowExecutionStartedEventAttributes': {
+            'taskList': {'name': 'tl'},
+            'taskStartToCloseTimeout': '10',
+            'executionStartToCloseTimeout': '20',
+            'childPolicy': 'TERMINATE',
+            'workflowType': {'name': 'FanOut', 'version': '1'},
+            'input': '[[], {}]',
+        },
+    }]
+    for i in range(n):
+        history.append({
+            'eventId': len(history) + 1,
+            'eventType': 'ActivityTaskScheduled',
+            'activityTaskScheduledEventAttributes': {
+                'activityId': 'task-%s-0' % i},
+        })
+        history.append({
+            'eventId': len(history) + 1,
+            'eventType': 'ActivityTaskCompleted',
+            'activityTaskCompletedEventAttributes': {
+                'scheduledEventId': len(history),
+                'result': '1'},
+        })
+    return history
+
+
+def bench_history_pages(events=10000, latency=0.05):
+    """Cold load a history served in slow pages, with and without prefetch."""
+    from flowy.swf.worker import poll_decision
+    layer1 = SlowLayer1(task_events(events // 2), latency)
+    for prefetch_pages in (0, 2):
+        start = time.time()
+        poll_decision(layer1, 'domain', 'tl', prefetch_pages=prefetch_pages)
+        report('history_pages(%s)' % prefetch_pages, events,
+               time.time() - start)
+
+
+def sample_payloads():
+    """Representative task inputs and results, by name."""
+    import random
+    rnd = random.Random(0)
+    records = [{'id': i, 'name': 'user-%s' % i, 'active': i % 3 == 0,
+                'score': rnd.random(), 'tags': ['a', 'b', 'c'][:i % 4]}
+               for i in range(2000)]
+    text = ' '.join(rnd.choice(['lorem', 'ipsum', 'dolor', 'sit', 'amet'])
+                    for _ in range(20000))
+    blob = bytes(bytearray(rnd.randrange(16) for _ in range(50000)))
+    return [('records', records), ('text', text), ('bytes', blob)]
+
+
+def bench_compression(levels=(None, 1, 6, 9), repeat=20):
+    """Payload size and encode/decode time for each zlib level."""
+    from flowy.serialization import Serializer
+    for name, value in sample_payloads():
+        for level in levels:
+            s = Serializer(compress_threshold=None if level is None else 0,
+                           compress_level=level)
+            start = time.time()
+            for _ in range(repeat):
+                payload = s.dumps(value)
+            encode = (time.time() - start) / repeat
+            start = time.time()
+            for _ in range(repeat):
+                s.loads(payload)
+            decode = (time.time() - start) / repeat
+            label = 'compression(%s, %s)' % (name, level)
+            print('%-28s %8s bytes %8.2fms encode %8.2fms decode' % (
+                label, len(payload), encode * 1e3, decode * 1e3))
+
+
+def bench_binary(repeat=20):
+    """Payload size and encode/decode time of the JSON and binary formats."""
+    from flowy.serialization import dumps, dumps_binary, loads
+    for name, value in sample_payloads():
+        for fmt, encoder in (('json', dumps), ('binary', dumps_binary)):
+            start = time.time()
+            for _ in range(repeat):
+                payload = encoder(value)
+            encode = (time.time() - start) / repeat
+            start = time.time()
+            for _ in range(repeat):
+                loads(payload)
+            decode = (time.time() - start) / repeat
+            label = 'binary(%s, %s)' % (name, fmt)
+            print('%-28s %8s bytes %8.2fms encode %8.2fms decode' % (
+                label, len(payload), encode * 1e3, decode * 1e3))
+
+
+def bench_decode_cache(n=1000):
+    """loads against DecodeCache.decode on payloads already seen."""
+    from flowy.serialization import DecodeCache, dumps, loads
+    records = sample_payloads()[0][1][:20]
+    for name, payload in (('number', dumps(12345.678)),
+                          ('text', dumps('lorem ipsum ' * 20)),
+                          ('records', dumps(records))):
+        start = time.time()
+        for _ in range(n):
+            loads(payload)
+        report('decode_cache(%s, loads)' % name, n, time.time() - start)
+        cache = DecodeCache(len(payload))
+        cache.prefill(loads, [payload])
+        start = time.time()
+        # The records are mutable, they are not cached and decoded every time
+        for _ in range(n):
+            cache.decode(loads, payload)
+        report('decode_cache(%s, cached)' % name, n, time.time() - start)
+
+
+def bench_traverse(n=20):
+    """traverse_data on proxy-free records and on records with results."""
+    from flowy.result import result
+    from flowy.serialization import traverse_data
+    records = sample_payloads()[0][1]
+    with_results = [dict(r, score=result(r['score'], i))
+                    for i, r in enumerate(records)]
+    for name, value in (('plain', records), ('results', with_results)):
+        start = time.time()
+        for _ in range(n):
+            traverse_data(value)
+        report('traverse(%s)' % name, n * len(value), time.time() - start)
+
+
+def old_dumps(value):
+    """The encoder dumps replaced: tag the whole value, then encode it."""
+    import json
+    return json.dumps(_old_tag(value))
+
+
+def _old_tag(value):
+    import uuid
+    from base64 import b64encode
+    if isinstance(value, uuid.UUID):
+        return {' u': value.hex}
+    elif isinstance(value, bytes):
+        return {' b': b64encode(value).decode('ascii')}
+    elif callable(getattr(value, '__json__', None)):
+        return _old_tag(value.__json__())
+    elif isinstance(value, (list, tuple)):
+        return [_old_tag(x) for x in value]
+    elif isinstance(value, dict):
+        return dict((k, _old_tag(v)) for k, v in value.items())
+    return value
+
+
+def bench_serialization(repeat=10):
+    """dumps/loads on 1MB payloads, with and without tagged values.
+
+    The plain records are also encoded with the old, two pass, encoder; it
+    doesn't support the sets and dates of the tagged ones.
+    """
+    import datetime
+    import uuid
+    from flowy.serialization import dumps, loads
+    records = sample_payloads()[0][1] * 5
+    tagged = [dict(r, id=uuid.UUID(int=r['id']), tags=set(r['tags']),
+                   created=datetime.date(2016, 1, 1 + r['id'] % 28))
+              for r in records]
+    for name, value, encoder in (('plain', records, dumps),
+                                 ('plain, old', records, old_dumps),
+                                 ('tagged', tagged, dumps)):
+        start = time.time()
+        for _ in range(repeat):
+            payload = encoder(value)
+        encode = (time.time() - start) / repeat
+        start = time.time()
+        for _ in range(repeat):
+            loads(payload)
+        decode = (time.time() - start) / repeat
+        label = 'serialization(%s)' % name
+        print('%-28s %8s bytes %8.2fms encode %8.2fms decode' % (
+            label, len(payload), encode * 1e3, decode * 1e3))
+
+
+class Reduce(object):
+    def __init__(self, task, red):
+        self.task = task
+        self.red = red
+
+    def __call__(self, n, arity=2):
+        return parallel_reduce(self.red, [self.task(i) for i in range(n)],
+                               arity=arity)
+
+
+def bench_reduce(sizes=(1000, 10000, 100000), arities=(2, 8)):
+    """Replay a reduction of n finished tasks, half of it already reduced."""
+    config = SWFWorkflowConfig()
+    config.conf_activity('task', version=1)
+    config.conf_activity('red', version=1)
+    worker = SWFWorkflowWorker()
+    worker.register(config, Reduce, version=1)
+    for n in sizes:
+        keys = ['task-%s-0' % i for i in range(n)]
+        keys += ['red-%s-0' % i for i in range(n // 2)]
+        results = dict((k, '1') for k in keys)
+        for arity in arities:
+            history = SWFExecutionHistory(set(), set(), results, {}, keys)
+            decision = NullDecision()
+            start = time.time()
+            worker('Reduce', 1, Proxy.serialize_input(n, arity), decision,
+                   history)
+            report('reduce(%s)' % arity, n, time.time() - start)
+
+
+class Map(object):
+    def __init__(self, task):
+        self.task = task
+
+    def __call__(self, n, chunk_size):
+        return parallel_map(self.task, range(n), chunk_size=chunk_size)
+
+
+def bench_parallel_map(n=50000, chunk_sizes=(1, 100)):
+    """Replay a map over n finished items, with one or more items per task."""
+    import json
+    config = SWFWorkflowConfig()
+    config.conf_activity('task', version=1)
+    worker = SWFWorkflowWorker()
+    worker.register(config, Map, version=1)
+    for chunk_size in chunk_sizes:
+        keys = ['task-%s-0' % i for i in range(n // chunk_size)]
+        output = json.dumps([[0, 1]] * chunk_size)
+        results = dict((k, output) for k in keys)
+        history = SWFExecutionHistory(set(), set(), results, {}, keys)
+        decision = NullDecision()
+        start = time.time()
+        worker('Map', 1, Proxy.serialize_input(n, chunk_size), decision,
+               history)
+        assert decision.result[0] == 'finish', decision.result
+        report('parallel_map(%s)' % chunk_size, n, time.time() - start)
+
+
+def bench_replay_allocation(n=100000):
+    """Replay n finished calls; time and peak memory of the result proxies."""
+    try:
+        import tracemalloc
+    except ImportError:  # Python 2
+        tracemalloc = None
+    worker = replay_worker()
+    history = completed_history(n)
+    input_data = Proxy.serialize_input(n)
+    for traced in (False, True):
+        if traced and tracemalloc is None:
+            continue
+        decision = NullDecision()
+        if traced:
+            tracemalloc.start()
+        start = time.time()
+        worker('FanOut', 1, input_data, decision, history)
+        duration = time.time() - start
+        assert decision.result[0] == 'finish', decision.result
+        if not traced:
+            report('replay_allocation', n, duration)
+            continue
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('%-24s n=%-7s %8.1fMB peak %8.0fB/call' % (
+            'replay_allocation(mem)', n, peak / 1e6, float(peak) / n))
+
+
+def report(name, n, duration):
+    print('%-24s n=%-7s %8.3fs %8.2fus/item' % (
+        name, n, duration, duration / n * 1e6))
+
+
+def main(names):
+    benchmarks = dict((k[len('bench_'):], v) for k, v in globals().items()
+                      if k.startswith('bench_'))
+    for name in names or sorted(benchmarks):
+        benchmarks[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,16 +1,20 @@
 import inspect
+import os
 import time
 import unittest
 from functools import partial
 
 from flowy import LocalWorkflow
 from flowy import TaskError
+from flowy import first
 from flowy import parallel_reduce
 from flowy import restart
 
 try:
+    from concurrent.futures import ProcessPoolExecutor
     from concurrent.futures import ThreadPoolExecutor
 except ImportError:
+    from futures import ProcessPoolExecutor
     from futures import ThreadPoolExecutor
 
 
@@ -188,3 +192,196 @@ import examples
 for wf_name, wf in vars(examples).items():
     if inspect.isclass(wf) and wf.__module__ == 'flowy.examples':
         setattr(TestExamples, 'test_%s' % wf_name, make_t(wf_name, wf))
+
+
+class Sleeper(object):
+    def __init__(self, task, sleep):
+        self.task = task
+        self.sleep = sleep
+
+    def __call__(self, delay):
+        return first(self.sleep(0.05), self.task(delay=delay))
+
+
+def slow_activity(delay):
+    time.sleep(delay)
+    return 'done'
+
+
+class TestSleep(unittest.TestCase):
+    def run_sleeper(self, delay):
+        main = LocalWorkflow(Sleeper, executor=ThreadPoolExecutor)
+        main.conf_activity('task', slow_activity)
+        main.conf_timer('sleep')
+        return main.run(delay, _wait=True)
+
+    def test_timer_fires_first(self):
+        self.assertEqual(self.run_sleeper(0.5), None)
+
+    def test_task_finishes_first(self):
+        self.assertEqual(self.run_sleeper(0), 'done')
+
+
+class TestTimerQueue(unittest.TestCase):
+    def test_calls_in_due_order(self):
+        from threading import Event
+        from flowy.local.runner import TimerQueue
+        timers = TimerQueue()
+        calls = []
+        done = Event()
+        timers.call_later(0.1, done.set)
+        timers.call_later(0.05, calls.append, 'b')
+        timers.call_later(0, calls.append, 'a')
+        timers.call_later(0.05, calls.append, 'c')
+        self.assertTrue(done.wait(5))
+        timers.close()
+        self.assertEqual(calls, ['a', 'b', 'c'])
+
+    def test_close_drops_pending_calls(self):
+        from flowy.local.runner import TimerQueue
+        timers = TimerQueue()
+        calls = []
+        timers.call_later(0.05, calls.append, 'a')
+        timers.close()
+        timers.call_later(0, calls.append, 'b')
+        time.sleep(0.1)
+        self.assertEqual(calls, [])
+
+
+class Stamps(object):
+    def __init__(self, task):
+        self.task = task
+
+    def __call__(self, n):
+        return [self.task() for _ in range(n)]
+
+
+class TestDelayedStarts(unittest.TestCase):
+    def test_tasks_over_the_rate_wait(self):
+        main = LocalWorkflow(Stamps, executor=ThreadPoolExecutor)
+        main.conf_activity('task', time.time, max_rate=3)
+        stamps = sorted(main.run(5, _wait=True))
+        self.assertTrue(stamps[2] - stamps[0] < 0.5)
+        self.assertTrue(stamps[3] - stamps[0] >= 0.9)
+
+    def test_invalid_max_rate(self):
+        main = LocalWorkflow(Stamps)
+        self.assertRaises(ValueError,
+                          lambda: main.conf_activity('task', time.time,
+                                                     max_rate=0))
+
+    def test_delayed_task_starts_later(self):
+        from threading import Event
+        from flowy.local.runner import WorkflowRunner
+        runner = WorkflowRunner(None, None, None, None)
+        started = []
+        done = Event()
+
+        def start(task):
+            started.append((task['id'], time.time()))
+            done.set()
+
+        now = time.time()
+        runner.start_task({'id': 'task-0-1', 'delay': 0.1}, start)
+        self.assertEqual(started, [])
+        self.assertTrue(done.wait(5))
+        runner.timers.close()
+        self.assertEqual(started[0][0], 'task-0-1')
+        self.assertTrue(started[0][1] - now >= 0.1)
+
+
+def sleepy(delay, marker=None):
+    if marker is not None and os.path.exists(marker):
+        return 'retried'
+    if marker is not None:
+        open(marker, 'w').close()
+    time.sleep(delay)
+    return 'done'
+
+
+class Straggler(object):
+    def __init__(self, task):
+        self.task = task
+
+    def __call__(self, delay, marker=None):
+        return self.task(delay, marker)
+
+
+class Pair(object):
+    def __init__(self, hung, other):
+        self.hung = hung
+        self.other = other
+
+    def __call__(self, marker):
+        return [self.hung(60, marker), self.other(0.3)]
+
+
+class Twice(object):
+    def __init__(self, task):
+        self.task = task
+
+    def __call__(self, delay):
+        return [self.task(delay), self.task(delay)]
+
+
+class TestTimeouts(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.mkdtemp()
+        self.marker = os.path.join(self.tmp, 'marker')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmp)
+
+    def test_timeout_without_retries(self):
+        main = LocalWorkflow(Straggler, executor=ThreadPoolExecutor)
+        main.conf_activity('task', sleepy, start_to_close=0.1, retry=(0, ))
+        self.assertRaises(TaskError, lambda: main.run(0.5))
+
+    def test_timed_out_task_is_retried(self):
+        main = LocalWorkflow(Straggler, executor=ThreadPoolExecutor)
+        main.conf_activity('task', sleepy, start_to_close=0.1)
+        self.assertEqual(main.run(0.5, self.marker), 'retried')
+
+    def test_hung_process_is_terminated(self):
+        main = LocalWorkflow(Pair, activity_workers=2)
+        main.conf_activity('hung', sleepy, start_to_close=0.2)
+        main.conf_activity('other', sleepy)
+        start = time.time()
+        self.assertEqual(main.run(self.marker, _wait=True),
+                         ['retried', 'done'])
+        self.assertTrue(time.time() - start < 30)
+
+    def test_queued_tasks_are_not_timed(self):
+        # The second task waits for the only worker longer than its timeout
+        main = LocalWorkflow(Twice, activity_workers=1)
+        main.conf_activity('task', sleepy, start_to_close=1, retry=(0, ))
+        self.assertEqual(main.run(0.7, _wait=True), ['done', 'done'])
+
+    def test_lost_tasks_are_retried(self):
+        main = LocalWorkflow(Pair, activity_workers=2)
+        main.conf_activity('hung', sleepy, start_to_close=0.2)
+        main.conf_activity('other', sleepy, retry=(0, ))
+        # The other task is lost with the pool and has no retries left
+        self.assertRaises(TaskError, lambda: main.run(self.marker,
+                                                      _wait=True))
+
+    def test_lost_tasks_are_not_submitted_again(self):
+        from flowy.local.runner import RecyclingExecutor
+        executor = RecyclingExecutor(ProcessPoolExecutor, 2)
+        hung = executor.submit(sleepy, 60)
+        other = executor.submit(sleepy, 0.3)
+        queued = executor.submit(sleepy, 0)
+        self.assertEqual(executor.start_time(queued), None)
+        time.sleep(0.05)
+        self.assertEqual(executor.abandon(hung), [other])
+        self.assertEqual(executor.start_time(other), None)
+        self.assertEqual(queued.result(), 'done')
+        self.assertFalse(other.done())
+        executor.shutdown()
+
+    def test_invalid_start_to_close(self):
+        main = LocalWorkflow(Straggler)
+        self.assertRaises(ValueError, lambda: main.conf_activity(
+            'task', sleepy, start_to_close=-1))
@@ -19,13 +19,13 @@ def make_traverse_cases():
         (
             [e1, [e2, e3], (r4, r0), [1, 2, [3]], {r4: ['xyz', ph]}],
             (
-                [e1, [e2, e3], [4, u'r0'], [1, 2, [3]], {4: ['xyz', ph]}],
+                [e1, [e2, e3], (4, u'r0'), [1, 2, [3]], {4: ['xyz', ph]}],
                 (e1, e2, e3, 4, u'r0', 1, 2, 3, 4, 'xyz', ph)
             )
         ), (
             [{(r4, tuple()): [r0, (e1, ph), tuple()]}],
             (
-                [{(4, tuple()): [u'r0', [e1, ph], []]}],
+                [{(4, tuple()): [u'r0', (e1, ph), tuple()]}],
                 (4, u'r0', e1, ph)
             )
         )
@@ -59,6 +59,61 @@ def test_traverse_unsized(traverse):
         traverse(x for x in range(10))
 
 
+def test_traverse_without_proxies_is_not_copied():
+    from flowy.serialization import traverse_data
+    value = [1, (2, u'x'), {'a': [None, 1.5]}]
+    assert traverse_data(value) == (value, (None, False))
+    assert traverse_data(value)[0] is value
+
+
+def test_traverse_copies_only_paths_to_proxies():
+    from flowy.result import result
+    from flowy.serialization import traverse_data
+    shared = [1, 2]
+    value = [shared, {'k': shared, 'r': (result(3, 0), )}, set([4])]
+    traversed, res = traverse_data(value)
+    assert traversed == [[1, 2], {'k': [1, 2], 'r': (3, )}, [4]]
+    assert traversed[0] is shared and traversed[1]['k'] is shared
+    assert res == (None, False)
+
+
+def test_traverse_keeps_tuples_with_proxies():
+    from flowy.result import result
+    from flowy.serialization import traverse_data
+    traversed, _ = traverse_data([(1, 2), (1, result(2, 0))])
+    assert traversed == [(1, 2), (1, 2)]
+    assert type(traversed[0]) is tuple and type(traversed[1]) is tuple
+
+
+def test_traverse_deep_nesting(traverse):
+    value = leaf = []
+    for _ in range(10000):
+        leaf.append([])
+        leaf = leaf[0]
+    leaf.append(1)
+    assert traverse(value) == (value, (1,))
+
+
+def test_collect_dependencies_keeps_raw_results():
+    from flowy.result import error, placeholder, raw_result
+    from flowy.serialization import collect_dependencies, loads, RawPayload
+    from flowy.serialization import traverse_data
+    decoded = []
+
+    def decode(raw):
+        decoded.append(raw)
+        return loads(raw)
+
+    r = raw_result('[1]', decode, 0)
+    e, ph = error('err', 1), placeholder()
+    traversed, (err, placeholders, results) = traverse_data(
+        [r, e, ph], f=collect_dependencies, initial=(None, False, None),
+        forward_raw=True)
+    assert isinstance(traversed[0], RawPayload)
+    assert err is e and placeholders
+    assert results == [r] and not decoded
+
+
 def make_err_and_ph_cases():
     from flowy.result import error, placeholder, result
 
@@ -122,3 +177,303 @@ x_uuid = uuid.uuid4()
 def test_dumps_loads(value, result):
     from flowy.serialization import dumps, loads
     assert loads(dumps(value)) == result
+
+
+def make_builtin_type_values():
+    import datetime
+    import decimal
+    from flowy.serialization import _FixedOffset
+    return (
+        set([1, 2]),
+        frozenset([u'a']),
+        datetime.datetime(2016, 2, 29, 12, 30, 1, 5),
+        datetime.datetime(2016, 2, 29, 12, 30, tzinfo=_FixedOffset(-3600)),
+        datetime.date(2016, 2, 29),
+        decimal.Decimal('1.10'),
+        [{u'when': datetime.date(2000, 1, 1), u'ids': set([x_uuid])}],
+    )
+
+
+@pytest.mark.parametrize('value', make_builtin_type_values())
+def test_builtin_types(value):
+    from flowy.serialization import dumps, dumps_binary, loads
+    assert loads(dumps(value)) == value
+    assert loads(dumps_binary(value)) == value
+
+
+def test_register_type():
+    import collections
+    from flowy.serialization import loads, Serializer
+
+    Point = collections.namedtuple('Point', 'x y')
+
+    class Money(object):
+        def __init__(self, cents):
+            self.cents = cents
+
+        def __eq__(self, other):
+            return self.cents == other.cents
+
+    class Euro(Money):
+        pass
+
+    s = Serializer(types=[(Point, 'point')])
+    s.register_type(Money, 'money', lambda m: m.cents, Money)
+    value = [Point(1, [Point(2, 3)]), {'price': Euro(150)}]
+    assert s.dumps(value) == ('[{" point": [1, [{" point": [2, 3]}]]}, '
+                              '{"price": {" money": 150}}]')
+    for payload in (s.dumps(value), s.dumps_binary(value)):
+        decoded = s.loads(payload)
+        assert decoded == value
+        assert type(decoded[0]) is Point and type(decoded[0].y[0]) is Point
+    assert type(loads(s.dumps(Point(1, 2)))) is dict  # unknown to the default
+    with pytest.raises(ValueError):
+        s.register_type(Euro, 'point')
+    with pytest.raises(ValueError):
+        s.register_type(Euro, 'euro', encode=lambda m: m.cents)
+    with pytest.raises(ValueError):
+        s.register_type(Euro, 'z', lambda m: m.cents, Euro)
+
+
+def test_unregistered_types():
+    import collections
+    from flowy.serialization import dumps, loads
+    Point = collections.namedtuple('Point', 'x y')
+    assert loads(dumps(Point(1, 2))) == [1, 2]
+    assert loads('{" x": {" unknown": 1}}') == {' x': {' unknown': 1}}
+    with pytest.raises(TypeError):
+        dumps(object())
+    with pytest.raises(ValueError):
+        loads('~1' + 'eAV0YWcwMU4=')  # an unknown binary extension
+
+
+def test_json_method_of_container_subclasses():
+    from flowy.result import result
+    from flowy.serialization import dumps, loads, traverse_data
+
+    class D(dict):
+        def __json__(self):
+            return {'custom': self['a']}
+
+    class L(list):
+        def __json__(self):
+            return ('custom', len(self))
+
+    traversed, _ = traverse_data([L([1, 2]), {'d': D(a=2)}])
+    assert loads(dumps(traversed)) == [['custom', 2], {'d': {'custom': 2}}]
+    traversed, _ = traverse_data(D(a=result(1, 0)))
+    assert traversed == {'custom': 1}
+    # dumps alone encodes them as plain containers
+    assert loads(dumps(D(a=1))) == {'a': 1}
+
+
+def test_traverse_keeps_namedtuples():
+    import collections
+    from flowy.result import result
+    from flowy.serialization import traverse_data
+    Point = collections.namedtuple('Point', 'x y')
+    traversed, _ = traverse_data([Point(result(1, 0), 2), Point(3, 4)])
+    assert traversed == [Point(1, 2), Point(3, 4)]
+    assert type(traversed[0]) is Point and type(traversed[1]) is Point
+
+
+def test_dumps_splices_raw():
+    from flowy.serialization import dumps, RawPayload
+    value = [RawPayload('{"a":[1]}'), {'b': RawPayload('2')}, u'\x00raw:0']
+    assert dumps(value) == '[{"a":[1]}, {"b": 2}, "\\u0000raw:0"]'
+
+
+def test_traverse_forwards_raw():
+    from flowy.result import raw_result
+    from flowy.serialization import dumps, loads, traverse_data
+    r = raw_result('{"a": [1]}', loads, 0)
+    traversed, (err, placeholders) = traverse_data([r], forward_raw=True)
+    assert (err, placeholders) == (None, False)
+    assert dumps(traversed) == '[{"a": [1]}]'
+    assert r['a'] == [1]  # decoded on access
+    traversed, _ = traverse_data([r], forward_raw=True)
+    assert traversed == [{'a': [1]}]
+
+
+import collections
+from flowy.blobs import FileBlobStore
+
+# Module level, so they can be pickled
+Pair = collections.namedtuple('Pair', 'a b')
+
+
+class CountingStore(FileBlobStore):
+    gets = 0
+
+    def get(self, key):
+        self.gets += 1
+        return super(CountingStore, self).get(key)
+
+
+@pytest.fixture
+def blob_store(tmpdir):
+    return CountingStore(str(tmpdir))
+
+
+def test_offload_large_payloads(blob_store):
+    from flowy.serialization import Serializer
+    s = Serializer(blob_store=blob_store, blob_threshold=100)
+    small = s.dumps([1, 2])
+    assert small == '[1, 2]'
+    value = {'data': u'x' * 1000, 'b': b'123'}
+    payload = s.dumps(value)
+    assert len(payload) < 100
+    assert s.loads(payload) == value
+    assert s.loads(payload) == value
+    assert blob_store.gets == 1  # cached after the first load
+
+
+def test_blob_cache_bounded_by_length(blob_store):
+    from flowy.serialization import Serializer
+    s = Serializer(blob_store=blob_store, blob_threshold=100,
+                   blob_cache_size=2500)
+    payloads = [s.dumps(u'%s' % i * 1000) for i in range(3)]
+    for payload in payloads:
+        s.loads(payload)
+    assert blob_store.gets == 3
+    s.loads(payloads[2])
+    s.loads(payloads[1])
+    assert blob_store.gets == 3
+    s.loads(payloads[0])  # evicted to keep the cache under 2500 characters
+    assert blob_store.gets == 4
+    s.loads(s.dumps(u'x' * 3000))  # too large to be cached
+    assert len(s.blob_cache) == 2
+
+
+def test_offloaded_results_are_forwarded(blob_store):
+    from flowy.result import raw_result
+    from flowy.serialization import Serializer, traverse_data
+    s = Serializer(blob_store=blob_store, blob_threshold=100)
+    payload = s.dumps(list(range(100)))
+    r = raw_result(payload, s.loads, 0)
+    traversed, _ = traverse_data([[r], {}], forward_raw=True)
+    forwarded = s.dumps(traversed)
+    assert blob_store.gets == 0
+    assert s.loads(forwarded) == [[list(range(100))], {}]
+
+
+def test_missing_blob_store():
+    from flowy.serialization import loads
+    with pytest.raises(ValueError):
+        loads('{" r": "abc"}')
+
+
+def test_serializer_pickles(blob_store):
+    import pickle
+    from flowy.serialization import Serializer
+    s = Serializer(types=[(Pair, 'pair')], blob_store=blob_store,
+                   blob_threshold=100, compress_threshold=50)
+    value = [Pair(1, u'x' * 1000)]
+    payload = s.dumps(value)
+    s.loads(payload)
+    copied = pickle.loads(pickle.dumps(s))
+    assert len(copied.blob_cache) == 0
+    assert copied.loads(payload) == value
+    assert copied.dumps(value) == payload
+
+
+def test_configs_use_their_serializer(blob_store):
+    import pickle
+    from flowy.config import ActivityConfig
+    from flowy.serialization import Serializer
+    s = Serializer(types=[(Pair, 'pair')], blob_store=blob_store,
+                   blob_threshold=100)
+    config = pickle.loads(pickle.dumps(ActivityConfig(serializer=s)))
+    wrapped = config.wrap(lambda p: [p] * 100)
+    payload = wrapped(s.serialize_input(Pair(1, 2)))
+    assert payload.startswith('{" r": ')
+    assert s.deserialize_result(payload) == [Pair(1, 2)] * 100
+    with pytest.raises(ValueError):
+        ActivityConfig(serializer=s, binary=True)
+
+
+def test_file_blob_store(tmpdir):
+    from flowy.blobs import FileBlobStore, blob_key
+    store = FileBlobStore(str(tmpdir))
+    key = blob_key(u'[1]')
+    store.put(key, u'[1]')
+    store.put(key, u'[1]')
+    assert store.get(key) == u'[1]'
+    with pytest.raises(KeyError):
+        store.get(blob_key(u'[2]'))
+    with pytest.raises(ValueError):
+        store.get('../x')
+
+
+def test_compress_large_payloads():
+    from flowy.serialization import loads, Serializer
+    s = Serializer(compress_threshold=100, compress_level=9)
+    assert s.dumps([1, 2]) == '[1, 2]'
+    value = [{'name': u'item', 'uuid': x_uuid, 'data': b'\x00' * 100}] * 50
+    payload = s.dumps(value)
+    assert payload.startswith('{" z": ')
+    assert len(payload) < 1000  # about 10KB uncompressed
+    assert s.loads(payload) == value
+    assert loads(payload) == value  # no settings needed to decompress
+
+
+def test_incompressible_payloads():
+    import os
+    from flowy.serialization import Serializer
+    s = Serializer(compress_threshold=100, compress_level=9)
+    value = os.urandom(200)
+    payload = s.dumps(value)
+    assert payload.startswith('{" b": ')
+    assert s.loads(payload) == value
+
+
+def test_compressed_and_offloaded(blob_store):
+    from flowy.serialization import Serializer
+    s = Serializer(blob_store=blob_store, blob_threshold=100,
+                   compress_threshold=100, compress_level=9)
+    value = [u'%s' % i for i in range(1000)]
+    payload = s.dumps(value)
+    assert payload.startswith('{" r": ')
+    assert s.loads(payload) == value
+
+
+@pytest.mark.parametrize('value', (
+    None, True, False, 0, 1, -1, 63, -64, 2 ** 70, -2 ** 70, 1.5, -0.0,
+    u'', u'țară', b'', b'\x00\xff', x_uuid, [], (), [1, (2, [3])],
+    {u'a': {(1, 2): [b'x', None]}, 3: 4.25},
+))
+def test_binary_roundtrip(value):
+    from flowy.serialization import dumps_binary, loads
+    payload = dumps_binary(value)
+    assert payload.startswith('~1')
+    decoded = loads(payload)
+    assert decoded == value
+    assert type(decoded) is type(value)
+
+
+def test_binary_errors():
+    from flowy.serialization import dumps_binary, loads
+    payload = dumps_binary([1, 2, 3])
+    with pytest.raises(ValueError):
+        loads(payload[:-2])
+    with pytest.raises(ValueError):
+        loads('~2abc')
+    with pytest.raises(TypeError):
+        dumps_binary(object())
+
+
+def test_forward_between_formats():
+    from flowy.serialization import dumps, dumps_binary, loads, RawPayload
+    json_payload = dumps({'a': (1, 2)})
+    binary_payload = dumps_binary({'a': (1, 2)})
+    assert loads(dumps([RawPayload(binary_payload)])) == [{'a': (1, 2)}]
+    assert loads(dumps_binary([RawPayload(json_payload)])) == [{'a': [1, 2]}]
+
+
+def test_binary_compressed():
+    from flowy.serialization import Serializer
+    s = Serializer(binary=True, compress_threshold=100, compress_level=9)
+    value = [(i, u'item', b'\x00' * 10) for i in range(100)]
+    payload = s.serialize_result(value)
+    assert payload.startswith('{" z": ')
+    assert s.deserialize_result(payload) == value
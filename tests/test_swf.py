@@ -144,6 +144,56 @@ class DummyDecision(object):
         assert expected == self.result, m
 
 
+def decide(config, workflow, history, args=(), decision=None):
+    """Run a decision of the workflow, registered with the config.
+
+    Return the calls made to the decision, in order, and its result: the
+    keys of the activities scheduled, (key, delay) for the timers and
+    ('cancel', key) for the cancellation requests. A real decision can be
+    passed instead of the DummyDecision, it's used as it is.
+    """
+    from flowy import SWFWorkflowWorker
+    worker = SWFWorkflowWorker()
+    worker.register(config, workflow, name='W', version=1)
+    calls = []
+    if decision is None:
+        decision = DummyDecision()
+        decision.schedule_activity = lambda *args: calls.append(args[0])
+        decision.schedule_timer = lambda key, delay: calls.append(
+            (key, delay))
+        decision.request_cancel_activity = lambda key: calls.append(
+            ('cancel', key))
+    worker('W', '1', serialize_input(*args), decision, history)
+    return calls, getattr(decision, 'result', None)
+
+
+class FanOut(object):
+    """Call a five times and b, if configured, once."""
+
+    def __init__(self, a, b=None):
+        self.a = a
+        self.b = b
+
+    def __call__(self):
+        results = [self.a(i) for i in range(5)]
+        if self.b is None:
+            return results
+        return results, self.b()
+
+
+class Single(object):
+    """Call a once and return its result, or 1 if it isn't used."""
+
+    def __init__(self, a):
+        self.a = a
+
+    def __call__(self, use_result=True):
+        r = self.a()
+        if use_result:
+            return r
+        return 1
+
+
 g = globals()
 for i, case in enumerate(cases):
     test_class_name = 'Test%s' % case['name']
@@ -237,6 +287,108 @@ class TestParallelReduce(unittest.TestCase):
         # python 2.6 doesn't have assertIs
         assert x is parallel_x.__wrapped__
 
+    def test_finish_order(self):
+        from flowy import parallel_reduce
+        from flowy.result import placeholder, result
+        a, b, c = result('a', 3), result('b', 1), result('c', 2)
+        p = placeholder()
+        calls = []
+
+        def f(x, y):
+            calls.append((x, y))
+            return placeholder()
+
+        parallel_reduce(f, [a, b, c, p])
+        self.assertEqual(len(calls), 3)
+        assert calls[0][0] is b and calls[0][1] is c
+        assert calls[1][0] is a and calls[1][1] is p
+
+    def test_non_result_values(self):
+        from flowy import parallel_reduce
+        from flowy.result import result
+        add = lambda x, y: x + y
+        self.assertEqual(parallel_reduce(add, [1, 2, 3]), 6)
+        self.assertEqual(parallel_reduce(add, [result(1, 0), 2, 3]), 6)
+        self.assertEqual(parallel_reduce(add, [2, 3], initializer=1), 6)
+
+    def test_arity(self):
+        from flowy import parallel_reduce
+        from flowy.result import placeholder, result
+        calls = []
+
+        def f(*values):
+            calls.append(values)
+            return sum(values)
+
+        self.assertEqual(parallel_reduce(f, range(10), arity=4), 45)
+        self.assertEqual(len(calls), 3)
+        results = [result(i, 10 - i) for i in range(9)] + [placeholder()]
+        calls[:] = []
+        parallel_reduce(lambda *values: calls.append(values) or placeholder(),
+                        results, arity=4)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual([len(c) for c in calls], [4, 4, 4])
+        assert all(x is y for x, y in zip(calls[0], results[8:4:-1]))
+        self.assertRaises(ValueError, lambda: parallel_reduce(f, [1], arity=1))
+
+    def test_many_results(self):
+        from flowy import parallel_reduce
+        from flowy.result import result
+        n = 20000
+        results = [result(i, n - i) for i in range(n)]
+        total = parallel_reduce(lambda x, y: result(x + y, None), results)
+        self.assertEqual(total, n * (n - 1) // 2)
+
+
+class TestParallelMap(unittest.TestCase):
+    def test_plain_function(self):
+        from flowy import batch, finish_order, parallel_map, parallel_reduce
+        from flowy.result import TaskError
+        results = parallel_map(batch(lambda x: 10 // x), [1, 2, 0, 5],
+                               chunk_size=3)
+        self.assertEqual(len(results), 4)
+        self.assertEqual(results[0], 10)
+        self.assertEqual(results[3], 2)
+        self.assertRaises(TaskError, lambda: results[2].__wrapped__)
+        ok = [results[0], results[1], results[3]]
+        self.assertEqual(list(finish_order(ok)), [10, 5, 2])
+        self.assertEqual(parallel_reduce(lambda x, y: x + y, ok), 17)
+
+    def test_batch_extra_args(self):
+        from flowy import batch
+        run = batch(lambda heartbeat, x: (heartbeat, x))
+        self.assertEqual(run('hb', [1, 2]), [[0, ('hb', 1)], [0, ('hb', 2)]])
+
+    def test_replay(self):
+        from flowy import SWFWorkflowConfig, SWFWorkflowWorker
+        from flowy import first, parallel_map
+
+        class W(object):
+            def __init__(self, task, report):
+                self.task = task
+                self.report = report
+
+            def __call__(self):
+                results = parallel_map(self.task, range(5), chunk_size=2)
+                return self.report(first(results[0], results[2], results[4]))
+
+        w = SWFWorkflowConfig()
+        w.conf_activity('task', version=1)
+        w.conf_activity('report', version=1)
+        worker = SWFWorkflowWorker()
+        worker.register(w, W, name='W', version=1)
+        # The first chunk failed, the second one is running and the last one
+        # finished first.
+        execution_history = SWFExecutionHistory(
+            ['task-1-0'], [], {'task-2-0': '[[0, "c"]]'},
+            {'task-0-0': 'boom'}, ['task-2-0', 'task-0-0'])
+        decision = DummyDecision()
+        inputs = []
+        decision.schedule_activity = lambda *args: inputs.append(args[3])
+        worker('W', '1', '[[], {}]', decision, execution_history)
+        self.assertEqual([deserialize_input(i) for i in inputs],
+                         [([u'c'], {})])
+
 
 class TestFinishOrder(unittest.TestCase):
     def test_non_results(self):
@@ -292,3 +444,1289 @@ class TestFinishOrder(unittest.TestCase):
         e = error('err!', 3)
         p = placeholder()
         self.assertEquals(first([e, p, r, t]).__factory__, r.__factory__)
+
+
+class FakeDecisionLayer1(object):
+    """Serve a workflow execution history in pages, like SWF does."""
+
+    def __init__(self, history, page_size=3):
+        self.history = history
+        self.page_size = page_size
+        self.calls = []
+
+    def poll_for_decision_task(self, domain, task_list, identity=None,
+                               maximum_page_size=None, next_page_token=None,
+                               reverse_order=None):
+        self.calls.append((next_page_token, reverse_order))
+        events = list(self.history)
+        if reverse_order:
+            events.reverse()
+        start = int(next_page_token or 0)
+        end = start + self.page_size
+        page = {'taskToken': 'token',
+                'workflowExecution': {'workflowId': 'wid', 'runId': 'rid'},
+                'events': events[start:end]}
+        if end < len(events):
+            page['nextPageToken'] = str(end)
+        return page
+
+
+def make_history(n):
+    history = [{
+        'eventId': 1,
+        'eventType': 'WorkflowExecutionStarted',
+        'workflowExecutionStartedEventAttributes': {
+            'taskList': {'name': 'tl'},
+            'taskStartToCloseTimeout': '10',
+            'executionStartToCloseTimeout': '20',
+            'childPolicy': 'TERMINATE',
+            'workflowType': {'name': 'W', 'version': '1'},
+            'input': '[[], {}]',
+        },
+    }]
+    for i in range(n):
+        scheduled_id = len(history) + 1
+        history.append({
+            'eventId': scheduled_id,
+            'eventType': 'ActivityTaskScheduled',
+            'activityTaskScheduledEventAttributes': {
+                'activityId': 'task-%s-0' % i},
+        })
+        history.append({
+            'eventId': scheduled_id + 1,
+            'eventType': 'ActivityTaskCompleted',
+            'activityTaskCompletedEventAttributes': {
+                'scheduledEventId': scheduled_id,
+                'result': str(i)},
+        })
+    return history
+
+
+class TestHistoryCache(unittest.TestCase):
+    def poll(self, history, cache):
+        from flowy.swf.worker import poll_decision
+        layer1 = FakeDecisionLayer1(history)
+        r = poll_decision(layer1, 'domain', 'tl', history_cache=cache)
+        return r[3], layer1.calls
+
+    def test_full_load_without_cache(self):
+        from flowy.swf.worker import poll_decision
+        layer1 = FakeDecisionLayer1(make_history(5))
+        name, version, input_data, exec_history, _ = poll_decision(
+            layer1, 'domain', 'tl')
+        self.assertEqual((name, version, input_data), ('W', '1', '[[], {}]'))
+        self.assertEqual(exec_history.result('task-4-0'), '4')
+        self.assertEqual(exec_history.order('task-4-0'), 4)
+        self.assertTrue(all(not r for _, r in layer1.calls))
+
+    def test_incremental_load(self):
+        from flowy.utils import LRUCache
+        cache = LRUCache(10)
+        history = make_history(5)
+        exec_history, calls = self.poll(history, cache)
+        self.assertEqual(len(calls), 4)
+        history = make_history(6)
+        exec_history, calls = self.poll(history, cache)
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(r for _, r in calls))
+        self.assertEqual(exec_history.result('task-5-0'), '5')
+        self.assertEqual(exec_history.order('task-5-0'), 5)
+        self.assertEqual(exec_history.result('task-0-0'), '0')
+        self.assertEqual(cache.hits, 1)
+
+    def test_cached_history_is_not_modified(self):
+        from flowy.utils import LRUCache
+        cache = LRUCache(10)
+        old_history, _ = self.poll(make_history(5), cache)
+        new_history, _ = self.poll(make_history(6), cache)
+        self.assertFalse(old_history.has_result('task-5-0'))
+        self.assertFalse(old_history.index.get('task-5-0'))
+        self.assertEqual(len(old_history.order_), 5)
+        self.assertEqual(new_history.result('task-5-0'), '5')
+        # A redelivery of the same decision starts from the same cached state
+        again, _ = self.poll(make_history(6), cache)
+        self.assertEqual(len(again.order_), 6)
+
+    def test_mismatch_fallback(self):
+        from flowy.swf.worker import load_history
+        from flowy.utils import LRUCache
+        cache = LRUCache(10)
+        cache.put(('wid', 'rid'), load_history(make_history(4)))
+        exec_history, calls = self.poll(make_history(3), cache)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(exec_history.order('task-2-0'), 2)
+        self.assertFalse(exec_history.has_result('task-3-0'))
+
+    def test_mismatch_logged_only_for_cached_histories(self):
+        import logging
+        from flowy.swf.worker import load_history
+        from flowy.utils import LRUCache, logger
+        records = []
+
+        class Handler(logging.Handler):
+            def emit(self, record):
+                records.append((record.levelno, record.getMessage()))
+
+        handler = Handler()
+        level = logger.level
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+        try:
+            cache = LRUCache(10)
+            self.poll(make_history(3), cache)  # a plain miss
+            self.assertEqual(records, [
+                (logging.DEBUG,
+                 'No cached history, loading the entire history.')])
+            del records[:]
+            cache.put(('wid', 'rid'), load_history(make_history(4)))
+            self.poll(make_history(3), cache)
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(level)
+        self.assertEqual(records, [
+            (logging.INFO,
+             'Cached history mismatch, loading the entire history.')])
+
+    def test_inconsistent_fallback(self):
+        from flowy.swf.worker import load_history
+        from flowy.utils import LRUCache
+        cache = LRUCache(10)
+        stale = load_history(make_history(2))
+        stale.last_event_id = 4  # one event behind what was actually applied
+        cache.put(('wid', 'rid'), stale)
+        exec_history, calls = self.poll(make_history(3), cache)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(exec_history.order('task-2-0'), 2)
+        self.assertEqual(len(exec_history.order_), 3)
+
+    def test_lru_eviction(self):
+        from flowy.utils import LRUCache
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertEqual(len(cache), 2)
+
+
+class TestPollerPool(unittest.TestCase):
+    def test_thread_pollers(self):
+        import threading
+        from flowy import SWFWorkflowConfig, SWFWorkflowWorker
+
+        class Layer1(FakeDecisionLayer1):
+            def __init__(self, *args, **kwargs):
+                super(Layer1, self).__init__(*args, **kwargs)
+                self.lock = threading.Lock()
+                self.identities = set()
+                self.completed = 0
+
+            def poll_for_decision_task(self, domain, task_list, identity=None,
+                                       *args, **kwargs):
+                with self.lock:
+                    self.identities.add(identity)
+                return super(Layer1, self).poll_for_decision_task(
+                    domain, task_list, identity, *args, **kwargs)
+
+            def respond_decision_task_completed(self, task_token, decisions):
+                with self.lock:
+                    self.completed += 1
+
+        layer1 = Layer1(make_history(3))
+
+        class Worker(SWFWorkflowWorker):
+            def break_loop(self):
+                return layer1.completed >= 20 and len(layer1.identities) == 3
+
+        worker = Worker()
+        worker.register(SWFWorkflowConfig(), lambda: lambda: 1, version=1,
+                        name='W')
+        worker.run_forever('domain', 'tl', layer1=layer1, identity='i',
+                           setup_log=False, register_remote=False,
+                           pollers=3, mode='thread')
+        self.assertTrue(layer1.completed >= 20)
+        self.assertEqual(layer1.identities, set(['i-0', 'i-1', 'i-2']))
+
+    def test_thread_pollers_have_their_own_clients(self):
+        import threading
+        from flowy import SWFWorkflowConfig, SWFWorkflowWorker
+        from flowy.swf import worker as worker_module
+        clients = []
+        lock = threading.Lock()
+
+        class Layer1(FakeDecisionLayer1):
+            def __init__(self):
+                super(Layer1, self).__init__(make_history(3))
+                with lock:
+                    clients.append(self)
+
+            def respond_decision_task_completed(self, task_token, decisions):
+                pass
+
+        class Worker(SWFWorkflowWorker):
+            def break_loop(self):
+                with lock:
+                    pollers = clients[1:]
+                    return len(pollers) == 3 and all(c.calls for c in pollers)
+
+        worker = Worker()
+        worker.register(SWFWorkflowConfig(), lambda: lambda: 1, version=1,
+                        name='W')
+        default_layer1 = worker_module.Layer1
+        worker_module.Layer1 = Layer1
+        try:
+            worker.run_forever('domain', 'tl', identity='i', setup_log=False,
+                               register_remote=False, pollers=3,
+                               mode='thread')
+        finally:
+            worker_module.Layer1 = default_layer1
+        self.assertEqual(len(clients), 4)  # one for the registration
+        self.assertTrue(all(c.calls for c in clients[1:]))
+
+    def test_stop_while_polling_an_idle_task_list(self):
+        import threading
+        from flowy import SWFWorkflowWorker
+        stop = threading.Event()
+
+        class Layer1(object):
+            polls = 0
+
+            def poll_for_decision_task(self, *args, **kwargs):
+                self.polls += 1
+                if self.polls == 3:
+                    stop.set()
+                return {'taskToken': ''}  # the long poll timed out
+
+        layer1 = Layer1()
+        SWFWorkflowWorker()._decision_loop('domain', 'tl', layer1, 'i',
+                                           stop=stop)
+        self.assertEqual(layer1.polls, 3)
+
+    def test_process_poller_loop_is_picklable(self):
+        import pickle
+        from flowy import SWFWorkflowConfig, SWFWorkflowWorker
+        from flowy.swf import worker as worker_module
+        loops = []
+        w = SWFWorkflowConfig(cancel_abandoned=True)
+        w.conf_activity('a', version=1)
+        worker = SWFWorkflowWorker()
+        worker.register(w, Single, name='W', version=1)
+        default_run_pollers = worker_module.run_pollers
+        worker_module.run_pollers = lambda loop, *args: loops.append(loop)
+        try:
+            worker.run_forever('domain', 'tl', layer1=object(), identity='i',
+                               setup_log=False, register_remote=False,
+                               pollers=2, mode='process')
+        finally:
+            worker_module.run_pollers = default_run_pollers
+        # Spawned processes get the loop pickled, it can't be a closure
+        loop = pickle.loads(pickle.dumps(loops[0]))
+        decision = DummyDecision()
+        loop.args[0]('W', '1', serialize_input(), decision,
+                     SWFExecutionHistory([], [], {}, {}, []))
+        self.assertEqual([s['call_key'] for s in decision.result['schedule']],
+                         ['a-0-0'])
+
+    def test_invalid_mode(self):
+        from flowy.swf.worker import run_pollers
+        self.assertRaises(ValueError, lambda: run_pollers(None, 2, 'fiber'))
+
+    def test_poller_identity(self):
+        from flowy.swf.worker import poller_identity
+        self.assertEqual(len(poller_identity('x' * 256, 12)), 256)
+        self.assertTrue(poller_identity('x' * 256, 12).endswith('x-12'))
+
+
+class TestBoundedExecutor(unittest.TestCase):
+    def test_limits(self):
+        import threading
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+        from flowy.swf.worker import BoundedExecutor
+        lock = threading.Lock()
+        running, max_running = {}, {}
+
+        def task(key):
+            with lock:
+                running[key] = running.get(key, 0) + 1
+                max_running[key] = max(max_running.get(key, 0), running[key])
+            time.sleep(0.01)
+            with lock:
+                running[key] -= 1
+
+        executor = ThreadPoolExecutor(max_workers=4)
+        pool = BoundedExecutor(executor, 4, {'a': 1, ('b', '1'): 2})
+        for i in range(30):
+            key = [('a', '1'), ('b', '1'), ('c', '1')][i % 3]
+            pool.wait_for_slot()
+            self.assertTrue(pool.in_flight <= 4)
+            pool.submit(key, task, (key, ))
+        executor.shutdown(wait=True)
+        self.assertEqual(max_running[('a', '1')], 1)
+        self.assertTrue(max_running[('b', '1')] <= 2)
+        self.assertEqual(pool.in_flight, 0)
+
+
+class TestConcurrentActivityWorker(unittest.TestCase):
+    def test_thread_mode(self):
+        import time
+        from flowy import SWFActivityConfig, SWFActivityWorker
+        from flowy.proxy import Proxy
+        from flowy.swf import worker as worker_module
+        clients, polls, results, overlaps = [], [], [], []
+
+        class Layer1(object):
+            """Detect the calls made concurrently on the same client."""
+
+            def __init__(self):
+                self.busy = False
+                clients.append(self)
+
+            def call(self, value=None):
+                if self.busy:
+                    overlaps.append(self)
+                self.busy = True
+                time.sleep(0.001)
+                self.busy = False
+                return value
+
+            def poll_for_activity_task(self, domain, task_list, identity):
+                polls.append(self)
+                return self.call({
+                    'taskToken': 'token-%s' % len(polls),
+                    'activityType': {'name': 'square', 'version': '1'},
+                    'input': Proxy.serialize_input(len(polls))})
+
+            def record_activity_task_heartbeat(self, task_token):
+                return self.call({})
+
+            def respond_activity_task_completed(self, result, task_token):
+                results.append(int(self.call(result)))
+
+        class Worker(SWFActivityWorker):
+            def break_loop(self):
+                return len(polls) >= 10
+
+        def square(heartbeat, x):
+            for _ in range(5):
+                heartbeat()
+                time.sleep(0.002)
+            return x * x
+
+        worker = Worker()
+        worker.register(SWFActivityConfig(default_heartbeat=1), square,
+                        version=1, name='square')
+        default_layer1 = worker_module.Layer1
+        worker_module.Layer1 = Layer1
+        try:
+            worker.run_forever('domain', 'tl', setup_log=False,
+                               register_remote=False, max_in_flight=3,
+                               auto_heartbeat=0.001)
+        finally:
+            worker_module.Layer1 = default_layer1
+        self.assertEqual(len(results), 10)
+        self.assertTrue(len(clients) > 2)  # the poller, workers, heartbeater
+        self.assertEqual(overlaps, [])
+
+    def test_shared_client(self):
+        import threading
+        from flowy import SWFActivityConfig, SWFActivityWorker
+        from flowy.proxy import Proxy
+
+        class Layer1(object):
+            def __init__(self):
+                self.lock = threading.Lock()
+                self.polled = 0
+                self.results = []
+
+            def poll_for_activity_task(self, domain, task_list, identity):
+                with self.lock:
+                    self.polled += 1
+                    return {'taskToken': 'token-%s' % self.polled,
+                            'activityType': {'name': 'square', 'version': '1'},
+                            'input': Proxy.serialize_input(self.polled)}
+
+            def respond_activity_task_completed(self, result, task_token):
+                with self.lock:
+                    self.results.append(int(result))
+
+        layer1 = Layer1()
+
+        class Worker(SWFActivityWorker):
+            def break_loop(self):
+                return layer1.polled >= 10
+
+        worker = Worker()
+        worker.register(SWFActivityConfig(), lambda hb, x: x * x, version=1,
+                        name='square')
+        worker.run_forever('domain', 'tl', layer1=layer1, setup_log=False,
+                           register_remote=False, max_in_flight=3)
+        self.assertEqual(sorted(layer1.results), [x * x for x in range(1, 11)])
+
+
+class FakeHeartbeatLayer1(object):
+    def __init__(self, cancel_after=None):
+        self.heartbeats = 0
+        self.cancel_after = cancel_after
+        self.responses = []
+
+    def record_activity_task_heartbeat(self, task_token):
+        self.heartbeats += 1
+        cancel = (self.cancel_after is not None
+                  and self.heartbeats > self.cancel_after)
+        return {'cancelRequested': cancel}
+
+    def respond_activity_task_failed(self, reason, task_token):
+        self.responses.append(('failed', reason))
+
+    def respond_activity_task_canceled(self, task_token, details=None):
+        self.responses.append(('canceled', details))
+
+    def respond_activity_task_completed(self, result, task_token):
+        self.responses.append(('completed', result))
+
+
+class TestHeartbeat(unittest.TestCase):
+    def test_coalesce(self):
+        from flowy.swf.decision import SWFActivityDecision
+        layer1 = FakeHeartbeatLayer1()
+        decision = SWFActivityDecision(layer1, 'token', heartbeat_interval=60)
+        for _ in range(1000):
+            self.assertTrue(decision.heartbeat())
+        self.assertEqual(layer1.heartbeats, 1)
+
+    def test_no_coalesce(self):
+        from flowy.swf.decision import SWFActivityDecision
+        layer1 = FakeHeartbeatLayer1()
+        decision = SWFActivityDecision(layer1, 'token')
+        for _ in range(3):
+            decision.heartbeat()
+        self.assertEqual(layer1.heartbeats, 3)
+
+    def test_cancel_requested(self):
+        from flowy.swf.decision import SWFActivityDecision
+        layer1 = FakeHeartbeatLayer1(cancel_after=1)
+        decision = SWFActivityDecision(layer1, 'token')
+        self.assertTrue(decision.heartbeat())
+        self.assertFalse(decision.heartbeat())
+        self.assertTrue(decision.cancel_requested)
+        decision.fail('stopped')
+        self.assertEqual(layer1.responses, [('canceled', 'stopped')])
+
+    def test_background_heartbeat(self):
+        import time
+        from flowy.swf.decision import SWFActivityDecision
+        from flowy.swf.worker import Heartbeater
+        layer1 = FakeHeartbeatLayer1()
+        heartbeater = Heartbeater(0.5)
+        decision = SWFActivityDecision(layer1, 'token', heartbeat_interval=0.01)
+        heartbeater.add(decision)
+        time.sleep(0.2)
+        decision.finish('1')
+        sent = layer1.heartbeats
+        self.assertTrue(sent >= 3)
+        time.sleep(0.05)
+        self.assertEqual(layer1.heartbeats, sent)
+
+    def test_default_heartbeat_registration(self):
+        from flowy import SWFActivityConfig, SWFActivityWorker
+        worker = SWFActivityWorker()
+        worker.register(SWFActivityConfig(default_heartbeat=10),
+                        lambda hb: 1, version=1, name='a')
+        self.assertEqual(worker.default_heartbeats[('a', '1')], 10)
+
+
+class TestHistoryIndex(unittest.TestCase):
+    def test_from_sets(self):
+        from flowy.history import HistoryIndex, RUNNING, RESULT, ERROR, TIMEDOUT
+        index = HistoryIndex.from_sets(
+            running=['a-0-0', 'a-1-0:t'],
+            timedout=['a-2-0'],
+            results={'a-1-0': 'r', 'b-0-1': 'x'},
+            errors={'a-2-1': 'err'},
+            order=['a-2-0', 'b-0-1', 'a-1-0', 'a-2-1'])
+        self.assertEqual(index.retries('a', 0), {0: (RUNNING, None, None)})
+        self.assertEqual(index.retries('a', 1), {0: (RESULT, 2, 'r')})
+        self.assertEqual(index.retries('a', 2), {0: (TIMEDOUT, 0, None),
+                                                 1: (ERROR, 3, 'err')})
+        self.assertEqual(index.get('b-0-1'), (RESULT, 1, 'x'))
+        self.assertEqual(index.retries('c', 0), {})
+        self.assertEqual(index.get('a-1-0:t'), None)
+
+    def test_state_precedence(self):
+        from flowy.history import HistoryIndex, TIMEDOUT
+        index = HistoryIndex.from_sets(['a-0-0'], ['a-0-0'], {'a-0-0': 1}, {},
+                                       ['a-0-0'])
+        self.assertEqual(index.get('a-0-0'), (TIMEDOUT, 0, None))
+
+    def test_local_state_order(self):
+        from flowy.local.runner import State
+        state = State()
+        for key in ['a-0-0', 'a-1-0', 'a-2-0']:
+            state.set_running(key)
+        state.set_result('a-2-0', '1')
+        state.set_error('a-0-0', 'err')
+        self.assertEqual(state.order('a-2-0'), 0)
+        self.assertEqual(state.order('a-0-0'), 1)
+        self.assertRaises(ValueError, lambda: state.order('a-1-0'))
+        self.assertEqual(state.copy().retries('a', 0), state.retries('a', 0))
+
+
+class TestResultCache(unittest.TestCase):
+    def run_decision(self, worker, results, cache):
+        results = dict(('task-%s-0' % k, v) for k, v in results.items())
+        execution_history = SWFExecutionHistory(
+            [], [], results, {}, sorted(results), result_cache=cache)
+        decision = DummyDecision()
+        worker('W', '1', serialize_input(3), decision, execution_history)
+        return decision.result
+
+    def make_worker(self, calls, deserialize_result=None, serializer=None):
+        from flowy import SWFWorkflowConfig, SWFWorkflowWorker
+
+        def deserialize_input(input_data):
+            calls.append(input_data)
+            return ActivityConfig.deserialize_input(input_data)
+
+        class W(object):
+            def __init__(self, task):
+                self.task = task
+
+            def __call__(self, n):
+                return sum(self.task(i) for i in range(n))
+
+        w = SWFWorkflowConfig(deserialize_input=deserialize_input)
+        w.conf_activity('task', version=1,
+                        deserialize_result=deserialize_result,
+                        serializer=serializer)
+        worker = SWFWorkflowWorker()
+        worker.register(w, W, name='W', version=1)
+        return worker
+
+    def test_custom_deserializer_memoized(self):
+        from flowy.serialization import DecodeCache
+        calls = []
+
+        def deserialize_result(result):
+            calls.append(result)
+            return int(result)
+
+        worker = self.make_worker(calls, deserialize_result)
+        cache = DecodeCache(100)
+        self.run_decision(worker, {0: '1', 1: '2'}, cache)
+        r = self.run_decision(worker, {0: '1', 1: '2', 2: '3'}, cache)
+        self.assertEqual(r, {'finish': 6})
+        # the input decodes to mutable values, it isn't cached
+        self.assertEqual(sorted(calls),
+                         ['1', '2', '3', '[[3], {}]', '[[3], {}]'])
+        self.assertEqual(cache.hits, 2)
+
+    def test_bulk_decode(self):
+        from flowy.serialization import DecodeCache
+        calls = []
+        worker = self.make_worker(calls)
+        cache = DecodeCache(100)
+        r = self.run_decision(worker, {0: '1', 1: '2', 2: '3'}, cache)
+        self.assertEqual(r, {'finish': 6})
+        # all three results were decoded in a single parse and then read
+        self.assertEqual(cache.misses, 1)  # the workflow input
+        self.assertEqual(len(cache), 3)
+
+    def test_bulk_decode_with_serializer(self):
+        from flowy.serialization import DecodeCache, Serializer
+
+        class Cents(object):
+            pass
+
+        serializer = Serializer(types=[(Cents, 'cents', id, int)])
+        worker = self.make_worker([], serializer=serializer)
+        cache = DecodeCache(100)
+        results = dict((i, '{" cents": %s}' % (i + 1)) for i in range(3))
+        r = self.run_decision(worker, results, cache)
+        self.assertEqual(r, {'finish': 6})
+        self.assertEqual(cache.misses, 1)  # the workflow input
+        self.assertEqual(len(cache), 3)
+
+    def test_invalid_payload_not_cached(self):
+        from flowy.serialization import DecodeCache, loads
+        cache = DecodeCache(100)
+        cache.prefill(loads, ['1', '"'])
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.decode(loads, '1'), 1)
+        self.assertRaises(ValueError, lambda: cache.decode(loads, '"'))
+        self.assertEqual(len(cache), 1)
+
+    def test_mutable_values_are_not_cached(self):
+        from flowy.serialization import DecodeCache, loads
+        cache = DecodeCache(100)
+        date = '{" d": [2016, 1, 1]}'
+        cache.prefill(loads, ['{"k": [1, 2]}', '[1]', date])
+        self.assertEqual(len(cache), 1)
+        value = cache.decode(loads, '{"k": [1, 2]}')
+        value['k'].append(3)
+        self.assertEqual(cache.decode(loads, '{"k": [1, 2]}'), {'k': [1, 2]})
+        self.assertEqual(len(cache), 1)
+
+    def test_immutable_values_are_shared(self):
+        from flowy.serialization import DecodeCache, loads
+        cache = DecodeCache(100)
+        value = cache.decode(loads, '"x"')
+        self.assertTrue(cache.decode(loads, '"x"') is value)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_bounded_by_payload_length(self):
+        from flowy.serialization import DecodeCache, loads
+        cache = DecodeCache(10)
+        cache.prefill(loads, ['"%s"' % ('x' * 20), '1'])
+        self.assertEqual(len(cache), 1)  # too large to be cached
+        cache.decode(loads, '22')
+        cache.decode(loads, '"12345"')
+        self.assertEqual(len(cache), 3)
+        cache.decode(loads, '333')
+        self.assertEqual(len(cache), 2)
+        self.assertFalse((loads, '22') in cache)
+
+    def test_no_cache(self):
+        calls = []
+        worker = self.make_worker(calls)
+        r = self.run_decision(worker, {0: '1', 1: '2', 2: '3'}, None)
+        self.assertEqual(r, {'finish': 6})
+
+
+class TestRawForwarding(unittest.TestCase):
+    def make_worker(self, access):
+        from flowy import SWFWorkflowConfig, SWFWorkflowWorker
+
+        class W(object):
+            def __init__(self, a, b):
+                self.a = a
+                self.b = b
+
+            def __call__(self):
+                r = self.a()
+                if access:
+                    r['k'].append(3)
+                return self.b([r])
+
+        w = SWFWorkflowConfig()
+        w.conf_activity('a', version=1)
+        w.conf_activity('b', version=1)
+        worker = SWFWorkflowWorker()
+        worker.register(w, W, name='W', version=1)
+        return worker
+
+    def scheduled_input(self, access):
+        execution_history = SWFExecutionHistory(
+            [], [], {'a-0-0': '{"k":[1,2]}'}, {}, ['a-0-0'])
+        decision = DummyDecision()
+        inputs = []
+        schedule_activity = decision.schedule_activity
+
+        def capture(call_key, name, version, input_data, *args):
+            inputs.append(input_data)
+            schedule_activity(call_key, name, version, input_data, *args)
+
+        decision.schedule_activity = capture
+        self.make_worker(access)('W', '1', '[[], {}]', decision,
+                                 execution_history)
+        return inputs
+
+    def test_forwarded_result_not_decoded(self):
+        self.assertEqual(self.scheduled_input(False),
+                         ['[[[{"k":[1,2]}]], {}]'])
+
+    def test_accessed_result_reencoded(self):
+        self.assertEqual(self.scheduled_input(True),
+                         ['[[[{"k": [1, 2, 3]}]], {}]'])
+
+
+class TestRawActivity(unittest.TestCase):
+    def test_raw_payload(self):
+        from flowy import SWFActivityConfig
+        calls = []
+
+        def store(heartbeat, input_data):
+            calls.append((heartbeat, input_data))
+            return '"stored"'
+
+        wrapped = SWFActivityConfig(raw=True).wrap(store)
+        self.assertEqual(wrapped('[[1], {}]', 'hb'), '"stored"')
+        self.assertEqual(calls, [('hb', '[[1], {}]')])
+
+    def test_raw_result_must_be_serialized(self):
+        from flowy import SWFActivityConfig
+        wrapped = SWFActivityConfig(raw=True).wrap(lambda hb, data: 1)
+        self.assertRaises(ValueError, lambda: wrapped('[[], {}]', 'hb'))
+
+    def test_raw_bytes_result_is_decoded(self):
+        from flowy import SWFActivityConfig
+        wrapped = SWFActivityConfig(raw=True).wrap(
+            lambda hb, data: u'"\u021b"'.encode('utf-8'))
+        self.assertEqual(wrapped('[[], {}]', 'hb'), u'"\u021b"')
+
+    def test_raw_with_serializers(self):
+        from flowy import SWFActivityConfig
+        self.assertRaises(ValueError,
+                          lambda: SWFActivityConfig(raw=True,
+                                                    serialize_result=str))
+
+
+class TestPagePrefetcher(unittest.TestCase):
+    def test_prefetched_history(self):
+        from flowy.swf.worker import poll_decision, PollerStats
+        layer1 = FakeDecisionLayer1(make_history(5))
+        stats = PollerStats('test')
+        r = poll_decision(layer1, 'domain', 'tl', prefetch_pages=2,
+                          stats=stats)
+        exec_history = r[3]
+        self.assertEqual(exec_history.result('task-4-0'), '4')
+        self.assertEqual(exec_history.order('task-4-0'), 4)
+        self.assertEqual(len(layer1.calls), 4)
+        self.assertEqual(stats.pages, 3)
+
+    def test_stops_with_the_consumer(self):
+        import time
+        from flowy.swf.worker import PagePrefetcher
+        fetched = []
+
+        def fetch(token):
+            fetched.append(token)
+            return {'events': [int(token)], 'nextPageToken': int(token) + 1}
+
+        events = PagePrefetcher(fetch, {'events': [0], 'nextPageToken': 1},
+                                depth=1).events()
+        self.assertEqual([next(events) for _ in range(3)], [0, 1, 2])
+        events.close()
+        count = len(fetched)
+        self.assertTrue(count <= 4)
+        time.sleep(0.05)
+        self.assertEqual(len(fetched), count)
+
+    def test_fetch_errors_propagate(self):
+        from flowy.swf.worker import PagePrefetcher
+
+        def fetch(token):
+            raise ValueError(token)
+
+        events = PagePrefetcher(fetch, {'events': [0], 'nextPageToken': 'x'})
+        events = events.events()
+        self.assertEqual(next(events), 0)
+        self.assertRaises(ValueError, lambda: next(events))
+
+
+class FakeStartLayer1(object):
+    def __init__(self):
+        self.started = []
+
+    def start_workflow_execution(self, domain, wid, name, version, **kwargs):
+        from boto.exception import SWFResponseError
+        from boto.swf.exceptions import SWFWorkflowExecutionAlreadyStartedError
+        if wid == 'dup':
+            raise SWFWorkflowExecutionAlreadyStartedError(400, 'Bad Request')
+        if wid == 'bad':
+            raise SWFResponseError(400, 'Bad Request')
+        self.started.append((wid, kwargs['input']))
+        return {'runId': 'run-%s' % wid}
+
+
+class TestStartMany(unittest.TestCase):
+    def test_start_many(self):
+        from flowy import SWFWorkflowStarter
+        layer1 = FakeStartLayer1()
+        starter = SWFWorkflowStarter('domain', 'W', 1, layer1=layer1)
+        inputs = [{'wid': 'w%s' % i, 'args': [i]} for i in range(20)]
+        inputs[3] = {'wid': 'dup'}
+        inputs[5] = {'wid': 'bad', 'kwargs': {'x': 1}}
+        results = starter.start_many(iter(inputs), concurrency=3)
+        self.assertEqual(len(results), 20)
+        self.assertEqual(results[0], ('w0', 'run-w0', 'started', None))
+        self.assertEqual(results[3], ('dup', None, 'already_started', None))
+        self.assertEqual(results[5][:3], ('bad', None, 'failed'))
+        self.assertEqual(len(layer1.started), 18)
+        self.assertTrue(('w7', '[[7], {}]') in layer1.started)
+
+    def test_random_wids(self):
+        from flowy import SWFWorkflowStarter
+        layer1 = FakeStartLayer1()
+        starter = SWFWorkflowStarter('domain', 'W', 1, layer1=layer1)
+        results = starter.start_many([{}, {}])
+        self.assertNotEqual(results[0].wid, results[1].wid)
+
+    def test_read_inputs(self):
+        from flowy.__main__ import read_inputs
+        lines = ['[1, 2]\n', '\n', '{"wid": "x", "kwargs": {"a": 1}}\n']
+        self.assertEqual(list(read_inputs(lines)),
+                         [{'args': [1, 2]}, {'wid': 'x', 'kwargs': {'a': 1}}])
+
+
+class TestBinarySerialization(unittest.TestCase):
+    def test_binary_activity_input(self):
+        from flowy import SWFWorkflowConfig, SWFWorkflowWorker
+        from flowy.serialization import dumps_binary
+
+        class W(object):
+            def __init__(self, a):
+                self.a = a
+
+            def __call__(self):
+                return self.a((1, 2), self.a())
+
+        w = SWFWorkflowConfig(binary=True)
+        w.conf_activity('a', version=1, binary=True)
+        worker = SWFWorkflowWorker()
+        worker.register(w, W, name='W', version=1)
+        execution_history = SWFExecutionHistory(
+            [], [], {'a-0-0': dumps_binary((3, 4))}, {}, ['a-0-0'])
+        decision = DummyDecision()
+        inputs = []
+        decision.schedule_activity = lambda *args: inputs.append(args[3])
+        worker('W', '1', '[[], {}]', decision, execution_history)
+        self.assertTrue(inputs[0].startswith('~1'))
+        self.assertEqual(deserialize_input(inputs[0]), ([(1, 2), (3, 4)], {}))
+
+    def test_binary_activity_result(self):
+        from flowy import SWFActivityConfig
+        from flowy.serialization import dumps_binary, loads
+        wrapped = SWFActivityConfig(binary=True).wrap(lambda hb, x: (x, x))
+        result = wrapped(dumps_binary([[1], {}]), 'hb')
+        self.assertEqual(loads(result), (1, 1))
+
+    def test_binary_with_custom_serializers(self):
+        from flowy import SWFActivityConfig, SWFWorkflowConfig
+        self.assertRaises(ValueError, lambda: SWFActivityConfig(
+            binary=True, serialize_result=str))
+        self.assertRaises(ValueError, lambda: SWFWorkflowConfig().conf_activity(
+            'a', 1, binary=True, serialize_input=str))
+
+
+class TestConcurrencyLimits(unittest.TestCase):
+    def schedule(self, config, history):
+        return decide(config, FanOut, history)[0]
+
+    def config(self, rate_limit=None, a_limit=None):
+        from flowy import SWFWorkflowConfig
+        w = SWFWorkflowConfig(rate_limit=rate_limit)
+        w.conf_activity('a', version=1, rate_limit=a_limit)
+        w.conf_activity('b', version=1, retry=(1, ))  # delayed by a timer
+        return w
+
+    def test_counts_running_tasks(self):
+        history = SWFExecutionHistory(
+            ['a-0-0', 'a-1-0', 'b-0-0:t'], [], {}, {}, [])
+        self.assertEqual(self.schedule(self.config(rate_limit=4), history),
+                         ['a-2-0', 'a-3-0'])
+
+    def test_timers_are_not_limited(self):
+        history = SWFExecutionHistory([], [], {}, {}, [])
+        self.assertEqual(self.schedule(self.config(rate_limit=2), history),
+                         ['a-0-0', 'a-1-0', ('b-0-0', 1)])
+        history = SWFExecutionHistory([], [], {'b-0-0:t': None}, {}, [])
+        self.assertEqual(self.schedule(self.config(a_limit=2), history),
+                         ['a-0-0', 'a-1-0', 'b-0-0'])
+
+    def test_per_dependency_limit(self):
+        history = SWFExecutionHistory(['a-0-0', 'a-3-0'], [], {}, {}, [])
+        self.assertEqual(
+            self.schedule(self.config(rate_limit=5, a_limit=3), history),
+            ['a-1-0', ('b-0-0', 1)])
+
+    def test_no_limit(self):
+        history = SWFExecutionHistory(['a-0-0'], [], {}, {}, [])
+        self.assertEqual(self.schedule(self.config(), history),
+                         ['a-1-0', 'a-2-0', 'a-3-0', 'a-4-0', ('b-0-0', 1)])
+
+    def test_invalid_limits(self):
+        self.assertRaises(ValueError, lambda: self.config(rate_limit=0))
+        self.assertRaises(ValueError, lambda: self.config(a_limit=-1))
+
+
+class TestRateLimits(unittest.TestCase):
+    def schedule(self, max_rate, history, rate_limit=None):
+        from flowy import SWFWorkflowConfig
+        w = SWFWorkflowConfig(rate_limit=rate_limit)
+        w.conf_activity('a', version=1, max_rate=max_rate)
+        return decide(w, FanOut, history)[0]
+
+    def test_defer_with_timer(self):
+        history = SWFExecutionHistory(
+            ['a-0-0'], [], {'a-1-0': '1'}, {}, ['a-1-0'],
+            starts={'a': [99.0, 100.0, 100.5]}, now=100.8)
+        self.assertEqual(self.schedule(3, history),
+                         ['a-2-0', ('a:r:102', 1)])
+
+    def test_wake_up_timer_running(self):
+        history = SWFExecutionHistory(
+            ['a:r:102:t'], [], {}, {}, [], starts={'a': [100.5]}, now=100.8)
+        self.assertEqual(self.schedule(2, history), ['a-0-0'])
+
+    def test_slow_rate(self):
+        history = SWFExecutionHistory([], [], {}, {}, [], now=10)
+        self.assertEqual(self.schedule(0.5, history), ['a-0-0', ('a:r:12', 2)])
+        history = SWFExecutionHistory([], [], {}, {}, [], starts={'a': [8]},
+                                      now=10)
+        self.assertEqual(self.schedule(0.5, history), ['a-0-0', ('a:r:12', 2)])
+
+    def test_limited_tasks_dont_consume_the_rate(self):
+        history = SWFExecutionHistory([], [], {}, {}, [], now=100)
+        self.assertEqual(self.schedule(3, history, rate_limit=2),
+                         ['a-0-0', 'a-1-0'])
+
+    def test_invalid_rates(self):
+        from flowy import SWFWorkflowConfig
+        w = SWFWorkflowConfig()
+        self.assertRaises(ValueError, lambda: w.conf_activity('a', 1,
+                                                              max_rate=0))
+        self.assertRaises(ValueError, lambda: w.conf_workflow('a', 1,
+                                                              max_rate=-1))
+        self.assertRaises(ValueError, lambda: w.conf_activity('a', 1,
+                                                              max_rate=2.5))
+        w.conf_activity('a', 1, max_rate=0.4)
+        w.conf_activity('b', 1, max_rate=2.0)
+
+    def test_parsed_start_times(self):
+        from flowy.swf.worker import load_history
+        events = [{
+            'eventId': 1, 'eventTimestamp': 10.0,
+            'eventType': 'WorkflowExecutionStarted',
+            'workflowExecutionStartedEventAttributes': {},
+        }]
+        for i, ts in enumerate((11.0, 12.5)):
+            events.append({
+                'eventId': len(events) + 1, 'eventTimestamp': ts,
+                'eventType': 'ActivityTaskScheduled',
+                'activityTaskScheduledEventAttributes': {
+                    'activityId': 'a-%s-0' % i},
+            })
+        events.append({'eventId': len(events) + 1, 'eventTimestamp': 13.0,
+                       'eventType': 'DecisionTaskStarted'})
+        history = load_history(events)
+        self.assertEqual(history.starts, {'a': [11.0, 12.5]})
+        self.assertEqual(history.now, 13.0)
+
+
+class TestHedging(unittest.TestCase):
+    def decide(self, history, retry=(0, 0, 0)):
+        from flowy import SWFWorkflowConfig
+        w = SWFWorkflowConfig()
+        w.conf_activity('a', version=1, hedge=5, retry=retry)
+        return decide(w, Single, history)
+
+    def test_hedge_timer_starts_with_the_task(self):
+        history = SWFExecutionHistory([], [], {}, {}, [])
+        self.assertEqual(self.decide(history)[0], ['a-0-0', ('a:h-0-0', 5)])
+
+    def test_duplicate_after_timer(self):
+        history = SWFExecutionHistory(['a-0-0', 'a:h-0-0:t'], [], {}, {}, [])
+        self.assertEqual(self.decide(history)[0], [])
+        history = SWFExecutionHistory(['a-0-0'], [], {'a:h-0-0:t': None}, {},
+                                      ['a:h-0-0:t'])
+        self.assertEqual(self.decide(history)[0], ['a:h-0-0'])
+
+    def test_duplicate_wins(self):
+        history = SWFExecutionHistory(['a-0-0'], [], {'a:h-0-0': '2'}, {},
+                                      ['a:h-0-0'])
+        self.assertEqual(self.decide(history),
+                         ([('cancel', 'a-0-0')], {'finish': 2}))
+        history = SWFExecutionHistory(
+            ['a-0-0'], [], {'a:h-0-0': '2'}, {}, ['a:h-0-0'],
+            cancel_requested=set(['a-0-0']))
+        self.assertEqual(self.decide(history), ([], {'finish': 2}))
+
+    def test_first_to_finish_wins(self):
+        history = SWFExecutionHistory(
+            [], [], {'a-0-0': '1', 'a:h-0-0': '2'}, {}, ['a:h-0-0', 'a-0-0'])
+        self.assertEqual(self.decide(history), ([], {'finish': 2}))
+        history = SWFExecutionHistory(
+            ['a:h-0-0'], [], {'a-0-0': '1'}, {}, ['a-0-0'])
+        self.assertEqual(self.decide(history),
+                         ([('cancel', 'a:h-0-0')], {'finish': 1}))
+        history = SWFExecutionHistory(
+            [], [], {'a:h-0-0': '2'}, {'a-0-0': 'err'}, ['a-0-0', 'a:h-0-0'])
+        self.assertEqual(self.decide(history), ([], {'fail': 'err'}))
+
+    def test_timed_out_duplicate(self):
+        history = SWFExecutionHistory(['a-0-0'], ['a:h-0-0'], {}, {},
+                                      ['a:h-0-0'])
+        self.assertEqual(self.decide(history)[0], [])
+        history = SWFExecutionHistory([], ['a-0-0', 'a:h-0-0'], {}, {},
+                                      ['a:h-0-0', 'a-0-0'])
+        self.assertEqual(self.decide(history)[0], ['a-0-1', ('a:h-0-1', 5)])
+
+    def test_timeout_after_hedge_timer(self):
+        # The retry keeps its own delay, the fired hedge timer is ignored
+        history = SWFExecutionHistory(
+            [], ['a-0-0'], {'a:h-0-0:t': None}, {}, ['a:h-0-0:t', 'a-0-0'])
+        self.assertEqual(self.decide(history, retry=(0, 10))[0],
+                         [('a-0-1', 10)])
+        history = SWFExecutionHistory(
+            [], ['a-0-0'], {'a:h-0-0:t': None, 'a-0-1:t': None}, {},
+            ['a:h-0-0:t', 'a-0-0', 'a-0-1:t'])
+        self.assertEqual(self.decide(history, retry=(0, 10))[0],
+                         ['a-0-1', ('a:h-0-1', 5)])
+
+    def test_duplicate_replaces_timed_out_task(self):
+        history = SWFExecutionHistory(['a:h-0-0'], ['a-0-0'], {}, {},
+                                      ['a-0-0'])
+        self.assertEqual(self.decide(history, retry=(0, 10))[0], [])
+        history = SWFExecutionHistory([], ['a-0-0'], {'a:h-0-0': '2'}, {},
+                                      ['a-0-0', 'a:h-0-0'])
+        self.assertEqual(self.decide(history, retry=(0, 10)),
+                         ([], {'finish': 2}))
+
+    def test_duplicates_count_for_their_proxy(self):
+        history = SWFExecutionHistory(['a-0-0', 'a:h-0-0'], [], {}, {}, [])
+        self.assertEqual(history.running_count('a'), 2)
+        self.assertEqual(history.running_count(), 2)
+
+    def test_invalid_hedge(self):
+        from flowy import SWFWorkflowConfig
+        w = SWFWorkflowConfig()
+        w.conf_activity('a', 1, hedge=5, retry=(0, ))
+        self.assertRaises(ValueError, lambda: w.conf_activity('b', 1, hedge=0))
+
+    def test_parsed_cancellation(self):
+        from flowy.swf.worker import load_history
+        events = [{
+            'eventId': 1, 'eventType': 'WorkflowExecutionStarted',
+            'workflowExecutionStartedEventAttributes': {},
+        }, {
+            'eventId': 2, 'eventType': 'ActivityTaskScheduled',
+            'activityTaskScheduledEventAttributes': {'activityId': 'a-0-0'},
+        }, {
+            'eventId': 3, 'eventType': 'ActivityTaskCancelRequested',
+            'activityTaskCancelRequestedEventAttributes': {
+                'activityId': 'a-0-0'},
+        }, {
+            'eventId': 4, 'eventType': 'ActivityTaskCanceled',
+            'activityTaskCanceledEventAttributes': {'scheduledEventId': 2},
+        }]
+        history = load_history(events)
+        self.assertEqual(history.cancel_requested, set(['a-0-0']))
+        self.assertEqual(history.running, set())
+        self.assertEqual(history.errors, {'a-0-0': 'The task was canceled.'})
+
+
+class FakeRespondLayer1(object):
+    """Record the decisions sent."""
+
+    def __init__(self):
+        self.decisions = None
+
+    def respond_decision_task_completed(self, task_token, decisions):
+        self.decisions = decisions
+
+
+class Race(object):
+    """The first of two activities and a sub-workflow."""
+
+    def __init__(self, a, w):
+        self.a = a
+        self.w = w
+
+    def __call__(self):
+        from flowy import first
+        return first(self.a(), self.a(), self.w())
+
+
+class TestCancelAbandoned(unittest.TestCase):
+    def decide(self, history, cancel_abandoned=True, workflow=None):
+        from flowy import SWFWorkflowConfig
+        from flowy.swf.decision import SWFWorkflowDecision
+        w = SWFWorkflowConfig(cancel_abandoned=cancel_abandoned)
+        w.conf_activity('a', version=1)
+        w.conf_workflow('w', version=1)
+        layer1 = FakeRespondLayer1()
+        decision = SWFWorkflowDecision(layer1, 'token', 'W', '1', 'tl', '10',
+                                       '20', None, 'TERMINATE')
+        decide(w, workflow or Race, history, decision=decision)
+        return [(d['decisionType'], list(d[k].values())[0])
+                for d in layer1.decisions for k in d if k != 'decisionType']
+
+    def history(self, running, results, order, cancel_requested=None):
+        return SWFExecutionHistory(
+            running, [], results, {}, order,
+            cancel_requested=cancel_requested,
+            workflow_ids={'w-0-0': 'uuid:w-0-0'})
+
+    def test_first_losers(self):
+        history = self.history(['a-1-0', 'w-0-0'], {'a-0-0': '1'}, ['a-0-0'])
+        self.assertEqual(self.decide(history), [
+            ('RequestCancelActivityTask', 'a-1-0'),
+            ('RequestCancelExternalWorkflowExecution', 'uuid:w-0-0'),
+            ('CompleteWorkflowExecution', '1'),
+        ])
+        self.assertEqual(self.decide(history, cancel_abandoned=False),
+                         [('CompleteWorkflowExecution', '1')])
+
+    def test_cancel_requested_once(self):
+        history = self.history(['a-1-0', 'w-0-0'], {'a-0-0': '1'}, ['a-0-0'],
+                               cancel_requested=set(['a-1-0']))
+        self.assertEqual(self.decide(history), [
+            ('RequestCancelExternalWorkflowExecution', 'uuid:w-0-0'),
+            ('CompleteWorkflowExecution', '1'),
+        ])
+
+    def test_losers_while_waiting(self):
+        from flowy import first, wait
+
+        class W(object):
+            def __init__(self, a, w):
+                self.a = a
+                self.w = w
+
+            def __call__(self):
+                wait(first(self.a(), self.w()))
+                return self.a()
+
+        history = self.history(['w-0-0'], {'a-0-0': '1'}, ['a-0-0'])
+        self.assertEqual(self.decide(history, workflow=W), [
+            ('RequestCancelExternalWorkflowExecution', 'uuid:w-0-0'),
+            ('ScheduleActivityTask', 'a-1-0'),
+        ])
+
+    def test_running_on_failure(self):
+        class W(object):
+            def __init__(self, a, w):
+                self.a = a
+                self.w = w
+
+            def __call__(self):
+                self.a()
+                raise ValueError('err')
+
+        history = self.history(['a-0-0'], {}, [])
+        self.assertEqual(self.decide(history, workflow=W), [
+            ('RequestCancelActivityTask', 'a-0-0'),
+            ('FailWorkflowExecution', 'err'),
+        ])
+
+    def test_parsed_sub_workflow_cancellation(self):
+        from flowy.swf.worker import load_history
+        events = [{
+            'eventId': 1, 'eventType': 'WorkflowExecutionStarted',
+            'workflowExecutionStartedEventAttributes': {},
+        }, {
+            'eventId': 2, 'eventType': 'StartChildWorkflowExecutionInitiated',
+            'startChildWorkflowExecutionInitiatedEventAttributes': {
+                'workflowId': 'uuid:w-0-0'},
+        }, {
+            'eventId': 3,
+            'eventType': 'RequestCancelExternalWorkflowExecutionInitiated',
+            'requestCancelExternalWorkflowExecutionInitiatedEventAttributes': {
+                'workflowId': 'uuid:w-0-0'},
+        }, {
+            'eventId': 4, 'eventType': 'ChildWorkflowExecutionCanceled',
+            'childWorkflowExecutionCanceledEventAttributes': {
+                'workflowExecution': {'workflowId': 'uuid:w-0-0'}},
+        }]
+        history = load_history(events)
+        self.assertEqual(history.workflow_ids, {'w-0-0': 'uuid:w-0-0'})
+        self.assertEqual(history.cancel_requested, set(['w-0-0']))
+        self.assertEqual(history.running, set())
+        self.assertEqual(history.errors, {'w-0-0': 'The task was canceled.'})
+
+
+class Timeout(object):
+    """An activity raced with a 1.5 seconds sleep."""
+
+    def __init__(self, a, sleep):
+        self.a = a
+        self.sleep = sleep
+
+    def __call__(self):
+        from flowy import first
+        return first(self.a(), self.sleep(1.5))
+
+
+class TestSleep(unittest.TestCase):
+    def decide(self, history):
+        from flowy import SWFWorkflowConfig
+        w = SWFWorkflowConfig()
+        w.conf_activity('a', version=1)
+        w.conf_timer('sleep')
+        return decide(w, Timeout, history)
+
+    def test_timer_started_once(self):
+        history = SWFExecutionHistory([], [], {}, {}, [])
+        self.assertEqual(self.decide(history),
+                         (['a-0-0', ('sleep-0-0', 1.5)], {'schedule': []}))
+        history = SWFExecutionHistory(['a-0-0', 'sleep-0-0:t'], [], {}, {}, [])
+        self.assertEqual(self.decide(history), ([], {'schedule': []}))
+
+    def test_first_to_finish(self):
+        history = SWFExecutionHistory(['a-0-0'], [], {'sleep-0-0:t': None},
+                                      {}, ['sleep-0-0:t'])
+        self.assertEqual(self.decide(history), ([], {'finish': None}))
+        history = SWFExecutionHistory(
+            [], [], {'a-0-0': '2', 'sleep-0-0:t': None}, {},
+            ['a-0-0', 'sleep-0-0:t'])
+        self.assertEqual(self.decide(history), ([], {'finish': 2}))
+
+    def test_parsed_timer(self):
+        from flowy.swf.worker import load_history
+        events = [{
+            'eventId': 1, 'eventType': 'WorkflowExecutionStarted',
+            'workflowExecutionStartedEventAttributes': {},
+        }, {
+            'eventId': 2, 'eventType': 'TimerStarted',
+            'timerStartedEventAttributes': {'timerId': 'sleep-0-0:t'},
+        }, {
+            'eventId': 3, 'eventType': 'TimerFired',
+            'timerFiredEventAttributes': {'timerId': 'sleep-0-0:t'},
+        }]
+        history = load_history(events)
+        h = SWFExecutionHistory(history.running, history.timedout,
+                                history.results, history.errors,
+                                history.order, history.index)
+        self.assertTrue(h.is_timer_ready('sleep-0-0'))
+        self.assertEqual(h.timer_order('sleep-0-0'), 0)
+
+    def test_timer_rounded_up(self):
+        from flowy.swf.decision import SWFWorkflowDecision
+        decision = SWFWorkflowDecision(None, 'token', 'W', '1', 'tl', None,
+                                       None, None, None)
+        decision.schedule_timer('sleep-0-0', 1.5)
+        attrs = decision.decisions._data[0]['startTimerDecisionAttributes']
+        self.assertEqual(attrs['startToFireTimeout'], '2')
+
+
+class TestIgnoredErrors(unittest.TestCase):
+    def setUp(self):
+        import logging
+        from flowy.utils import logger
+        self.records = records = []
+
+        class Handler(logging.Handler):
+            def emit(self, record):
+                records.append(record.getMessage())
+
+        self.handler = Handler()
+        logger.addHandler(self.handler)
+
+    def tearDown(self):
+        from flowy.utils import logger
+        logger.removeHandler(self.handler)
+
+    def decide(self, use_error):
+        from flowy import SWFWorkflowConfig
+        w = SWFWorkflowConfig()
+        w.conf_activity('a', version=1)
+        history = SWFExecutionHistory([], [], {}, {'a-0-0': 'err'},
+                                      ['a-0-0'])
+        return decide(w, Single, history, args=(use_error, ))[1]
+
+    def test_ignored_error_is_logged(self):
+        self.assertEqual(self.decide(False), {'finish': 1})
+        self.assertEqual(self.records, ['Result with error was ignored: err'])
+
+    def test_used_error_is_not_logged(self):
+        self.assertEqual(self.decide(True), {'fail': 'err'})
+        self.assertEqual(
+            [r for r in self.records if 'ignored' in r], [])
+
+    def test_result_has_no_finalizer(self):
+        from flowy.result import TaskResult
+        self.assertFalse(hasattr(TaskResult, '__del__'))
+        self.assertFalse(hasattr(TaskResult(), '__dict__'))